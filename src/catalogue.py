@@ -0,0 +1,75 @@
+import json
+from collections import OrderedDict
+from osgeo import ogr, osr
+
+
+class LakeCatalogue:
+    """
+    Lake polygons of a GeoJSON FeatureCollection, transformed on demand into the coordinate system of each scene.
+
+    The polygons are read in the CRS named by the GeoJSON "crs" member (WGS84 lon/lat when missing, as in the
+    GeoJSON specification). Transformed geometries and their envelopes are cached per scene projection, so a run
+    pays the transformation once per (lake, CRS). Scenes without a projection, or in the catalogue CRS, use the
+    polygons as they are.
+
+    With mask_cache (MB) the rasterized lake masks are also kept, least recently used first out, so scenes on
+    the same grid (e.g. the same tile in a long running daemon) skip rasterization.
+    """
+    def __init__(self, geojson, mask_cache=0):
+        crs = (geojson.get("crs") or {}).get("properties", {}).get("name")
+        self.source = osr.SpatialReference()
+        self.source.SetFromUserInput(crs if crs else "EPSG:4326")
+        self.source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        self.features = []
+        for lake in geojson["features"]:
+            geometry = json.loads(json.dumps(lake["geometry"]))
+            if geometry["coordinates"][0][0] != geometry["coordinates"][0][-1]:
+                geometry["coordinates"][0].append(geometry["coordinates"][0][0])
+            self.features.append((lake["properties"]["key"], ogr.CreateGeometryFromJson(json.dumps(geometry))))
+        self._cache = {}
+        self.mask_cache = mask_cache
+        self._masks = OrderedDict()
+        self._mask_bytes = 0
+
+    def keys(self):
+        return [key for key, geometry in self.features]
+
+    def lakes(self, projection):
+        """List of (key, geometry, envelope) in the coordinate system given as WKT, envelope as (min_x, max_x, min_y, max_y)."""
+        if projection not in self._cache:
+            transform = self._transform(projection)
+            lakes = []
+            for key, geometry in self.features:
+                if transform is not None:
+                    geometry = geometry.Clone()
+                    geometry.Transform(transform)
+                lakes.append((key, geometry, geometry.GetEnvelope()))
+            self._cache[projection] = lakes
+        return self._cache[projection]
+
+    def _transform(self, projection):
+        if not projection:
+            return None
+        target = osr.SpatialReference()
+        target.ImportFromWkt(projection)
+        target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        if target.IsSame(self.source):
+            return None
+        return osr.CoordinateTransformation(self.source, target)
+
+    def mask(self, raster, key, geometry, window):
+        """Lake mask of geometry over the (x_offset, y_offset, x_size, y_size) window of raster, see polygon_raster_mask."""
+        from functions import polygon_raster_mask
+        if not self.mask_cache:
+            return polygon_raster_mask(raster, geometry, window=window)
+        cache_key = (key, raster.GetProjection(), raster.GetGeoTransform(), tuple(window))
+        if cache_key in self._masks:
+            self._masks.move_to_end(cache_key)
+            return self._masks[cache_key]
+        mask = polygon_raster_mask(raster, geometry, window=window)
+        mask.flags.writeable = False
+        self._masks[cache_key] = mask
+        self._mask_bytes += mask.nbytes
+        while self._mask_bytes > self.mask_cache * 1024 * 1024 and len(self._masks) > 0:
+            self._mask_bytes -= self._masks.popitem(last=False)[1].nbytes
+        return mask
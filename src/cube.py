@@ -0,0 +1,158 @@
+import os
+import json
+import zlib
+import numpy as np
+from timeseries import parse_date
+
+
+class LakeCube:
+    """
+    Chunked, compressed time x y x x array of the crops of one lake and parameter, stored as a Zarr (v2) group
+    that can be opened with zarr or xarray (engine="zarr"):
+
+        <path>/.zgroup
+        <path>/.zattrs        crs, geotransform of the lake grid and the source file of every time step
+        <path>/data/          float32 crops, NaN outside the lake and for invalid pixels
+        <path>/time/          int64 acquisition times, seconds since 1970-01-01
+
+    The lake grid is fixed by the first crop. Time steps are appended in processing order (see the time array
+    for sorting); re-adding a file overwrites its time step and removing a file clears it. A pixel time series
+    reads one chunk per time_chunk time steps. Files are replaced atomically; concurrent writers must hold a
+    lock (see functions.add_to_cube).
+    """
+    def __init__(self, path, chunks=(32, 256, 256), level=5, time_chunk=4096):
+        self.path = path
+        self.level = level
+        self.attributes = self._read(".zattrs")
+        self.data = self._read(os.path.join("data", ".zarray"))
+        if self.data is None:
+            self.data = {"zarr_format": 2, "shape": [0, 0, 0], "chunks": list(chunks), "dtype": "<f4",
+                         "compressor": {"id": "zlib", "level": level}, "fill_value": "NaN", "filters": None,
+                         "order": "C"}
+            self.time = {"zarr_format": 2, "shape": [0], "chunks": [time_chunk], "dtype": "<i8",
+                         "compressor": {"id": "zlib", "level": level}, "fill_value": 0, "filters": None,
+                         "order": "C"}
+        else:
+            self.time = self._read(os.path.join("time", ".zarray"))
+
+    def _read(self, name):
+        path = os.path.join(self.path, name)
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+        return None
+
+    def _replace(self, path, content, mode):
+        """Writes a file of the store atomically, so readers (e.g. a running sync) never see partial files."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_file = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_file, mode) as f:
+            f.write(content)
+        os.replace(temp_file, path)
+
+    def _write(self, name, data):
+        self._replace(os.path.join(self.path, name), json.dumps(data, indent=1), 'w')
+
+    def _chunk(self, array, key, dtype, shape, fill):
+        path = os.path.join(self.path, array, key)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                return np.frombuffer(zlib.decompress(f.read()), dtype=dtype).reshape(shape).copy()
+        return np.full(shape, fill, dtype=dtype)
+
+    def _write_chunk(self, array, key, values, empty):
+        path = os.path.join(self.path, array, key)
+        if empty:
+            if os.path.isfile(path):
+                os.remove(path)
+            return
+        self._replace(path, zlib.compress(values.tobytes(), self.level), 'wb')
+
+    @property
+    def files(self):
+        return self.attributes["files"] if self.attributes is not None else []
+
+    def grid(self):
+        """Projection (WKT), geotransform and (height, width) of the lake grid, None for an empty cube."""
+        if self.attributes is None:
+            return None
+        return self.attributes["crs"], tuple(self.attributes["geotransform"]), tuple(self.data["shape"][1:])
+
+    def append(self, file, date, values, crs=None, geotransform=None):
+        """
+        Writes the crop of file (2D array on the lake grid) acquired at date (YYYYMMDDTHHMMSS) and returns its
+        time index. crs and geotransform define the lake grid when the cube is created.
+        """
+        values = np.asarray(values, dtype=np.float32)
+        if self.attributes is None:
+            self.attributes = {"crs": crs, "geotransform": list(geotransform), "files": []}
+            self.data["shape"] = [0] + list(values.shape)
+            self._write(".zgroup", {"zarr_format": 2})
+            self._write(os.path.join("data", ".zattrs"), {"_ARRAY_DIMENSIONS": ["time", "y", "x"]})
+            self._write(os.path.join("time", ".zattrs"), {"_ARRAY_DIMENSIONS": ["time"],
+                                                          "units": "seconds since 1970-01-01"})
+        if list(values.shape) != self.data["shape"][1:]:
+            raise ValueError("Crop shape {} does not match the lake grid {}".format(values.shape, self.data["shape"][1:]))
+        if file in self.files:
+            index = self.files.index(file)
+        else:
+            index = len(self.files)
+            self.files.append(file)
+            self.data["shape"][0] = index + 1
+            self.time["shape"][0] = index + 1
+        self._set(index, values, parse_date(date).astype(np.int64))
+        self._write(".zattrs", self.attributes)
+        self._write(os.path.join("data", ".zarray"), self.data)
+        self._write(os.path.join("time", ".zarray"), self.time)
+        return index
+
+    def remove(self, file):
+        """Clears the time step of file (all NaN, time 0). Returns False if the file is not in the cube."""
+        if file not in self.files:
+            return False
+        index = self.files.index(file)
+        self._set(index, np.full(self.data["shape"][1:], np.nan, dtype=np.float32), 0)
+        self.files[index] = None
+        self._write(".zattrs", self.attributes)
+        return True
+
+    def _set(self, index, values, time):
+        ct, cy, cx = self.data["chunks"]
+        height, width = self.data["shape"][1:]
+        for y in range(0, height, cy):
+            for x in range(0, width, cx):
+                key = "{}.{}.{}".format(index // ct, y // cy, x // cx)
+                chunk = self._chunk("data", key, np.float32, (ct, cy, cx), np.nan)
+                part = values[y:y + cy, x:x + cx]
+                chunk[index % ct] = np.nan
+                chunk[index % ct, :part.shape[0], :part.shape[1]] = part
+                self._write_chunk("data", key, chunk, np.isnan(chunk).all())
+        size = self.time["chunks"][0]
+        times = self._chunk("time", str(index // size), np.int64, (size,), 0)
+        times[index % size] = time
+        self._write_chunk("time", str(index // size), times, False)
+
+    def times(self):
+        size = self.time["chunks"][0]
+        count = self.time["shape"][0]
+        chunks = [self._chunk("time", str(i), np.int64, (size,), 0) for i in range((count + size - 1) // size)]
+        return np.concatenate(chunks)[:count].astype("datetime64[s]") if count > 0 else np.array([], dtype="datetime64[s]")
+
+    def read(self, index):
+        """Crop of one time step."""
+        ct, cy, cx = self.data["chunks"]
+        height, width = self.data["shape"][1:]
+        values = np.full((height, width), np.nan, dtype=np.float32)
+        for y in range(0, height, cy):
+            for x in range(0, width, cx):
+                chunk = self._chunk("data", "{}.{}.{}".format(index // ct, y // cy, x // cx), np.float32, (ct, cy, cx), np.nan)
+                values[y:y + cy, x:x + cx] = chunk[index % ct, :min(cy, height - y), :min(cx, width - x)]
+        return values
+
+    def pixel(self, y, x):
+        """Time series of one pixel, reading a single chunk per time_chunk time steps."""
+        ct, cy, cx = self.data["chunks"]
+        count = self.data["shape"][0]
+        values = [self._chunk("data", "{}.{}.{}".format(t, y // cy, x // cx), np.float32, (ct, cy, cx), np.nan)[:, y % cy, x % cx]
+                  for t in range((count + ct - 1) // ct)]
+        return np.concatenate(values)[:count] if count > 0 else np.array([], dtype=np.float32)
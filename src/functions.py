@@ -1,10 +1,14 @@
 import os
 import json
+import shutil
 import tempfile
-import requests
 import subprocess
-import numpy as np
-from osgeo import gdal, ogr, osr
+import instrumentation
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# numpy, osgeo and requests are imported inside the functions that use them, so that starting
+# the CLI (and the common "No updates, exiting." path) does not pay for loading them.
 
 conda_env_path = os.environ.get("CONDA_PREFIX")
 if conda_env_path:
@@ -12,88 +16,820 @@ if conda_env_path:
     os.environ["PROJ_DATA"] = proj_data_path
 
 
-def add_file(file, local_tiff, local_tiff_cropped, local_metadata, remote_tiff, geometry):
+def add_file(file, local_tiff, local_tiff_cropped, local_metadata, remote_tiff, geometry, options=None):
+    """
+    Crops the lakes out of a new file and adds its statistics to the lake metadata.
+    options are passed on to extract_tiff_subsection, "output_profile" may be a dict of profiles per
+    parameter as returned by parse_output_profiles, and "sharded_metadata" selects the year sharded metadata
+    layout (see add_metadata_entry) and "timeseries" also maintains the columnar time series (see update_timeseries).
+
+    Returns the files written for every lake, {lake: {"crops": [paths], "metadata": [paths]}}, e.g. to upload
+    them (see uploader.BackgroundUploader).
+    """
     print("Adding: {}".format(file))
-    properties = properties_from_filename(file)
-    metadata = extract_tiff_subsection(os.path.join(local_tiff, file), local_tiff_cropped, geometry)
+    options, sharded, timeseries = _file_options(file, options)
+    metadata = extract_tiff_subsection(os.path.join(local_tiff, file), local_tiff_cropped, geometry, **options)
+    instrumentation.count("files_added")
+    outputs = {}
     for lake in metadata.keys():
-        metadata_file_path = os.path.join(lake, properties["parameter"])
-        lake_metadata_file = os.path.join(local_metadata, metadata_file_path + ".json")
-        if os.path.isfile(lake_metadata_file):
-            with open(lake_metadata_file, 'r') as f:
-                lake_metadata = json.load(f)
-        else:
-            lake_metadata = []
-        lake_metadata = [l for l in lake_metadata if l["k"] != metadata[lake]["file"]]
-        lake_metadata.append({"dt": properties["date"],
-                              "k": metadata[lake]["file"],
-                              "p": metadata[lake]["pixels"],
-                              "vp": metadata[lake]["valid_pixels"],
-                              "min": metadata[lake]["min"],
-                              "max": metadata[lake]["max"],
-                              "mean": metadata[lake]["mean"],
-                              "p10": metadata[lake]["p10"],
-                              "p90": metadata[lake]["p90"],
-                              "c": metadata[lake]["commit"],
-                              "r": metadata[lake]["reproduce"]
-                              })
-        os.makedirs(os.path.dirname(lake_metadata_file), exist_ok=True)
-        with open(lake_metadata_file, 'w') as f:
-            json.dump(lake_metadata, f, separators=(',', ':'))
-
-        public_metadata_file = os.path.join(local_metadata, metadata_file_path + "_public.json")
-        if os.path.isfile(public_metadata_file):
-            with open(public_metadata_file, 'r') as f:
-                public_metadata = json.load(f)
-            public_metadata = [l for l in public_metadata if l["name"] != metadata[lake]["file"]]
-        else:
-            public_metadata = []
-        public_metadata.append({
+        outputs[lake] = _add_lake_metadata(file, file, lake, metadata[lake], local_tiff_cropped, local_metadata,
+                                           remote_tiff, sharded, timeseries)
+    return outputs
+
+
+def _file_options(file, options):
+    """Splits the add_file options into extract_tiff_subsection options, sharded and timeseries."""
+    options = dict(options or {})
+    sharded = options.pop("sharded_metadata", False)
+    timeseries = options.pop("timeseries", False)
+    if isinstance(options.get("output_profile"), dict):
+        options["output_profile"] = select_output_profile(options["output_profile"],
+                                                          properties_from_filename(file)["parameter"])
+    return options, sharded, timeseries
+
+
+def _add_lake_metadata(file, source, lake, result, local_tiff_cropped, local_metadata, remote_tiff, sharded=False,
+                       timeseries=False, replaced=()):
+    """
+    Adds the statistics of a lake (as returned by extract_tiff_subsection) to its metadata as the entries of file,
+    with the public URL of the scene source. The entries of the files in replaced are removed. Returns the written
+    files, {"crops": [paths], "metadata": [paths]}.
+    """
+    properties = properties_from_filename(file)
+    with instrumentation.stage("metadata_io", file=os.path.basename(file), lake=lake):
+        record = {"dt": properties["date"],
+                  "k": result["file"],
+                  "p": result["pixels"],
+                  "vp": result["valid_pixels"],
+                  "min": result["min"],
+                  "max": result["max"],
+                  "mean": result["mean"],
+                  "p10": result["p10"],
+                  "p90": result["p90"],
+                  "c": result["commit"],
+                  "r": result["reproduce"]
+                  }
+        public_record = {
             "datetime": properties["date"],
             "name": os.path.basename(file),
-            "url": uri_to_url(os.path.join(remote_tiff, file)),
-            "valid_pixels": "{}%".format(
-                round(float(metadata[lake]["valid_pixels"]) / float(metadata[lake]["pixels"]) * 100))
-        })
-        with open(public_metadata_file, 'w') as f:
-            json.dump(public_metadata, f, separators=(',', ':'))
-
-        filtered = [d for d in lake_metadata if d['vp'] / d['p'] > 0.1]
+            "url": uri_to_url(os.path.join(remote_tiff, source)),
+            "valid_pixels": "{}%".format(round(float(result["valid_pixels"]) / float(result["pixels"]) * 100))
+        }
+        with metadata_lock(local_metadata, lake, properties["parameter"]):
+            for replaced_file in replaced:
+                _remove_lake_entries(replaced_file, properties_from_filename(replaced_file), local_metadata, lake,
+                                     sharded, timeseries)
+            written = add_metadata_entry(local_metadata, lake, properties["parameter"], file, record,
+                                         public_record, sharded=sharded)
+            if timeseries:
+                written.append(update_timeseries(local_metadata, lake, properties["parameter"], file, record))
+    crops = [os.path.join(local_tiff_cropped, lake, f) for f in crop_file_names(file, lake)]
+    return {"crops": [f for f in crops if os.path.isfile(f)], "metadata": written}
+
+
+def acquisition_name(file):
+    """
+    Name of the acquisition of a file, the file name without its tile (see properties_from_filename). Tiles of the
+    same processor, parameter, satellite and date share it.
+    """
+    properties = properties_from_filename(file)
+    if properties["tile"] is None:
+        return os.path.basename(file)
+    return "{}_{}_{}_{}{}".format(properties["processor"], properties["parameter"], properties["satellite"],
+                                  properties["date"], os.path.splitext(file)[1])
+
+
+def group_tiles(files, local_tiff):
+    """
+    Groups files by acquisition (see acquisition_name), completing every group with the other tiles of the
+    acquisition in local_tiff. Returns one sorted list of paths relative to local_tiff per acquisition, in the
+    order in which the acquisitions first appear in files.
+    """
+    acquisitions = {}
+    for file in files:
+        acquisitions.setdefault(acquisition_name(file), set())
+    for root, dirs, names in os.walk(local_tiff):
+        for name in names:
+            if name.endswith(".tif") and acquisition_name(name) in acquisitions:
+                acquisitions[acquisition_name(name)].add(os.path.relpath(os.path.join(root, name), local_tiff))
+    return [sorted(tiles) for tiles in acquisitions.values() if len(tiles) > 0]
+
+
+def add_tiles(files, local_tiff, local_tiff_cropped, local_metadata, remote_tiff, geometry, options=None):
+    """
+    Adds the tiles of one acquisition (see group_tiles) as a single scene: every lake gets one crop and one
+    metadata record named after the acquisition (see acquisition_name) instead of one per tile. Lakes covered by
+    several tiles are mosaicked on the grid of the tile with the most valid pixels in the lake, the other tiles
+    only filling its invalid pixels (see mosaic_crops). Earlier entries and crops of the individual tiles are
+    replaced, and the public URL points to the tile with the most valid pixels.
+
+    The crops of every tile are kept in a temporary folder until the lake is mosaicked, so only one lake is held
+    in memory at a time. Low resolution files from scene overviews (lowres_overviews) are not supported.
+
+    Parameters and return value as for add_file, files being the tiles relative to local_tiff.
+    """
+    acquisition = acquisition_name(files[0])
+    if len(files) == 1 and acquisition == os.path.basename(files[0]):
+        return add_file(files[0], local_tiff, local_tiff_cropped, local_metadata, remote_tiff, geometry, options)
+    from osgeo import gdal
+    print("Adding {} tiles as: {}".format(len(files), acquisition))
+    options, sharded, timeseries = _file_options(acquisition, options)
+    if options.get("lowres_overviews"):
+        raise ValueError("Low resolution files from overviews are not supported for mosaicked tiles")
+    profile = parse_output_profile(options.get("output_profile", "deflate"))
+    catalogue = lake_catalogue(geometry)
+    temp_dir = tempfile.mkdtemp(prefix="tiles_")
+    try:
+        crops = {}
+        for file in sorted(files):
+            raster = gdal.Open(os.path.join(local_tiff, file))
+            for key, pixels, lake_statistics, out_dataset in lake_crops(
+                    raster, local_tiff_cropped, catalogue, os.path.basename(file), options.get("memory_budget", False),
+                    options.get("statistics", "exact"), options.get("sketch_accuracy", 0.001),
+                    options.get("access", "read")):
+                path = os.path.join(temp_dir, "{}_{}".format(key, os.path.basename(file)))
+                gdal.GetDriverByName("GTiff").CreateCopy(path, out_dataset, options=["TILED=YES"])
+                crops.setdefault(key, []).append((lake_statistics.count, file,
+                                                  _crop_result(pixels, lake_statistics, out_dataset), path))
+            raster = None
+            instrumentation.count("files_added")
+            if options.get("cube"):
+                remove_from_cube(options["cube"], file)
+
+        outputs = {}
+        for key in sorted(crops.keys()):
+            tiles = sorted(crops.pop(key), key=lambda t: (t[0], t[1]))  # Most valid pixels last
+            count, source, result, path = tiles[-1]
+            if len(tiles) > 1:
+                print("  Mosaicking lake {} from {} tiles".format(key, len(tiles)))
+                with instrumentation.stage("mosaic", file=acquisition, lake=key):
+                    path = os.path.join(temp_dir, "{}_{}".format(key, acquisition))
+                    mosaic_crops([gdal.Open(t[3]) for t in tiles], path)
+                    result = crop_metadata(path, key, catalogue, options.get("statistics", "exact"),
+                                           options.get("sketch_accuracy", 0.001))
+                instrumentation.count("lakes_mosaicked")
+            else:
+                print("  Extracting lake {}".format(key))
+            out_dataset = gdal.Open(path)
+            result["file"] = _write_lake(out_dataset, local_tiff_cropped, acquisition, key,
+                                         options.get("small_view", 500), profile, options.get("cog", False),
+                                         options.get("cube", False))
+            out_dataset = None
+            for t in tiles:
+                os.remove(t[3])
+            tiles = None
+            for file in files:
+                for crop in crop_file_names(file, key):
+                    if os.path.isfile(os.path.join(local_tiff_cropped, key, crop)):
+                        os.remove(os.path.join(local_tiff_cropped, key, crop))
+            outputs[key] = _add_lake_metadata(acquisition, source, key, result, local_tiff_cropped, local_metadata,
+                                              remote_tiff, sharded, timeseries, replaced=files)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return outputs
+
+
+def mosaic_crops(datasets, path):
+    """
+    Mosaics float32 lake crops (NaN as nodata) of several tiles into a GeoTiff at path, on the pixel grid of the last
+    crop extended to cover all of them. Crops are drawn in order (nearest neighbour), so where several have valid
+    pixels the last one is kept and the others only fill its invalid pixels. The metadata of the last crop is kept.
+    """
+    import numpy as np
+    from osgeo import gdal, osr
+    target = datasets[-1]
+    x0, x_res, _, y0, _, y_res = target.GetGeoTransform()
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(target.GetProjection())
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    xs, ys = [], []
+    for dataset in datasets:
+        geotransform = dataset.GetGeoTransform()
+        corners = [(geotransform[0] + i * dataset.RasterXSize * geotransform[1],
+                    geotransform[3] + j * dataset.RasterYSize * geotransform[5]) for i in (0, 1) for j in (0, 1)]
+        source = osr.SpatialReference()
+        source.ImportFromWkt(dataset.GetProjection())
+        source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        if not source.IsSame(srs):
+            transform = osr.CoordinateTransformation(source, srs)
+            corners = [transform.TransformPoint(x, y)[:2] for x, y in corners]
+        xs.extend(x for x, y in corners)
+        ys.extend(y for x, y in corners)
+    # Rounded before snapping so crops already on the grid do not gain a column through floating point error
+    min_x = x0 + np.floor(round((min(xs) - x0) / x_res, 6)) * x_res
+    max_x = x0 + np.ceil(round((max(xs) - x0) / x_res, 6)) * x_res
+    max_y = y0 + np.floor(round((max(ys) - y0) / y_res, 6)) * y_res
+    min_y = y0 + np.ceil(round((min(ys) - y0) / y_res, 6)) * y_res
+    mosaic = gdal.Warp(path, list(datasets), format="GTiff", dstSRS=target.GetProjection(),
+                       outputBounds=(min_x, min_y, max_x, max_y), xRes=x_res, yRes=abs(y_res),
+                       srcNodata=np.nan, dstNodata=np.nan, outputType=gdal.GDT_Float32,
+                       resampleAlg=gdal.GRA_NearestNeighbour)
+    mosaic.SetMetadata(target.GetMetadata())
+    mosaic = None
+
+
+def remove_file(file, local_metadata, sharded=False, timeseries=False, cube=False):
+    print("Removing: {}".format(file))
+    instrumentation.count("files_removed")
+    properties = properties_from_filename(file)
+    with instrumentation.stage("metadata_io", file=os.path.basename(file)):
+        _remove_file(file, properties, local_metadata, sharded, timeseries)
+    if cube:
+        with instrumentation.stage("cube", file=os.path.basename(file)):
+            remove_from_cube(cube, file)
+
+
+def _remove_file(file, properties, local_metadata, sharded=False, timeseries=False):
+    for lake in os.listdir(local_metadata):
+        base = os.path.join(local_metadata, lake, properties["parameter"])
+        if not os.path.isfile(base + ".json") and not os.path.isdir(base):
+            continue
+        with metadata_lock(local_metadata, lake, properties["parameter"]):
+            _remove_lake_entries(file, properties, local_metadata, lake, sharded, timeseries)
+
+
+def _remove_lake_entries(file, properties, local_metadata, lake, sharded=False, timeseries=False):
+    base = os.path.join(local_metadata, lake, properties["parameter"])
+    if timeseries:
+        update_timeseries(local_metadata, lake, properties["parameter"], file)
+    if sharded:
+        shard_metadata(base)
+    if os.path.isfile(base + ".json"):
+        records_file, public_file = base + ".json", base + "_public.json"
+        if _remove_entries(file, records_file, public_file) and not os.path.isfile(shard_index_path(base)):
+            latest = get_latest([d for d in read_json(records_file, []) if d['vp'] / d['p'] > 0.1])
+            print("   Deleting from: {}".format(base + "_latest.json"))
+            write_json(base + "_latest.json", latest)
+    if os.path.isfile(shard_index_path(base)):
+        records_file, public_file = shard_paths(base, properties["date"])
+        if _remove_entries(file, records_file, public_file):
+            latest = update_shard_index(base, properties["date"], read_json(records_file, []))
+            print("   Deleting from: {}".format(base + "_latest.json"))
+            write_json(base + "_latest.json", latest)
+
+
+def _remove_entries(file, records_file, public_file):
+    """Removes the entries of file from a records and a public document, returns True if records were removed."""
+    stem = os.path.splitext(os.path.basename(file))[0]
+    removed = False
+    records = read_json(records_file, None)
+    if records is not None and len([i for i in records if stem in i["k"]]) > 0:
+        print("   Deleting from: {}".format(records_file))
+        write_json(records_file, [i for i in records if stem not in i["k"]])
+        removed = True
+    public = read_json(public_file, None)
+    if public is not None and len([i for i in public if i["name"] == os.path.basename(file)]) > 0:
+        print("   Deleting from: {}".format(public_file))
+        write_json(public_file, [i for i in public if i["name"] != os.path.basename(file)])
+    return removed
+
+
+_documents = None
+_document_bytes = 0
+_document_cache = 0
+
+
+def cache_documents(size=64):
+    """
+    Keeps parsed metadata documents in memory between reads (used by the daemon), so only documents changed
+    by another process (detected by modification time and size) are parsed again.
+
+    Parameters:
+        size (float): MB of documents, counted by their size on disk, kept before the least recently used are
+            dropped. 0 or False disables the cache.
+    """
+    global _documents, _document_bytes, _document_cache
+    _documents = OrderedDict() if size else None
+    _document_bytes = 0
+    _document_cache = size
+
+
+def _document_stat(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _cache_document(path, data):
+    global _document_bytes
+    if path in _documents:
+        _document_bytes -= _documents.pop(path)[0][1]
+    stat = _document_stat(path)
+    _documents[path] = (stat, data)
+    _document_bytes += stat[1]
+    while _document_bytes > _document_cache * 1024 * 1024 and len(_documents) > 0:
+        _document_bytes -= _documents.popitem(last=False)[1][0][1]
+
+
+def read_json(path, default):
+    """
+    Parsed JSON document at path, default if it does not exist. With cache_documents the returned object is
+    shared with the cache, so callers build new objects instead of modifying it.
+    """
+    if not os.path.isfile(path):
+        return default
+    if _documents is not None and path in _documents and _documents[path][0] == _document_stat(path):
+        _documents.move_to_end(path)
+        return _documents[path][1]
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if _documents is not None:
+        _cache_document(path, data)
+    return data
+
+
+def write_json(path, data):
+    """Writes data as compact JSON, atomically replacing path so readers never see a partial document."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_file = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_file, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(temp_file, path)
+    if _documents is not None:
+        _cache_document(path, data)
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive advisory lock (flock) on path, held for the duration of the context. Processes and containers using
+    the same volume wait for each other.
+    """
+    import fcntl
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def metadata_lock(local_metadata, lake, parameter):
+    """
+    Lock of the metadata documents of a lake parameter (<lake>/<parameter>.lock), to be held around every
+    read-modify-write so several instances can process disjoint sets of files on the same metadata folder.
+    """
+    return file_lock(os.path.join(local_metadata, lake, parameter + ".lock"))
+
+
+def add_metadata_entry(local_metadata, lake, parameter, file, record, public_record, sharded=False):
+    """
+    Adds the record and public record of a file to the metadata of a lake parameter, replacing earlier
+    entries of the same file, and updates <parameter>_latest.json. Returns the paths of the written documents.
+
+    With sharded the entries go to the year documents of the sharded layout (see shard_paths), so only
+    the current year is rewritten. An existing legacy <parameter>.json is split into shards first.
+    Callers hold metadata_lock.
+    """
+    base = os.path.join(local_metadata, lake, parameter)
+    if sharded:
+        shard_metadata(base)
+        records_file, public_file = shard_paths(base, record["dt"])
+    else:
+        records_file, public_file = base + ".json", base + "_public.json"
+
+    records = [l for l in read_json(records_file, []) if l["k"] not in crop_file_names(file, lake)]
+    records.append(record)
+    write_json(records_file, records)
+
+    public = [l for l in read_json(public_file, []) if l["name"] != public_record["name"]]
+    public.append(public_record)
+    write_json(public_file, public)
+
+    if sharded:
+        latest = update_shard_index(base, record["dt"], records)
+    else:
+        filtered = [d for d in records if d['vp'] / d['p'] > 0.1]
         if len(filtered) > 0:
             latest = get_latest(filtered)
         else:
             latest = {}
-        with open(os.path.join(local_metadata, metadata_file_path + "_latest.json"), 'w') as f:
-            json.dump(latest, f, separators=(',', ':'))
+    write_json(base + "_latest.json", latest)
+    written = [records_file, public_file, base + "_latest.json"]
+    if sharded:
+        written.append(shard_index_path(base))
+    return written
 
 
-def remove_file(file, local_metadata):
-    print("Removing: {}".format(file))
-    properties = properties_from_filename(file)
+def shard_paths(base, date):
+    """
+    Records and public document of the year of date in the sharded layout of a lake parameter:
+
+        <lake>/<parameter>/<YYYY>.json
+        <lake>/<parameter>/<YYYY>_public.json
+        <lake>/<parameter>/index.json          shards with their record count and date range, latest entry
+        <lake>/<parameter>_latest.json         unchanged
+    """
+    return os.path.join(base, date[:4] + ".json"), os.path.join(base, date[:4] + "_public.json")
+
+
+def shard_index_path(base):
+    return os.path.join(base, "index.json")
+
+
+def update_shard_index(base, date, records):
+    """
+    Updates the index entry of the year of date from its (already loaded) records and returns the latest
+    entry. Only the newest year with an entry above the valid pixel threshold is read, as get_latest only
+    compares scenes of the newest day.
+    """
+    year = date[:4]
+    shards = dict(read_json(shard_index_path(base), {"shards": {}})["shards"])
+    shards[year] = _shard_entry(records)
+    latest = {}
+    for shard in sorted(shards.keys(), reverse=True):
+        shard_records = records if shard == year else read_json(shard_paths(base, shard)[0], [])
+        filtered = [d for d in shard_records if d['vp'] / d['p'] > 0.1]
+        if len(filtered) > 0:
+            latest = get_latest(filtered)
+            break
+    write_json(shard_index_path(base), {"shards": shards, "latest": latest})
+    return latest
+
+
+def _shard_entry(records):
+    return {"records": len(records),
+            "first": min([r["dt"] for r in records], default=None),
+            "last": max([r["dt"] for r in records], default=None)}
+
+
+def shard_metadata(base):
+    """Splits the legacy documents of a lake parameter into year shards, unless it is already sharded."""
+    if os.path.isfile(shard_index_path(base)) or not os.path.isfile(base + ".json"):
+        return
+    print("   Sharding metadata: {}".format(base + ".json"))
+    write_metadata_documents(base, read_json(base + ".json", []), read_json(base + "_public.json", []), sharded=True)
+
+
+def write_metadata_documents(base, records, public, sharded=False):
+    """
+    Writes the complete records and public documents of a lake parameter, in the legacy or the sharded layout
+    (see shard_paths), and its latest entry.
+    """
+    filtered = [d for d in records if d['vp'] / d['p'] > 0.1]
+    latest = get_latest(filtered) if len(filtered) > 0 else {}
+    if sharded:
+        years = {}
+        for r in records:
+            years.setdefault(r["dt"][:4], ([], []))[0].append(r)
+        for r in public:
+            years.setdefault(r["datetime"][:4], ([], []))[1].append(r)
+        index = {"shards": {}, "latest": latest}
+        for year, (year_records, year_public) in sorted(years.items()):
+            records_file, public_file = shard_paths(base, year)
+            write_json(records_file, year_records)
+            write_json(public_file, year_public)
+            index["shards"][year] = _shard_entry(year_records)
+        write_json(shard_index_path(base), index)
+        # Otherwise left stale next to the shards, written again by write_legacy_metadata if still wanted
+        _remove_legacy_views(base)
+    else:
+        write_json(base + ".json", records)
+        write_json(base + "_public.json", public)
+    write_json(base + "_latest.json", latest)
+
+
+def lake_records(base):
+    """All records of a lake parameter, from the year shards if it is sharded."""
+    index = read_json(shard_index_path(base), None)
+    if index is None:
+        return read_json(base + ".json", [])
+    records = []
+    for year in sorted(index["shards"].keys()):
+        records.extend(read_json(shard_paths(base, year)[0], []))
+    return records
+
+
+def lake_public(base):
+    """All public records of a lake parameter, from the year shards if it is sharded."""
+    index = read_json(shard_index_path(base), None)
+    if index is None:
+        return read_json(base + "_public.json", [])
+    public = []
+    for year in sorted(index["shards"].keys()):
+        public.extend(read_json(shard_paths(base, year)[1], []))
+    return public
+
+
+def update_timeseries(local_metadata, lake, parameter, file, record=None):
+    """
+    Updates the columnar time series of a lake parameter (<lake>/<parameter>_timeseries.npz, see timeseries.py)
+    after the metadata records were updated: the entries of file are dropped and record, if given, is added.
+    A missing time series is built from all existing records. Returns the path of the time series if it was written.
+    """
+    import numpy as np
+    import timeseries
+    base = os.path.join(local_metadata, lake, parameter)
+    path = base + "_timeseries.npz"
+    if os.path.isfile(path):
+        columns = timeseries.load(path)
+        if record is not None:
+            columns = timeseries.drop(columns, np.isin(columns["k"], crop_file_names(file, lake)))
+            columns = timeseries.append(columns, [record])
+        else:
+            stem = os.path.splitext(os.path.basename(file))[0]
+            remove = np.char.find(columns["k"], stem) >= 0
+            if not remove.any():
+                return None
+            columns = timeseries.drop(columns, remove)
+    elif record is not None:
+        columns = timeseries.from_records(lake_records(base))
+    else:
+        return None
+    timeseries.save(path, columns)
+    return path
+
+
+def write_legacy_metadata(local_metadata):
+    """
+    Writes the legacy single file views (<parameter>.json and <parameter>_public.json) of all sharded lake
+    parameters for existing consumers. Views are only rebuilt when the shard index changed since they were
+    written.
+    """
+    for lake, parameter, base in _sharded_parameters(local_metadata):
+        index_file = shard_index_path(base)
+        if os.path.isfile(base + ".json") and os.path.getmtime(base + ".json") >= os.path.getmtime(index_file):
+            continue
+        with metadata_lock(local_metadata, lake, parameter):
+            write_json(base + "_public.json", lake_public(base))
+            write_json(base + ".json", lake_records(base))
+
+
+def remove_legacy_metadata(local_metadata):
+    """Removes the legacy single file views of all sharded lake parameters, once they are no longer written."""
+    for lake, parameter, base in _sharded_parameters(local_metadata):
+        if os.path.isfile(base + ".json") or os.path.isfile(base + "_public.json"):
+            with metadata_lock(local_metadata, lake, parameter):
+                _remove_legacy_views(base)
+
+
+def _sharded_parameters(local_metadata):
+    """(lake, parameter, base) of every lake parameter in the sharded layout."""
     for lake in os.listdir(local_metadata):
-        metadata_file_path = os.path.join(local_metadata, lake, properties["parameter"])
-        meta_file = metadata_file_path + ".json"
-        public_file = metadata_file_path + "_public.json"
-        if os.path.isfile(meta_file):
-            with open(meta_file, 'r') as f:
-                meta = json.load(f)
-            if len([i for i in meta if os.path.splitext(os.path.basename(file))[0] in i["k"]]) > 0:
-                meta = [i for i in meta if os.path.splitext(os.path.basename(file))[0] not in i["k"]]
-                latest = get_latest([d for d in meta if d['vp'] / d['p'] > 0.1])
-                with open(metadata_file_path + "_latest.json", 'w') as f:
-                    print("   Deleting from: {}".format(metadata_file_path + "_latest.json"))
-                    json.dump(latest, f, separators=(',', ':'))
-                with open(meta_file, 'w') as f:
-                    print("   Deleting from: {}".format(meta_file))
-                    json.dump(meta, f, separators=(',', ':'))
-        if os.path.isfile(public_file):
-            with open(public_file, 'r') as f:
-                public = json.load(f)
-            if len([i for i in public if i["name"] == os.path.basename(file)]) > 0:
-                public = [i for i in public if i["name"] != os.path.basename(file)]
-                with open(public_file, 'w') as f:
-                    print("   Deleting from: {}".format(public_file))
-                    json.dump(public, f, separators=(',', ':'))
+        lake_dir = os.path.join(local_metadata, lake)
+        if not os.path.isdir(lake_dir):
+            continue
+        for parameter in os.listdir(lake_dir):
+            base = os.path.join(lake_dir, parameter)
+            if os.path.isfile(shard_index_path(base)):
+                yield lake, parameter, base
+
+
+def _remove_legacy_views(base):
+    for path in (base + ".json", base + "_public.json"):
+        if os.path.isfile(path):
+            print("   Removing legacy view: {}".format(path))
+            os.remove(path)
+
+
+def lake_parameters(lake_dir):
+    """Parameters with metadata in a lake folder, either as <parameter>.json or as a sharded folder."""
+    parameters = set()
+    for f in os.listdir(lake_dir):
+        if os.path.isdir(os.path.join(lake_dir, f)):
+            if os.path.isfile(shard_index_path(os.path.join(lake_dir, f))):
+                parameters.add(f)
+        elif f.endswith(".json") and not f.endswith("_latest.json") and not f.endswith("_public.json"):
+            parameters.add(f[:-len(".json")])
+    return sorted(parameters)
+
+
+def shard_of(name, count):
+    """Shard (0 to count - 1) of a file or lake name, stable across runs, machines and Python versions."""
+    import zlib
+    return zlib.crc32(os.path.basename(name).encode("utf-8")) % count
+
+
+def merge_shards(shard_dir, local_tiff_cropped, local_metadata, sharded=False, timeseries=False):
+    """
+    Merges the outputs of shard runs (reprocess with --shard, one <shard_dir>/<i>-of-<N> folder per shard with
+    tiff_cropped and metadata) into the canonical folders. Crops are moved into local_tiff_cropped. The entries of
+    every lake parameter replace the canonical entries of the same scenes and the documents are rewritten sorted
+    by date with a recomputed latest entry, so the result does not depend on the number of shards or on the
+    order in which they finished. Canonical crops with the same content hash as the shard crop are kept (see
+    merge_crop), so a sharded reprocess only uploads the crops that changed.
+
+    Parameters:
+    - shard_dir (str): Folder of the shard outputs
+    - local_tiff_cropped (str): Canonical cropped file folder
+    - local_metadata (str): Canonical metadata folder
+    - sharded, timeseries: See add_file
+    """
+    documents = {}
+    for shard in sorted(os.listdir(shard_dir)):
+        crops_dir = os.path.join(shard_dir, shard, "tiff_cropped")
+        for root, dirs, files in os.walk(crops_dir):
+            for f in sorted(files):
+                name, extension = os.path.splitext(f)
+                if name.endswith("_lowres") and name[:-len("_lowres")] + extension in files:
+                    continue
+                merge_crop(root, os.path.join(local_tiff_cropped, os.path.relpath(root, crops_dir)), f)
+        metadata_dir = os.path.join(shard_dir, shard, "metadata")
+        if not os.path.isdir(metadata_dir):
+            continue
+        for lake in sorted(os.listdir(metadata_dir)):
+            lake_dir = os.path.join(metadata_dir, lake)
+            if not os.path.isdir(lake_dir):
+                continue
+            for parameter in lake_parameters(lake_dir):
+                records, public = documents.setdefault((lake, parameter), ({}, {}))
+                records.update((r["k"], r) for r in lake_records(os.path.join(lake_dir, parameter)))
+                public.update((r["name"], r) for r in lake_public(os.path.join(lake_dir, parameter)))
+
+    for (lake, parameter), (records, public) in sorted(documents.items()):
+        base = os.path.join(local_metadata, lake, parameter)
+        with metadata_lock(local_metadata, lake, parameter):
+            replaced = set(records.keys())
+            for name in public:
+                replaced.update(crop_file_names(name, lake))
+            merged = [r for r in lake_records(base) if r["k"] not in replaced] + list(records.values())
+            merged_public = [r for r in lake_public(base) if r["name"] not in public] + list(public.values())
+            merged.sort(key=lambda r: (r["dt"], r["k"]))
+            merged_public.sort(key=lambda r: (r["datetime"], r["name"]))
+            write_metadata_documents(base, merged, merged_public, sharded)
+            if timeseries:
+                import timeseries as ts
+                ts.save(base + "_timeseries.npz", ts.from_records(merged))
+        print("   Merged {} {} ({} entries)".format(lake, parameter, len(records)))
+        instrumentation.count("parameters_merged")
+
+
+def merge_crop(source_dir, target_dir, file):
+    """
+    Moves the crop file and its low resolution version from source_dir to target_dir. If the crop in target_dir
+    has the same content hash (see write_lake_tiff), the files in target_dir are kept untouched instead. A low
+    resolution version left in target_dir without one in source_dir is removed.
+    """
+    name, extension = os.path.splitext(file)
+    lowres_file = name + "_lowres" + extension
+    source, target = os.path.join(source_dir, file), os.path.join(target_dir, file)
+    if os.path.isfile(target) and extension == ".tif":
+        digest = stored_content_hash(source)
+        if digest is not None and stored_content_hash(target) == digest:
+            os.remove(source)
+            if os.path.isfile(os.path.join(source_dir, lowres_file)):
+                os.remove(os.path.join(source_dir, lowres_file))
+            instrumentation.count("crops_unchanged")
+            return
+    os.makedirs(target_dir, exist_ok=True)
+    shutil.move(source, target)
+    if os.path.isfile(os.path.join(source_dir, lowres_file)):
+        shutil.move(os.path.join(source_dir, lowres_file), os.path.join(target_dir, lowres_file))
+    elif os.path.isfile(os.path.join(target_dir, lowres_file)):
+        os.remove(os.path.join(target_dir, lowres_file))
+
+
+def rebuild_metadata(local_tiff_cropped, local_metadata, local_tiff, remote_tiff, geojson, workers=None,
+                     statistics="exact", sketch_accuracy=0.001, sharded=False, timeseries=False):
+    """
+    Rebuilds the metadata of every lake from its cropped files instead of the raw scenes, e.g. after a change
+    of the metadata format, rounding, public URLs or the latest entry rule. The documents of every lake parameter
+    with crops are replaced, lakes are processed in parallel by a pool of workers.
+
+    Statistics are computed from the crop values (identical for lossless output profiles, within the encoding
+    error for int16 and lerc), the lake pixel count by rasterizing the lake on the crop grid, and "Commit Hash"
+    and "Reproduce" are read from the crop (crops written before these tags keep the "c" and "r" of their existing
+    record). Public URLs point to the scene path found in local_tiff, or keep the URL of the existing public entry
+    if the scene is no longer there (the file name if there is none).
+
+    Parameters:
+    - local_tiff_cropped (str): Folder of the cropped files, <lake>/<name>_<lake>.tif
+    - local_metadata (str): Metadata folder
+    - local_tiff (str): Local scene folder, only used to resolve scene paths
+    - remote_tiff (str): URI of the remote scene folder
+    - geojson (dict): Lake polygons as a GeoJSON FeatureCollection with a "key" property
+    - workers (int): Number of worker processes (default: number of CPUs)
+    - statistics, sketch_accuracy: See extract_tiff_subsection
+    - sharded, timeseries: See add_file
+    """
+    from multiprocessing import Pool
+    scenes = {}
+    for root, dirs, files in os.walk(local_tiff):
+        for f in files:
+            if f.endswith(".tif"):
+                scenes[f] = os.path.relpath(os.path.join(root, f), local_tiff)
+    features = {f["properties"]["key"]: f for f in geojson["features"]}
+    options = {"statistics": statistics, "sketch_accuracy": sketch_accuracy, "sharded": sharded,
+               "timeseries": timeseries}
+    tasks = []
+    for lake in sorted(os.listdir(local_tiff_cropped)):
+        if not os.path.isdir(os.path.join(local_tiff_cropped, lake)):
+            continue
+        if lake not in features:
+            print("   No geometry for {}, skipping".format(lake))
+            continue
+        tasks.append((lake, os.path.join(local_tiff_cropped, lake), features[lake], local_metadata, remote_tiff,
+                      scenes, options))
+    with Pool(workers) as pool:
+        for lake, count in pool.imap_unordered(_rebuild_lake, tasks):
+            print("   Rebuilt {} ({} files)".format(lake, count))
+            instrumentation.count("lakes_rebuilt")
+            instrumentation.count("files_rebuilt", count)
+
+
+def _rebuild_lake(task):
+    """Worker of rebuild_metadata, rebuilds and writes the metadata of one lake."""
+    lake, lake_dir, feature, local_metadata, remote_tiff, scenes, options = task
+    from catalogue import LakeCatalogue
+    catalogue = LakeCatalogue({"type": "FeatureCollection", "features": [feature]})
+    documents = {}
+    existing = {}
+    count = 0
+    for crop in sorted(os.listdir(lake_dir)):
+        name, extension = os.path.splitext(crop)
+        if extension != ".tif" or not name.endswith("_" + lake):
+            continue
+        file = name[:-len("_" + lake)] + extension
+        result = crop_metadata(os.path.join(lake_dir, crop), lake, catalogue, options["statistics"],
+                               options["sketch_accuracy"])
+        if result is None:
+            continue
+        lowres_file = crop_file_names(file, lake)[1]
+        properties = properties_from_filename(file)
+        if properties["parameter"] not in existing:
+            base = os.path.join(local_metadata, lake, properties["parameter"])
+            existing[properties["parameter"]] = ({r["k"]: r for r in lake_records(base)},
+                                                 {r["name"]: r for r in lake_public(base)})
+        previous_records, previous_public = existing[properties["parameter"]]
+        previous = next((previous_records[k] for k in crop_file_names(file, lake) if k in previous_records), {})
+        if file in scenes:
+            url = uri_to_url(os.path.join(remote_tiff, scenes[file]))
+        elif file in previous_public:
+            url = previous_public[file]["url"]
+        else:
+            url = uri_to_url(os.path.join(remote_tiff, file))
+        record = {"dt": properties["date"],
+                  "k": lowres_file if os.path.isfile(os.path.join(lake_dir, lowres_file)) else crop,
+                  "p": result["pixels"],
+                  "vp": result["valid_pixels"],
+                  "min": result["min"],
+                  "max": result["max"],
+                  "mean": result["mean"],
+                  "p10": result["p10"],
+                  "p90": result["p90"],
+                  "c": result["commit"] if result["commit"] != "False" else previous.get("c", "False"),
+                  "r": result["reproduce"] if result["reproduce"] != "False" else previous.get("r", "False")
+                  }
+        public_record = {
+            "datetime": properties["date"],
+            "name": file,
+            "url": url,
+            "valid_pixels": "{}%".format(round(float(result["valid_pixels"]) / float(result["pixels"]) * 100))
+        }
+        records, public = documents.setdefault(properties["parameter"], ([], []))
+        records.append(record)
+        public.append(public_record)
+        count += 1
+
+    for parameter, (records, public) in documents.items():
+        base = os.path.join(local_metadata, lake, parameter)
+        records.sort(key=lambda r: r["dt"])
+        public.sort(key=lambda r: r["datetime"])
+        with metadata_lock(local_metadata, lake, parameter):
+            if options["sharded"] and os.path.isdir(base):
+                shutil.rmtree(base)
+            write_metadata_documents(base, records, public, options["sharded"])
+            if options["timeseries"]:
+                import timeseries
+                timeseries.save(base + "_timeseries.npz", timeseries.from_records(records))
+    return lake, count
+
+
+def crop_metadata(path, lake, catalogue, statistics="exact", sketch_accuracy=0.001):
+    """
+    Statistics of a cropped lake file as returned by extract_tiff_subsection (plus "pixels", "commit" and
+    "reproduce"), or None if it has no valid pixels or the lake is not in the catalogue.
+    """
+    import numpy as np
+    from osgeo import gdal
+    from quantiles import LakeStatistics
+    dataset = gdal.Open(path)
+    band = dataset.GetRasterBand(1)
+    values = band.ReadAsArray()
+    nodata = band.GetNoDataValue()
+    scale, offset = band.GetScale(), band.GetOffset()
+    if (scale is not None and scale != 1) or (offset is not None and offset != 0):
+        invalid = values == nodata if nodata is not None else np.zeros(values.shape, dtype=bool)
+        values = values * (scale if scale is not None else 1) + (offset if offset is not None else 0)
+        values[invalid] = np.nan
+    elif nodata is not None and not np.isnan(nodata):
+        values = values.astype(np.float32)
+        values[values == nodata] = np.nan
+
+    lakes = [l for l in catalogue.lakes(dataset.GetProjection()) if l[0] == lake]
+    if len(lakes) == 0:
+        return None
+    lake_statistics = LakeStatistics(statistics, sketch_accuracy)
+    lake_statistics.add(values[~np.isnan(values)])
+    if lake_statistics.count == 0:
+        return None
+    metadata = dataset.GetMetadata()
+    result = {"pixels": np.count_nonzero(catalogue.mask(dataset, lake, lakes[0][1], (0, 0, dataset.RasterXSize, dataset.RasterYSize)) == 1)}
+    result.update(lake_statistics.result())
+    result["commit"] = metadata["Commit Hash"] if "Commit Hash" in metadata else "False"
+    result["reproduce"] = metadata["Reproduce"] if "Reproduce" in metadata else "False"
+    dataset = None
+    return result
 
 
 def download_file(url, save_path):
@@ -104,6 +840,7 @@ def download_file(url, save_path):
         url (str): The URL of the file to download.
         save_path (str): The local path where the file should be saved.
     """
+    import requests
     response = requests.get(url)
     if response.status_code == 200:
         with open(save_path, "wb") as file:
@@ -114,20 +851,35 @@ def download_file(url, save_path):
 
 
 def metadata_summary(uri, name, folder):
+    metadata_summaries(uri, {name: folder})
+
+
+def metadata_summaries(uri, products):
+    """
+    Updates the remote metadata summary (lake -> product name -> parameters) for several products at once,
+    fetching and uploading the summary a single time.
+
+    Parameters:
+    - uri (str): URI of the remote metadata summary
+    - products (dict): Local metadata folder of every product name
+    """
+    import requests
     edits = False
     try:
         response = requests.get(uri_to_url(uri))
         summary = response.json()
     except Exception as e:
         summary = {}
-    for lake in os.listdir(folder):
-        if lake not in summary:
-            summary[lake] = {}
-        parameters = list(set([f.replace(".json", "") for f in os.listdir(os.path.join(folder, lake)) if "_latest" not in f and "_public" not in f]))
-        parameters.sort()
-        if name not in summary[lake] or parameters != summary[lake][name]:
-            edits = True
-            summary[lake][name] = parameters
+    for name, folder in products.items():
+        for lake in os.listdir(folder):
+            if not os.path.isdir(os.path.join(folder, lake)):
+                continue
+            if lake not in summary:
+                summary[lake] = {}
+            parameters = lake_parameters(os.path.join(folder, lake))
+            if name not in summary[lake] or parameters != summary[lake][name]:
+                edits = True
+                summary[lake][name] = parameters
     if edits:
         print("   Uploading edited metadata file")
         with tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=True) as temp_file:
@@ -140,14 +892,20 @@ def metadata_summary(uri, name, folder):
                 print("Failed to upload summary file")
 
 
-def polygon_raster_mask(raster, geometry):
+def polygon_raster_mask(raster, geometry, window=None):
     """
     Creates a raster mask based on a polygon and a input raster
 
     Parameters:
     - raster (gdal.Dataset): Opened gdal.Dataset file
     - geometry (ogr.Geometry): Polygon as a ogr.Geometry object.
+    - window (tuple): Optional (x_offset, y_offset, x_size, y_size) in pixels, only this part of the raster is rasterized.
     """
+    if window is None:
+        window = (0, 0, raster.RasterXSize, raster.RasterYSize)
+    x_offset, y_offset, x_size, y_size = window
+    geotransform = raster.GetGeoTransform()
+    from osgeo import gdal, ogr, osr
     driver = ogr.GetDriverByName("Memory")
     data_source = driver.CreateDataSource("temp")
     spatial_ref = osr.SpatialReference()
@@ -160,23 +918,27 @@ def polygon_raster_mask(raster, geometry):
     feature.SetField("id", 1)
     layer.CreateFeature(feature)
     mask_driver = gdal.GetDriverByName("MEM")
-    mask_raster = mask_driver.Create("", raster.RasterXSize, raster.RasterYSize, 1, gdal.GDT_Byte)
-    mask_raster.SetGeoTransform(raster.GetGeoTransform())
+    mask_raster = mask_driver.Create("", x_size, y_size, 1, gdal.GDT_Byte)
+    mask_raster.SetGeoTransform((geotransform[0] + x_offset * geotransform[1] + y_offset * geotransform[2], geotransform[1],
+                                 geotransform[2], geotransform[3] + x_offset * geotransform[4] + y_offset * geotransform[5],
+                                 geotransform[4], geotransform[5]))
     mask_raster.SetProjection(raster.GetProjection())
     gdal.RasterizeLayer(mask_raster, [1], layer, burn_values=[1])  # Inside polygon = 1
     mask_geometry = mask_raster.GetRasterBand(1).ReadAsArray()
     return mask_geometry
 
 
-def pixel_coordinates(raster, geometry):
+def pixel_coordinates(raster, geometry, envelope=None):
     """
     Calculates pixel values from raster and geometry
 
     Parameters:
     - raster (gdal.Dataset): Opened gdal.Dataset file
     - geometry (ogr.Geometry): Polygon as a ogr.Geometry object.
+    - envelope (tuple): Optional precomputed envelope (min_x, max_x, min_y, max_y) of geometry
     """
-    min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+    import numpy as np
+    min_x, max_x, min_y, max_y = envelope if envelope is not None else geometry.GetEnvelope()
     geotransform = raster.GetGeoTransform()
     min_x_pixel = int(np.floor((min_x - geotransform[0]) / geotransform[1]))
     max_x_pixel = int(np.ceil((max_x - geotransform[0]) / geotransform[1]))
@@ -194,91 +956,768 @@ def pixel_coordinates(raster, geometry):
     return min_x_pixel, min_y_pixel, max_x_pixel, max_y_pixel, new_min_x, new_min_y
 
 
-def extract_tiff_subsection(input_file, output_dir, geojson, small_view=500):
-    raster = gdal.Open(input_file)
+def lake_windows(raster, geojson):
+    """
+    Returns (key, geometry, window) for every lake overlapping the raster, where geometry is in the coordinate
+    system of the raster and window is (min_x_pixel, min_y_pixel, max_x_pixel, max_y_pixel, min_x, min_y) as
+    returned by pixel_coordinates.
+
+    Parameters:
+    - raster (gdal.Dataset): Opened gdal.Dataset file
+    - geojson (dict or LakeCatalogue): Lake polygons as a GeoJSON FeatureCollection with a "key" property, or a
+      catalogue.LakeCatalogue to reuse transformed geometries across scenes
+    """
+    catalogue = lake_catalogue(geojson)
+    lakes = []
+    for key, polygon_geometry, envelope in catalogue.lakes(raster.GetProjection()):
+        window = pixel_coordinates(raster, polygon_geometry, envelope)
+        min_x_pixel, min_y_pixel, max_x_pixel, max_y_pixel = window[:4]
+
+        if max_x_pixel <= min_x_pixel or max_y_pixel <= min_y_pixel:
+            continue
+
+        lakes.append((key, polygon_geometry, window))
+    return lakes
+
+
+def lake_catalogue(geojson):
+    """Returns geojson if it already is a catalogue.LakeCatalogue, otherwise a new catalogue of its lakes."""
+    from catalogue import LakeCatalogue
+    return geojson if isinstance(geojson, LakeCatalogue) else LakeCatalogue(geojson)
+
+
+def create_lake_tiff(path, raster, window, data_type):
+    """Creates an empty single band GeoTiff covering window (as returned by pixel_coordinates) of raster."""
+    import numpy as np
+    from osgeo import gdal
+    min_x_pixel, min_y_pixel, max_x_pixel, max_y_pixel, min_x, min_y = window
     geotransform = raster.GetGeoTransform()
-    projection = raster.GetProjection()
-    file_metadata = raster.GetMetadata()
+    driver = gdal.GetDriverByName("GTiff")
+    out_dataset = driver.Create(path, max_x_pixel - min_x_pixel, max_y_pixel - min_y_pixel, 1, data_type)
+    out_dataset.SetGeoTransform((min_x, geotransform[1], geotransform[2], min_y, geotransform[4], geotransform[5]))
+    out_dataset.SetProjection(raster.GetProjection())
+    out_dataset.GetRasterBand(1).SetNoDataValue(np.nan)
+    return out_dataset
 
-    if raster.RasterCount == 2:
-        band = raster.GetRasterBand(1).ReadAsArray()
-        mask = raster.GetRasterBand(2).ReadAsArray()
-        band[mask == 1] = np.nan
-    else:
-        band = raster.GetRasterBand(1).ReadAsArray()
 
-    metadata = {}
+# Output encodings of the cropped lake files, see parse_output_profile
+OUTPUT_PROFILES = {
+    "deflate": {"creation_options": ["COMPRESS=DEFLATE"]},
+    "deflate_predictor": {"creation_options": ["COMPRESS=DEFLATE", "PREDICTOR=3"]},
+    "zstd": {"creation_options": ["COMPRESS=ZSTD", "PREDICTOR=3"]},
+    "lerc": {"creation_options": ["COMPRESS=LERC_ZSTD"], "max_error": 0.001},
+    "int16": {"creation_options": ["COMPRESS=DEFLATE", "PREDICTOR=2"], "scale": 0.001, "offset": 0.0}
+}
+INT16_NODATA = -32768
 
-    for lake in geojson["features"]:
-        key = lake["properties"]["key"]
 
-        if lake["geometry"]["coordinates"][0][0] != lake["geometry"]["coordinates"][0][-1]:
-            lake["geometry"]["coordinates"][0].append(lake["geometry"]["coordinates"][0][0])
+def parse_output_profile(spec="deflate"):
+    """
+    Parses an output profile specification into a dict with the GeoTiff creation options.
+
+    - deflate: Float32, DEFLATE (default)
+    - deflate_predictor: Float32, DEFLATE with floating point predictor
+    - zstd: Float32, ZSTD with floating point predictor
+    - lerc:<max_error>: Float32, LERC_ZSTD, lossy within max_error (default 0.001)
+    - int16:<scale>[:<offset>]: Int16 storing round((value - offset) / scale) with scale/offset set on the band
+      and nodata -32768, DEFLATE with horizontal predictor (default scale 0.001, offset 0)
+    """
+    parts = spec.split(":")
+    name = parts[0]
+    if name not in OUTPUT_PROFILES:
+        raise ValueError("Unknown output profile {}, options are {}".format(name, ", ".join(OUTPUT_PROFILES)))
+    profile = dict(OUTPUT_PROFILES[name])
+    profile["name"] = name
+    profile["creation_options"] = list(profile["creation_options"])
+    if name == "lerc":
+        if len(parts) > 1:
+            profile["max_error"] = float(parts[1])
+        profile["creation_options"].append("MAX_Z_ERROR={}".format(profile["max_error"]))
+    elif name == "int16":
+        if len(parts) > 1:
+            profile["scale"] = float(parts[1])
+        if len(parts) > 2:
+            profile["offset"] = float(parts[2])
+    return profile
 
-        polygon_geometry = ogr.CreateGeometryFromJson(json.dumps(lake["geometry"]))
-        min_x_pixel, min_y_pixel, max_x_pixel, max_y_pixel, min_x, min_y = pixel_coordinates(raster, polygon_geometry)
 
-        if max_x_pixel < 0 or max_y_pixel < 0 or min_x_pixel > raster.RasterXSize or min_y_pixel > raster.RasterYSize:
+def parse_output_profiles(spec):
+    """
+    Parses per parameter output profiles, e.g. "ST=int16:0.01,CHL=lerc:0.001,deflate_predictor" where the entry
+    without a parameter is the default. Returns {parameter: spec, "default": spec}.
+    """
+    profiles = {"default": "deflate"}
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if entry == "":
             continue
+        parameter, _, profile = entry.rpartition("=")
+        parse_output_profile(profile)  # Validate
+        profiles[parameter if parameter else "default"] = profile
+    return profiles
 
-        cropped_band = np.copy(band[min_y_pixel:max_y_pixel, min_x_pixel:max_x_pixel])
-        mask_geometry = polygon_raster_mask(raster, polygon_geometry)
-        cropped_band[mask_geometry[min_y_pixel:max_y_pixel, min_x_pixel:max_x_pixel] != 1] = np.nan
 
-        if np.isnan(cropped_band).all():
-            continue
+def select_output_profile(profiles, parameter):
+    return profiles.get(parameter, profiles["default"])
 
-        print("  Extracting lake {}".format(key))
-        os.makedirs(os.path.join(output_dir, key), exist_ok=True)
-        name, extension = os.path.splitext(os.path.basename(input_file))
-        temp_file = os.path.join(output_dir, key,  "{}_temp{}".format(name, extension))
-        main_file = os.path.join(output_dir, key, "{}_{}{}".format(name, key, extension))
-        lowres_file = os.path.join(output_dir, key, "{}_{}_lowres{}".format(name, key, extension))
-
-        metadata[key] = {
-            "pixels": np.count_nonzero(mask_geometry == 1),
-            "valid_pixels": np.count_nonzero(~np.isnan(cropped_band)),
-            "min": np.round(np.nanmin(cropped_band).astype(np.float64),5),
-            "max": np.round(np.nanmax(cropped_band).astype(np.float64),5),
-            "mean": np.round(np.nanmean(cropped_band).astype(np.float64),5),
-            "p10": np.round(np.nanpercentile(cropped_band, 10),5),
-            "p90": np.round(np.nanpercentile(cropped_band, 90),5),
-            "file": os.path.basename(main_file),
-            "commit": file_metadata["Commit Hash"] if "Commit Hash" in file_metadata else "False",
-            "reproduce": file_metadata["Reproduce"] if "Reproduce" in file_metadata else "False"
-        }
 
-        driver = gdal.GetDriverByName("GTiff")
-        out_dataset = driver.Create(temp_file, max_x_pixel - min_x_pixel, max_y_pixel - min_y_pixel, 1, gdal.GDT_Float32)
-        out_geotransform = (min_x, geotransform[1], geotransform[2], min_y, geotransform[4], geotransform[5])
-        out_dataset.SetGeoTransform(out_geotransform)
-        out_dataset.SetProjection(projection)
-        out_band = out_dataset.GetRasterBand(1)
-        out_band.WriteArray(cropped_band)
-        out_band.SetNoDataValue(np.nan)
+def _encode_int16(out_dataset, scale, offset):
+    """Returns an in memory Int16 copy of out_dataset with scale, offset and nodata set."""
+    import numpy as np
+    from osgeo import gdal
+    values = out_dataset.GetRasterBand(1).ReadAsArray()
+    nodata = np.isnan(values)
+    encoded = np.round((values - offset) / scale)
+    clipped = np.count_nonzero((encoded < -32767) | (encoded > 32767))
+    if clipped > 0:
+        print("   Warning: {} pixels outside the Int16 range for scale {} and offset {}".format(clipped, scale, offset))
+    encoded = np.clip(encoded, -32767, 32767)
+    encoded[nodata] = INT16_NODATA
+    dataset = gdal.GetDriverByName("MEM").Create("", out_dataset.RasterXSize, out_dataset.RasterYSize, 1, gdal.GDT_Int16)
+    dataset.SetGeoTransform(out_dataset.GetGeoTransform())
+    dataset.SetProjection(out_dataset.GetProjection())
+    band = dataset.GetRasterBand(1)
+    band.WriteArray(encoded.astype(np.int16))
+    band.SetNoDataValue(INT16_NODATA)
+    band.SetScale(scale)
+    band.SetOffset(offset)
+    dataset.SetMetadata(out_dataset.GetMetadata())
+    return dataset
+
+
+def cog_creation_options(creation_options):
+    """Converts GTiff creation options of an output profile to their COG driver equivalent."""
+    predictors = {"2": "STANDARD", "3": "FLOATING_POINT"}
+    options = []
+    for option in creation_options:
+        key, value = option.split("=", 1)
+        if key == "PREDICTOR":
+            value = predictors.get(value, value)
+        options.append("{}={}".format(key, value))
+    return options + ["OVERVIEWS=AUTO", "RESAMPLING=BILINEAR"]
+
+
+def write_lake_tiff(out_dataset, main_file, lowres_file, small_view, file=None, lake=None, profile="deflate", cog=False,
+                    lowres_overviews=False):
+    """
+    Writes the lake crop held in out_dataset as a compressed GeoTiff and creates the low resolution version
+    when it is smaller (see write_lowres_tiff). Returns the name of the file to be listed in the metadata.
+
+    profile is an output profile specification or dict (see parse_output_profile) defining the encoding.
+    With cog a single Cloud Optimized GeoTiff with internal overviews is written instead of the full and
+    low resolution files, and its name is always returned. With lowres_overviews only the full resolution file
+    is written and None is returned, the low resolution version is then cut from the scene overviews (see
+    lowres_crop) and written with write_lowres_tiff.
+
+    Files whose stored "Content Hash" matches the crop and its settings (see content_hash) are left untouched,
+    so a reprocess keeps their modification times and the sync only uploads crops that changed.
+    """
+    from osgeo import gdal
+    if isinstance(profile, str):
+        profile = parse_output_profile(profile)
+    with instrumentation.stage("write", file=file, lake=lake):
         out_dataset.FlushCache()
+        digest = content_hash(out_dataset, profile=profile, cog=cog, small_view=small_view,
+                              lowres="overviews" if lowres_overviews else "warp")
+        if stored_content_hash(main_file) == digest:
+            instrumentation.count("crops_unchanged")
+            if not cog and os.path.isfile(lowres_file):
+                return os.path.basename(lowres_file)
+            return os.path.basename(main_file)
+        source = out_dataset
+        if "scale" in profile:
+            source = _encode_int16(out_dataset, profile["scale"], profile["offset"])
+        metadata = ["{}={}".format(CONTENT_HASH, digest)]
+        if cog:
+            gdal.Translate(main_file, source, format="COG", metadataOptions=metadata,
+                           creationOptions=cog_creation_options(profile["creation_options"]))
+        else:
+            gdal.Translate(main_file, source, metadataOptions=metadata,
+                           creationOptions=["TILED=YES", "COPY_SRC_OVERVIEWS=YES"] + profile["creation_options"])
+        source = None
+
+    if cog or lowres_overviews:
+        # A stale low resolution file would be kept by the next run once the full resolution file is unchanged
+        if os.path.isfile(lowres_file):
+            os.remove(lowres_file)
+        return os.path.basename(main_file) if cog else None
+    return write_lowres_tiff(main_file, lowres_file, small_view, file, lake, profile)
 
-        # Compress file
-        translate_options = gdal.TranslateOptions(gdal.ParseCommandLine(
-            '-co TILED=YES -co COPY_SRC_OVERVIEWS=YES -co COMPRESS=DEFLATE'))
-        gdal.Translate(main_file, out_dataset, options=translate_options)
-        os.remove(temp_file)
 
-        # Create low resolution version
+def write_lowres_tiff(main_file, lowres_file, small_view, file=None, lake=None, profile="deflate", lowres=None):
+    """
+    Writes the low resolution version of the full resolution file written by write_lake_tiff when it is smaller,
+    resampling main_file or, if given, from the float32 low resolution version lowres (see lowres_crop). Returns
+    the name of the file to be listed in the metadata.
+    """
+    from osgeo import gdal
+    if isinstance(profile, str):
+        profile = parse_output_profile(profile)
+    with instrumentation.stage("lowres", file=file, lake=lake):
         if os.path.isfile(lowres_file):
             os.remove(lowres_file)
         dataset = gdal.Open(main_file)
         geo_transform = dataset.GetGeoTransform()
-        scale_factor = max(np.floor(dataset.RasterXSize/small_view), np.floor(dataset.RasterYSize/small_view))
+        scale_factor = lowres_scale_factor(dataset.RasterXSize, dataset.RasterYSize, small_view)
         if scale_factor > 1:
-            gdal.Warp(lowres_file, dataset, xRes=geo_transform[1]*scale_factor, yRes=geo_transform[5]*scale_factor, resampleAlg=gdal.GRA_Bilinear)
+            if lowres is not None:
+                source = _encode_int16(lowres, profile["scale"], profile["offset"]) if "scale" in profile else lowres
+                gdal.Translate(lowres_file, source)
+                source = None
+            else:
+                lowres = gdal.Warp(lowres_file, dataset, xRes=geo_transform[1]*scale_factor, yRes=geo_transform[5]*scale_factor,
+                                   resampleAlg=gdal.GRA_Bilinear)
+                if "scale" in profile:
+                    lowres.GetRasterBand(1).SetScale(profile["scale"])
+                    lowres.GetRasterBand(1).SetOffset(profile["offset"])
+            lowres = None
             if os.path.getsize(lowres_file) > os.path.getsize(main_file):
                 os.remove(lowres_file)
             else:
-                metadata[key]["file"] = os.path.basename(lowres_file)
+                return os.path.basename(lowres_file)
+    return os.path.basename(main_file)
+
+
+# Metadata item of the cropped files holding their content_hash
+CONTENT_HASH = "Content Hash"
+
+
+def content_hash(out_dataset, **settings):
+    """
+    SHA-256 of a lake crop: its pixels, georeferencing and metadata, and the settings it is written with (output
+    profile, cog, ...), so a change of any of them rewrites the file.
+    """
+    import hashlib
+    digest = hashlib.sha256()
+    digest.update(out_dataset.GetRasterBand(1).ReadAsArray().tobytes())
+    metadata = {k: v for k, v in out_dataset.GetMetadata().items() if k != CONTENT_HASH}
+    digest.update(json.dumps({"size": [out_dataset.RasterXSize, out_dataset.RasterYSize],
+                              "geotransform": list(out_dataset.GetGeoTransform()),
+                              "projection": out_dataset.GetProjection(), "metadata": metadata, "settings": settings},
+                             sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def stored_content_hash(path):
+    """content_hash stored in a cropped file, None if the file does not exist or has none."""
+    from osgeo import gdal
+    if not os.path.isfile(path):
+        return None
+    dataset = gdal.Open(path)
+    return dataset.GetMetadataItem(CONTENT_HASH) if dataset is not None else None
+
+
+def lowres_scale_factor(width, height, small_view):
+    """Downsampling factor of the low resolution version of a width x height crop, no version is written below 2."""
+    import numpy as np
+    return max(np.floor(width / small_view), np.floor(height / small_view))
+
+
+@contextmanager
+def scene_overviews(raster, memory_budget=False):
+    """
+    Empty float32 copy of band 1 of raster (NaN nodata) collecting the lake pixels to cut low resolution crops
+    from: the crops of lake_crops are copied into it with add_to_overviews, so lakes dropped by the quality
+    pre-pass are never copied and no band is read or lake rasterized twice, then bilinear overviews ignoring NaN
+    are built with build_overviews and the crops cut with lowres_crop. Flagged, land and shore pixels are thus
+    never averaged into low resolution pixels (only pixels of a neighbouring lake closer than the downsampling
+    factor can be). The copy is sparse and kept in memory (/vsimem), or in a temporary folder if memory_budget is
+    given. Nothing is written next to the scene.
+    """
+    import numpy as np
+    from osgeo import gdal
+    if memory_budget:
+        temp_dir = tempfile.mkdtemp(prefix="overviews_")
+        path = os.path.join(temp_dir, "overviews.tif")
+    else:
+        temp_dir = None
+        path = "/vsimem/overviews_{}_{}.tif".format(os.getpid(), id(raster))
+    overviews = None
+    try:
+        overviews = gdal.GetDriverByName("GTiff").Create(path, raster.RasterXSize, raster.RasterYSize, 1,
+                                                         gdal.GDT_Float32, ["TILED=YES", "SPARSE_OK=YES"])
+        overviews.SetGeoTransform(raster.GetGeoTransform())
+        overviews.SetProjection(raster.GetProjection())
+        overviews.GetRasterBand(1).SetNoDataValue(np.nan)
+        yield overviews
+    finally:
+        overviews = None
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        else:
+            gdal.Unlink(path)
+
+
+def _crop_offset(scene, dataset):
+    """Pixel offset (x, y) in scene of the upper left corner of dataset, a crop or low resolution crop of it."""
+    geotransform = scene.GetGeoTransform()
+    crop_geotransform = dataset.GetGeoTransform()
+    return (int(round((crop_geotransform[0] - geotransform[0]) / geotransform[1])),
+            int(round((crop_geotransform[3] - geotransform[3]) / geotransform[5])))
+
+
+def add_to_overviews(overviews, out_dataset, small_view, memory_budget=False):
+    """
+    Copies the valid pixels of the lake crop out_dataset (see lake_crops) into the scene copy of scene_overviews,
+    in parts of at most memory_budget MB (see block_windows) if given.
+
+    Returns the grid of the low resolution version of the crop, or None when no low resolution version is
+    written: a float32 MEM dataset on the grid of the file resampled by write_lowres_tiff, carrying the metadata
+    of the crop, that is 0 where the nearest crop pixel is valid (in the lake and not masked) and NaN elsewhere.
+    lowres_crop fills it once the overviews are built.
+    """
+    import numpy as np
+    from osgeo import gdal
+    width, height = out_dataset.RasterXSize, out_dataset.RasterYSize
+    x_offset, y_offset = _crop_offset(overviews, out_dataset)
+    scale_factor = int(lowres_scale_factor(width, height, small_view))
+    keep = None
+    if scale_factor > 1:
+        lowres_width, lowres_height = int(width / scale_factor + 0.5), int(height / scale_factor + 0.5)
+        rows = np.minimum(np.arange(lowres_height) * scale_factor + scale_factor // 2, height - 1)
+        columns = np.minimum(np.arange(lowres_width) * scale_factor + scale_factor // 2, width - 1)
+        keep = np.zeros((lowres_height, lowres_width), dtype=bool)
+
+    window = (x_offset, y_offset, x_offset + width, y_offset + height)
+    parts = _window_parts(window, block_windows(overviews, memory_budget)) if memory_budget else [
+        (x_offset, y_offset, width, height)]
+    band = overviews.GetRasterBand(1)
+    for x, y, x_size, y_size in parts:
+        crop = out_dataset.GetRasterBand(1).ReadAsArray(x - x_offset, y - y_offset, x_size, y_size)
+        valid = ~np.isnan(crop)
+        if keep is not None:
+            part_rows = np.nonzero((rows >= y - y_offset) & (rows < y - y_offset + y_size))[0]
+            part_columns = np.nonzero((columns >= x - x_offset) & (columns < x - x_offset + x_size))[0]
+            keep[np.ix_(part_rows, part_columns)] = valid[np.ix_(rows[part_rows] - (y - y_offset),
+                                                                 columns[part_columns] - (x - x_offset))]
+        if not valid.any():
+            continue
+        values = band.ReadAsArray(x, y, x_size, y_size)
+        values[valid] = crop[valid]
+        band.WriteArray(values, x, y)
+    if keep is None:
+        return None
+
+    crop_geotransform = out_dataset.GetGeoTransform()
+    grid = gdal.GetDriverByName("MEM").Create("", keep.shape[1], keep.shape[0], 1, gdal.GDT_Float32)
+    grid.SetGeoTransform((crop_geotransform[0], crop_geotransform[1] * scale_factor, crop_geotransform[2],
+                          crop_geotransform[3], crop_geotransform[4], crop_geotransform[5] * scale_factor))
+    grid.SetProjection(out_dataset.GetProjection())
+    grid.SetMetadata(out_dataset.GetMetadata())
+    grid.GetRasterBand(1).SetNoDataValue(np.nan)
+    grid.GetRasterBand(1).WriteArray(np.where(keep, 0, np.nan).astype(np.float32))
+    return grid
+
+
+def build_overviews(overviews, scale_factor):
+    """Builds the bilinear overviews of the scene copy of scene_overviews down to the largest lowres scale_factor."""
+    levels = []
+    while 2 ** (len(levels) + 1) <= scale_factor:
+        levels.append(2 ** (len(levels) + 1))
+    if len(levels) > 0:
+        overviews.BuildOverviews("BILINEAR", levels)
+
+
+def lowres_crop(scene, grid):
+    """
+    Fills the low resolution grid of a lake crop (see add_to_overviews) from the scene copy of scene_overviews and
+    returns it. Values come from a decimated bilinear read of the scene window, which GDAL serves from the closest
+    overview instead of the full resolution pixels, ignoring NaN. Pixels that are NaN in the grid stay NaN.
+    """
+    import numpy as np
+    from osgeo import gdal
+    scale_factor = int(round(grid.GetGeoTransform()[1] / scene.GetGeoTransform()[1]))
+    x_offset, y_offset = _crop_offset(scene, grid)
+    lowres_width, lowres_height = grid.RasterXSize, grid.RasterYSize
+
+    # The last row and column may reach past the crop, and past the scene for lakes on its edge
+    x_size = min(lowres_width * scale_factor, scene.RasterXSize - x_offset)
+    y_size = min(lowres_height * scale_factor, scene.RasterYSize - y_offset)
+    buffer_width = min(lowres_width, -(-x_size // scale_factor))
+    buffer_height = min(lowres_height, -(-y_size // scale_factor))
+    values = np.full((lowres_height, lowres_width), np.nan, dtype=np.float32)
+    values[:buffer_height, :buffer_width] = scene.GetRasterBand(1).ReadAsArray(
+        x_offset, y_offset, x_size, y_size, buf_xsize=buffer_width, buf_ysize=buffer_height,
+        resample_alg=gdal.GRIORA_Bilinear)
+    band = grid.GetRasterBand(1)
+    values[np.isnan(band.ReadAsArray())] = np.nan
+    band.WriteArray(values)
+    return grid
+
+
+def add_to_cube(cube_dir, lake, file, out_dataset):
+    """
+    Appends the lake crop held in out_dataset to the data cube <cube_dir>/<lake>/<parameter>.zarr (see
+    cube.LakeCube). The first crop fixes the lake grid, later crops on a different grid are resampled onto it
+    (nearest neighbour).
+    """
+    import numpy as np
+    from osgeo import gdal
+    from cube import LakeCube
+    properties = properties_from_filename(file)
+    path = os.path.join(cube_dir, lake, properties["parameter"] + ".zarr")
+    with file_lock(path + ".lock"):
+        lake_cube = LakeCube(path)
+        grid = lake_cube.grid()
+        shape = (out_dataset.RasterYSize, out_dataset.RasterXSize)
+        if grid is None or grid == (out_dataset.GetProjection(), out_dataset.GetGeoTransform(), shape):
+            values = out_dataset.GetRasterBand(1).ReadAsArray()
+        else:
+            crs, geotransform, (height, width) = grid
+            warped = gdal.Warp("", out_dataset, format="MEM", dstSRS=crs, width=width, height=height,
+                               outputBounds=(geotransform[0], geotransform[3] + height * geotransform[5],
+                                             geotransform[0] + width * geotransform[1], geotransform[3]),
+                               srcNodata=np.nan, dstNodata=np.nan, resampleAlg=gdal.GRA_NearestNeighbour)
+            values = warped.GetRasterBand(1).ReadAsArray()
+            warped = None
+        lake_cube.append(os.path.basename(file), properties["date"], values, out_dataset.GetProjection(),
+                         out_dataset.GetGeoTransform())
+
+
+def remove_from_cube(cube_dir, file):
+    """Clears the time step of file in the data cubes of all lakes."""
+    from cube import LakeCube
+    parameter = properties_from_filename(file)["parameter"]
+    if not os.path.isdir(cube_dir):
+        return
+    for lake in os.listdir(cube_dir):
+        path = os.path.join(cube_dir, lake, parameter + ".zarr")
+        if not os.path.isdir(path):
+            continue
+        with file_lock(path + ".lock"):
+            if LakeCube(path).remove(os.path.basename(file)):
+                print("   Deleting from: {}".format(path))
+
+
+def crop_file_names(file, lake):
+    """Names of the full and low resolution cropped files of lake for the input file."""
+    name, extension = os.path.splitext(os.path.basename(file))
+    return "{}_{}{}".format(name, lake, extension), "{}_{}_lowres{}".format(name, lake, extension)
+
+
+def extract_tiff_subsection(input_file, output_dir, geojson, small_view=500, memory_budget=False,
+                            statistics="exact", sketch_accuracy=0.001, access="read", output_profile="deflate",
+                            cog=False, cube=False, lowres_overviews=False):
+    """
+    Crops every lake out of a GeoTiff, writing <output_dir>/<lake>/<name>_<lake>.tif (and a _lowres version)
+    and returns the statistics of each lake with valid pixels.
+
+    Parameters:
+    - input_file (str): Path of the GeoTiff. A second band is treated as quality mask (1 = invalid).
+    - output_dir (str): Folder for the cropped files
+    - geojson (dict or LakeCatalogue): Lake polygons, see lake_windows
+    - small_view (int): Target size in pixels of the low resolution version
+    - memory_budget (float): Optional limit in MB for pixel buffers. The scene is then streamed in its native
+      block order instead of being read into memory at once, producing identical results.
+    - statistics (str): "exact" or "sketch". "sketch" computes p10/p90 from a mergeable quantile sketch with
+      relative error sketch_accuracy (see quantiles.QuantileSketch) instead of keeping all lake pixel values.
+    - access (str): "read" or "memmap", how the scene is accessed when not streaming blocks (see scene_arrays).
+    - output_profile (str): Encoding of the cropped files, see parse_output_profile. Statistics are always
+      computed from the original values.
+    - cog (bool): Write one Cloud Optimized GeoTiff with internal overviews per lake instead of a full and a low
+      resolution file.
+    - cube (str): Optional folder of per lake data cubes, every crop is also appended to
+      <cube>/<lake>/<parameter>.zarr (see add_to_cube).
+    - lowres_overviews (bool): Cut the low resolution versions from overviews of the lake pixels of the scene
+      (collected from the crops and built once per scene, see scene_overviews) instead of resampling every full
+      resolution crop.
+    """
+    from osgeo import gdal
+    raster = gdal.Open(input_file)
+    file = os.path.basename(input_file)
+    profile = parse_output_profile(output_profile)
+    catalogue = lake_catalogue(geojson)
+
+    metadata = {}
+    with (scene_overviews(raster, memory_budget) if lowres_overviews and not cog else _no_overviews()) as overviews:
+        grids = {}
+        for key, pixels, lake_statistics, out_dataset in lake_crops(raster, output_dir, catalogue, file, memory_budget,
+                                                                    statistics, sketch_accuracy, access):
+            print("  Extracting lake {}".format(key))
+            with instrumentation.stage("stats", file=file, lake=key):
+                metadata[key] = _crop_result(pixels, lake_statistics, out_dataset)
+            if overviews is not None:
+                with instrumentation.stage("overviews", file=file, lake=key):
+                    grid = add_to_overviews(overviews, out_dataset, small_view, memory_budget)
+            metadata[key]["file"] = _write_lake(out_dataset, output_dir, file, key, small_view, profile, cog, cube,
+                                                overviews is not None)
+            if metadata[key]["file"] is None:
+                grids[key] = grid
+            out_dataset = grid = None
+
+        # Only once every crop was copied, and not at all when all crops are unchanged
+        if len(grids) > 0:
+            scale_factors = [round(grid.GetGeoTransform()[1] / raster.GetGeoTransform()[1])
+                             for grid in grids.values() if grid is not None]
+            with instrumentation.stage("overviews", file=file):
+                build_overviews(overviews, max(scale_factors, default=1))
+        for key, grid in grids.items():
+            main_file, lowres_file = [os.path.join(output_dir, key, f) for f in crop_file_names(file, key)]
+            if grid is not None:
+                with instrumentation.stage("lowres", file=file, lake=key):
+                    grid = lowres_crop(overviews, grid)
+            metadata[key]["file"] = write_lowres_tiff(main_file, lowres_file, small_view, file, key, profile, grid)
+        grids.clear()
     return metadata
 
 
+@contextmanager
+def _no_overviews():
+    yield None
+
+
+def lake_crops(raster, output_dir, geojson, file, memory_budget=False, statistics="exact", sketch_accuracy=0.001,
+               access="read"):
+    """
+    Yields (key, pixels, statistics, out_dataset) for every lake of the scene with valid pixels, where out_dataset
+    is a temporary float32 crop of the lake window (NaN outside the lake and for invalid pixels) carrying the
+    "Commit Hash" and "Reproduce" metadata of the scene. It is removed when the next lake is requested.
+    See extract_tiff_subsection for the parameters.
+    """
+    from quantiles import LakeStatistics
+    file_metadata = raster.GetMetadata()
+    name, extension = os.path.splitext(file)
+    catalogue = lake_catalogue(geojson)
+    with instrumentation.stage("geometry", file=file):
+        lakes = lake_windows(raster, catalogue)
+
+    def new_statistics():
+        return LakeStatistics(statistics, sketch_accuracy)
+
+    if memory_budget:
+        lakes = reject_masked_lakes(raster, lakes, file, memory_budget)
+        lake_data = _extract_blocks(raster, lakes, name, extension, memory_budget, new_statistics, file, catalogue)
+    else:
+        lake_data = _extract_in_memory(raster, lakes, output_dir, name, extension, new_statistics, file, access,
+                                       catalogue)
+
+    for key, pixels, lake_statistics, out_dataset, temp_file in lake_data:
+        if lake_statistics.count > 0:
+            # Kept in the crop so its metadata can be rebuilt without the scene (see rebuild_metadata)
+            out_dataset.SetMetadata({k: file_metadata[k] for k in ("Commit Hash", "Reproduce") if k in file_metadata})
+            yield key, pixels, lake_statistics, out_dataset
+        out_dataset = None
+        os.remove(temp_file)
+
+
+def reject_masked_lakes(raster, lakes, file=None, memory_budget=False, mask=None):
+    """
+    Drops the lakes (as returned by lake_windows) whose whole window is flagged in the quality mask band
+    (1 = invalid), e.g. under clouds, so the data band is not read and the lake is not rasterized for them.
+    Returns the remaining lakes.
+
+    mask is the quality mask band of the scene if it was already read. Otherwise only the mask window of every
+    lake is read, in parts of at most memory_budget MB (see block_windows) if given, stopping at the first pixel
+    that is not flagged.
+    """
+    if raster.RasterCount != 2 or len(lakes) == 0:
+        return lakes
+    band = raster.GetRasterBand(2)
+    windows = list(block_windows(raster, memory_budget)) if memory_budget else None
+    remaining = []
+    with instrumentation.stage("quality_check", file=file):
+        for lake in lakes:
+            min_x_pixel, min_y_pixel, max_x_pixel, max_y_pixel = lake[2][:4]
+            if mask is not None:
+                flagged = (mask[min_y_pixel:max_y_pixel, min_x_pixel:max_x_pixel] == 1).all()
+            else:
+                parts = _window_parts(lake[2], windows) if windows is not None else [
+                    (min_x_pixel, min_y_pixel, max_x_pixel - min_x_pixel, max_y_pixel - min_y_pixel)]
+                flagged = all((band.ReadAsArray(*part) == 1).all() for part in parts)
+            if not flagged:
+                remaining.append(lake)
+    skipped = len(lakes) - len(remaining)
+    if skipped > 0:
+        print("  Skipped {} of {} lakes fully covered by the quality mask".format(skipped, len(lakes)))
+        instrumentation.count("lakes_masked", skipped)
+    return remaining
+
+
+def _window_parts(window, windows):
+    """Parts (x_offset, y_offset, x_size, y_size) of a lake window within each of the block windows."""
+    min_x_pixel, min_y_pixel, max_x_pixel, max_y_pixel = window[:4]
+    for x_offset, y_offset, x_size, y_size in windows:
+        x0, y0 = max(min_x_pixel, x_offset), max(min_y_pixel, y_offset)
+        x1, y1 = min(max_x_pixel, x_offset + x_size), min(max_y_pixel, y_offset + y_size)
+        if x0 < x1 and y0 < y1:
+            yield x0, y0, x1 - x0, y1 - y0
+
+
+def _crop_result(pixels, lake_statistics, out_dataset):
+    """Statistics of a lake crop as returned by extract_tiff_subsection, without "file"."""
+    crop_metadata = out_dataset.GetMetadata()
+    result = {"pixels": pixels}
+    result.update(lake_statistics.result())
+    result["commit"] = crop_metadata["Commit Hash"] if "Commit Hash" in crop_metadata else "False"
+    result["reproduce"] = crop_metadata["Reproduce"] if "Reproduce" in crop_metadata else "False"
+    return result
+
+
+def _write_lake(out_dataset, output_dir, file, key, small_view, profile, cog=False, cube=False, lowres_overviews=False):
+    """Writes the crop of lake key of file (see write_lake_tiff) and adds it to the data cube. Returns the listed name."""
+    main_file, lowres_file = [os.path.join(output_dir, key, f) for f in crop_file_names(file, key)]
+    if cube:
+        with instrumentation.stage("cube", file=file, lake=key):
+            add_to_cube(cube, key, file, out_dataset)
+    os.makedirs(os.path.join(output_dir, key), exist_ok=True)
+    return write_lake_tiff(out_dataset, main_file, lowres_file, small_view, file=file, lake=key, profile=profile,
+                           cog=cog, lowres_overviews=lowres_overviews)
+
+
+def _temp_lake_file(output_dir, key, name, extension):
+    os.makedirs(os.path.join(output_dir, key), exist_ok=True)
+    return os.path.join(output_dir, key, "{}_temp{}".format(name, extension))
+
+
+def scene_arrays(raster, access="read"):
+    """
+    Returns the data band and the quality mask band (or None) of the scene as arrays.
+
+    access "read" copies both bands into memory. access "memmap" exposes uncompressed bands as memory mapped
+    arrays via GDAL virtual memory, so no copy of the scene is made and pages are shared with the page cache.
+    Compressed scenes, or platforms without virtual memory support, fall back to "read".
+    """
+    return scene_band(raster, 1, access), scene_band(raster, 2, access) if raster.RasterCount == 2 else None
+
+
+def scene_band(raster, index, access="read"):
+    """Band index (1 = data, 2 = quality mask) of the scene as an array, see scene_arrays."""
+    if access == "memmap":
+        compression = raster.GetMetadataItem("COMPRESSION", "IMAGE_STRUCTURE")
+        if compression is None:
+            try:
+                band = raster.GetRasterBand(index).GetVirtualMemAutoArray()
+                if band is not None:
+                    return band
+            except Exception as e:
+                print("   Memory mapping not available ({}), reading scene".format(e))
+        elif index == 1:
+            print("   Scene is compressed ({}), reading instead of memory mapping".format(compression))
+    return raster.GetRasterBand(index).ReadAsArray()
+
+
+def _extract_in_memory(raster, lakes, output_dir, name, extension, new_statistics, file, access="read",
+                       catalogue=None):
+    """
+    Crops each lake from the full scene (see scene_arrays). The quality mask is read first and lakes it fully
+    covers are dropped (see reject_masked_lakes) before the data band is read. The quality mask and lake polygon
+    are applied to the lake window only, producing the crop in a single copy. Yields (key, pixels, statistics,
+    out_dataset, temp_file).
+    """
+    import numpy as np
+    from osgeo import gdal
+    if len(lakes) == 0:
+        return
+    mask = None
+    if raster.RasterCount == 2:
+        with instrumentation.stage("quality_check", file=file):
+            mask = scene_band(raster, 2, access)
+        lakes = reject_masked_lakes(raster, lakes, file, mask=mask)
+        if len(lakes) == 0:
+            return
+    with instrumentation.stage("scene_read", file=file):
+        band = scene_band(raster, 1, access)
+
+    for key, polygon_geometry, window in lakes:
+        min_x_pixel, min_y_pixel, max_x_pixel, max_y_pixel = window[:4]
+        with instrumentation.stage("masking", file=file, lake=key):
+            mask_geometry = _lake_mask(catalogue, raster, key, polygon_geometry, (
+                min_x_pixel, min_y_pixel, max_x_pixel - min_x_pixel, max_y_pixel - min_y_pixel))
+            valid = mask_geometry == 1
+            if mask is not None:
+                valid &= mask[min_y_pixel:max_y_pixel, min_x_pixel:max_x_pixel] != 1
+            cropped_band = np.where(valid, band[min_y_pixel:max_y_pixel, min_x_pixel:max_x_pixel], np.nan
+                                    ).astype(band.dtype, copy=False)
+            lake_statistics = new_statistics()
+            lake_statistics.add(cropped_band[~np.isnan(cropped_band)])
+
+        if lake_statistics.count == 0:
+            continue
+
+        temp_file = _temp_lake_file(output_dir, key, name, extension)
+        out_dataset = create_lake_tiff(temp_file, raster, window, gdal.GDT_Float32)
+        out_dataset.GetRasterBand(1).WriteArray(cropped_band)
+        yield key, np.count_nonzero(mask_geometry == 1), lake_statistics, out_dataset, temp_file
+
+
+def _lake_mask(catalogue, raster, key, geometry, window):
+    if catalogue is None:
+        return polygon_raster_mask(raster, geometry, window=window)
+    return catalogue.mask(raster, key, geometry, window)
+
+
+def block_windows(raster, memory_budget, bytes_per_pixel=12):
+    """
+    Splits the raster into (x_offset, y_offset, x_size, y_size) windows following its native block layout,
+    each window holding at most memory_budget MB (estimated with bytes_per_pixel for the data, quality mask,
+    lake mask and temporaries). Windows span whole rows of blocks where possible so strips and tiles are read
+    in file order.
+    """
+    block_x, block_y = raster.GetRasterBand(1).GetBlockSize()
+    budget_pixels = max(int(memory_budget * 1024 * 1024 / bytes_per_pixel), 1)
+    rows_of_blocks = budget_pixels // (raster.RasterXSize * block_y)
+    if rows_of_blocks >= 1:
+        x_size, y_size = raster.RasterXSize, rows_of_blocks * block_y
+    else:
+        x_size, y_size = max(budget_pixels // (block_x * block_y), 1) * block_x, block_y
+    for y_offset in range(0, raster.RasterYSize, y_size):
+        for x_offset in range(0, raster.RasterXSize, x_size):
+            yield (x_offset, y_offset, min(x_size, raster.RasterXSize - x_offset),
+                   min(y_size, raster.RasterYSize - y_offset))
+
+
+def _extract_blocks(raster, lakes, name, extension, memory_budget, new_statistics, file, catalogue=None):
+    """
+    Streams the scene window by window (see block_windows), applying the quality mask and lake membership per
+    window and writing each lake crop incrementally into a temporary folder outside the output folder, so the
+    partial crops are never synced. Yields (key, pixels, statistics, out_dataset, temp_file).
+    """
+    import numpy as np
+    from osgeo import gdal
+    if len(lakes) == 0:
+        return
+    temp_dir = tempfile.mkdtemp(prefix="blocks_")
+    outputs = {}
+    for key, polygon_geometry, window in lakes:
+        temp_file = os.path.join(temp_dir, "{}_{}{}".format(name, key, extension))
+        outputs[key] = {"pixels": 0, "statistics": new_statistics(), "temp_file": temp_file,
+                        "dataset": create_lake_tiff(temp_file, raster, window, gdal.GDT_Float32)}
+
+    try:
+        for x_offset, y_offset, x_size, y_size in block_windows(raster, memory_budget):
+            block_lakes = [l for l in lakes if l[2][0] < x_offset + x_size and l[2][2] > x_offset
+                           and l[2][1] < y_offset + y_size and l[2][3] > y_offset]
+            if len(block_lakes) == 0:
+                continue
+            with instrumentation.stage("scene_read", file=file):
+                band = raster.GetRasterBand(1).ReadAsArray(x_offset, y_offset, x_size, y_size)
+                if raster.RasterCount == 2:
+                    mask = raster.GetRasterBand(2).ReadAsArray(x_offset, y_offset, x_size, y_size)
+                    band[mask == 1] = np.nan
+                    del mask
+
+            for key, polygon_geometry, window in block_lakes:
+                min_x_pixel, min_y_pixel, max_x_pixel, max_y_pixel = window[:4]
+                x0, y0 = max(min_x_pixel, x_offset), max(min_y_pixel, y_offset)
+                x1, y1 = min(max_x_pixel, x_offset + x_size), min(max_y_pixel, y_offset + y_size)
+                with instrumentation.stage("masking", file=file, lake=key):
+                    mask_geometry = _lake_mask(catalogue, raster, key, polygon_geometry, (x0, y0, x1 - x0, y1 - y0))
+                    cropped_band = np.where(mask_geometry == 1,
+                                            band[y0 - y_offset:y1 - y_offset, x0 - x_offset:x1 - x_offset], np.nan
+                                            ).astype(band.dtype, copy=False)
+                    outputs[key]["pixels"] += np.count_nonzero(mask_geometry == 1)
+                    outputs[key]["statistics"].add(cropped_band[~np.isnan(cropped_band)])
+                with instrumentation.stage("write", file=file, lake=key):
+                    outputs[key]["dataset"].GetRasterBand(1).WriteArray(cropped_band, x0 - min_x_pixel, y0 - min_y_pixel)
+
+        for key in list(outputs.keys()):
+            output = outputs.pop(key)
+            yield key, output["pixels"], output["statistics"], output["dataset"], output["temp_file"]
+    finally:
+        outputs.clear()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
 def uri_to_url(uri):
     parts = uri.split("/")
     return "https://{}.s3.eu-central-1.amazonaws.com/{}".format(parts[2], "/".join(parts[3:]))
@@ -329,9 +1768,12 @@ def rclone_sync(remote, local_dir, dry_run=False, extension="*.tif"):
     - Added: Files that are in remote but not in local.
     - Modified: Files that differ in local and remote.
     - Removed: Files that are in local but not in remote.
+    extension is an include pattern or a list of include patterns.
     """
     os.makedirs(local_dir, exist_ok=True)
-    command = ["rclone", "sync", remote, local_dir, "--include", extension]
+    command = ["rclone", "sync", remote, local_dir]
+    for pattern in ([extension] if isinstance(extension, str) else extension):
+        command.extend(["--include", pattern])
     if dry_run:
         command.append("--dry-run")
 
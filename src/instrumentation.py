@@ -0,0 +1,100 @@
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+class RunReport:
+    """
+    Collects per-stage timings of a run.
+
+    Every stage is aggregated with the file and lake it belongs to, so the report can be
+    summarized by stage, by file and by lake. The individual stage records are only kept
+    with records=True (e.g. for --report), so long runs and the daemon do not grow memory
+    with every stage. Counters hold simple totals (e.g. files processed or lakes skipped).
+    """
+    FIELDS = ("stage", "file", "lake")
+
+    def __init__(self, records=False):
+        self.records = records
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.stages = []
+        self.totals = {field: {} for field in self.FIELDS}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name, file=None, lake=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {
+                "stage": name,
+                "file": file,
+                "lake": lake,
+                "seconds": round(time.perf_counter() - start, 6)
+            }
+            for field in self.FIELDS:
+                if record[field] is not None:
+                    entry = self.totals[field].setdefault(record[field], {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+                    entry["count"] += 1
+                    entry["seconds"] += record["seconds"]
+                    entry["max_seconds"] = max(entry["max_seconds"], record["seconds"])
+            if self.records:
+                record["peak_rss_mb"] = round(peak_rss_mb(), 1)
+                self.stages.append(record)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def aggregate(self, field):
+        return {key: dict(entry, seconds=round(entry["seconds"], 6)) for key, entry in self.totals[field].items()}
+
+    def empty(self):
+        return len(self.totals["stage"]) == 0 and len(self.counters) == 0
+
+    def to_dict(self):
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "duration_seconds": round(time.time() - self.started, 3),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "counters": self.counters,
+            "by_stage": self.aggregate("stage"),
+            "by_file": self.aggregate("file"),
+            "by_lake": self.aggregate("lake"),
+            "stages": self.stages
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, separators=(',', ':'))
+
+    def print_summary(self, top=5):
+        summary = self.to_dict()
+        print("Run summary: {:.1f}s, peak RSS {:.0f} MB".format(summary["duration_seconds"], summary["peak_rss_mb"]))
+        for name, value in summary["counters"].items():
+            print("   {}: {}".format(name, value))
+        print("   {:<14} {:>7} {:>10} {:>10}".format("stage", "count", "total s", "max s"))
+        for name, entry in sorted(summary["by_stage"].items(), key=lambda x: -x[1]["seconds"]):
+            print("   {:<14} {:>7} {:>10.2f} {:>10.2f}".format(name, entry["count"], entry["seconds"], entry["max_seconds"]))
+        for field in ("file", "lake"):
+            slowest = sorted(summary["by_" + field].items(), key=lambda x: -x[1]["seconds"])[:top]
+            if len(slowest) > 0:
+                print("   Slowest {}s: {}".format(field, ", ".join("{} ({:.1f}s)".format(k, v["seconds"]) for k, v in slowest)))
+
+
+report = RunReport()
+stage = report.stage
+count = report.count
@@ -4,15 +4,23 @@ import json
 import argparse
 from datetime import datetime
 import functions
+import instrumentation
+import retry_queue
 
 
 def reprocess(params, lake_geometry="lakes.geojson"):
     print("Reprocessing metadata")
-    functions.rclone_sync(params["remote_tiff"], params["local_tiff"])
-    functions.rclone_sync(params["remote_metadata"], params["local_metadata"], extension="*.json")
-    functions.download_file(params["lake_geometry"], lake_geometry)
-    with open(lake_geometry, 'r') as f:
-        geometry = json.load(f)
+    if params["no_sync"]:
+        print("Using local files without syncing")
+    else:
+        with instrumentation.stage("sync"):
+            functions.rclone_sync(params["remote_tiff"], params["local_tiff"])
+            functions.rclone_sync(params["remote_metadata"], params["local_metadata"], extension=["*.json", "*.npz"])
+    with instrumentation.stage("geometry_load"):
+        if not params["no_sync"] or not os.path.exists(lake_geometry):
+            functions.download_file(params["lake_geometry"], lake_geometry)
+        with open(lake_geometry, 'r') as f:
+            geometry = json.load(f)
 
     if params["lakes"] is not False and params["lakes"].lower() != "false":
         new_lakes = [l.strip() for l in params["lakes"].split(",")]
@@ -23,6 +31,20 @@ def reprocess(params, lake_geometry="lakes.geojson"):
             print("Geometry missing for the following lakes: {}".format(missing))
             return
 
+    shard = parse_shard(params["shard"])
+    local_tiff_cropped, local_metadata = params["local_tiff_cropped"], params["local_metadata"]
+    options = processing_options(params)
+    if shard is not None:
+        index, count = shard
+        local_tiff_cropped, local_metadata = shard_outputs(params["shard_dir"], index, count)
+        options["timeseries"] = False  # Built by the merge
+        if params["shard_by"] == "lake":
+            geometry["features"] = [f for f in geometry["features"] if functions.shard_of(f["properties"]["key"], count) == index]
+        elif options["cube"]:
+            raise ValueError("Data cubes are shared by all files of a lake, use --shard_by lake")
+        print("Shard {} of {} by {}, writing to {}".format(index, count, params["shard_by"], os.path.dirname(local_metadata)))
+    geometry = lake_catalogue(geometry, params["mask_cache"] or 0)
+
     period = False
     if params["period"] is not False and params["period"].lower() != "false":
         period = True
@@ -31,85 +53,484 @@ def reprocess(params, lake_geometry="lakes.geojson"):
         end = datetime.strptime(start_end[1], "%Y%m%d")
         print("Only processing files between {} and {}".format(start, end))
 
-    failed = []
+    selected = []
     for root, dirs, files in os.walk(params["local_tiff"]):
         for file in files:
             if not file.endswith(".tif"):
                 continue
+            if shard is not None and params["shard_by"] == "file":
+                name = functions.acquisition_name(file) if params["mosaic_tiles"] else file
+                if functions.shard_of(name, shard[1]) != shard[0]:
+                    continue
             if period:
                 match = re.search(r"\d{8}T\d{6}", file)
                 if match:
                     dt = datetime.strptime(match.group(0), "%Y%m%dT%H%M%S")
                     if dt < start or dt > end:
                         continue
-            try:
-                functions.add_file(os.path.join(os.path.relpath(root, params["local_tiff"]), file),
-                                   params["local_tiff"], params["local_tiff_cropped"], params["local_metadata"],
-                                   params["remote_tiff"], geometry)
-            except Exception as e:
-                failed.append(file)
-                print(e)
+            selected.append(os.path.join(os.path.relpath(root, params["local_tiff"]), file))
+
+    failed = []
+    uploader = background_uploader(params) if shard is None else None
+    for files in scenes(selected, params):
+        try:
+            outputs = add_scene(files, params, local_tiff_cropped, local_metadata, geometry, options)
+            if uploader is not None:
+                uploader.submit(outputs)
+        except Exception as e:
+            failed.extend(os.path.basename(f) for f in files)
+            instrumentation.count("files_failed", len(files))
+            print(e)
+
+    if params["upload"] and shard is not None:
+        print("Not uploading shard outputs, upload after --merge_shards")
+    elif params["upload"]:
+        finish_uploads(uploader)
+        upload(params)
+
+    if len(failed) > 0:
+        raise ValueError("Failed for: {}".format(", ".join(failed)))
+
+
+def scenes(files, params):
+    """Files processed together: every file on its own, or the tiles of each acquisition with --mosaic_tiles."""
+    if params["mosaic_tiles"]:
+        return functions.group_tiles(files, params["local_tiff"])
+    return [[file] for file in files]
+
+
+def add_scene(files, params, local_tiff_cropped, local_metadata, geometry, options):
+    """Adds one scene of scenes(), see functions.add_file and functions.add_tiles."""
+    if params["mosaic_tiles"]:
+        return functions.add_tiles(files, params["local_tiff"], local_tiff_cropped, local_metadata,
+                                   params["remote_tiff"], geometry, options)
+    return functions.add_file(files[0], params["local_tiff"], local_tiff_cropped, local_metadata,
+                              params["remote_tiff"], geometry, options)
+
+
+def newest_first(work):
+    """
+    Splits the scenes of a run (see scenes) into the newest scene of every parameter and tile, processed and
+    published first so the latest entries are current soon after an outage, and the backfill. Both are ordered by
+    acquisition date, newest first.
+    """
+    ordered = sorted(work, key=lambda files: functions.properties_from_filename(files[0])["date"], reverse=True)
+    priority, backfill, seen = [], [], set()
+    for files in ordered:
+        keys = set()
+        for file in files:
+            properties = functions.properties_from_filename(file)
+            keys.add((properties["parameter"], properties["tile"]))
+        (backfill if keys <= seen else priority).append(files)
+        seen.update(keys)
+    return priority, backfill
+
+
+def publish_checkpoint(params, outputs, uploader=None):
+    """
+    Uploads the crops and <parameter>_latest.json documents written for the newest scenes (see newest_first) before
+    the backfill starts, the other documents follow with the final sync. Background uploads already publish them
+    first.
+    """
+    if not params["upload"] or uploader is not None:
+        return
+    from uploader import BackgroundUploader
+    print("Publishing the latest entries before the backfill")
+    checkpoint = BackgroundUploader(params["local_tiff_cropped"], params["remote_tiff_cropped"], params["local_metadata"],
+                                    params["remote_metadata"], params["background_upload"] or 4)
+    for output in outputs:
+        checkpoint.submit({lake: {"crops": files["crops"],
+                                  "metadata": [f for f in files["metadata"] if f and f.endswith("_latest.json")]}
+                           for lake, files in output.items()})
+    with instrumentation.stage("checkpoint"):
+        failed = checkpoint.finish()
+    instrumentation.count("checkpoint_uploads", checkpoint.uploaded)
+    if len(failed) > 0:
+        print("{} checkpoint uploads failed, left to the final sync".format(len(failed)))
+
+
+def parse_shard(spec):
+    """(index, count) of a --shard i/N specification (index from 0), None when not sharded."""
+    if spec is False or spec is None:
+        return None
+    match = re.fullmatch(r"(\d+)/(\d+)", spec.strip())
+    if not match or int(match.group(1)) >= int(match.group(2)):
+        raise ValueError("Invalid shard {}, expected i/N with 0 <= i < N".format(spec))
+    return int(match.group(1)), int(match.group(2))
 
+
+def shard_outputs(shard_dir, index, count):
+    """Cropped file and metadata folders of one shard, merged by functions.merge_shards."""
+    if not shard_dir:
+        raise ValueError("--shard requires --shard_dir")
+    folder = os.path.join(shard_dir, "{}-of-{}".format(index, count))
+    return os.path.join(folder, "tiff_cropped"), os.path.join(folder, "metadata")
+
+
+def merge(params):
+    """Merges the shard outputs of --merge_shards into the local cropped file and metadata folders."""
+    print("Merging shard outputs from {}".format(params["merge_shards"]))
+    with instrumentation.stage("merge"):
+        functions.merge_shards(params["merge_shards"], params["local_tiff_cropped"], params["local_metadata"],
+                               params["sharded_metadata"], params["timeseries"])
     if params["upload"]:
-        if "metadata_summary" in params:
+        upload(params)
+
+
+def lake_catalogue(geojson, mask_cache=0):
+    """Lake catalogue shared by all files of a run, so geometries are transformed once per coordinate system."""
+    from catalogue import LakeCatalogue
+    return LakeCatalogue(geojson, mask_cache)
+
+
+def processing_options(params):
+    """Options passed on to functions.extract_tiff_subsection."""
+    if params["lowres_overviews"] and params["mosaic_tiles"]:
+        raise ValueError("--lowres_overviews is not supported with --mosaic_tiles")
+    return {"memory_budget": params["memory_budget"], "statistics": params["statistics"],
+            "sketch_accuracy": params["sketch_accuracy"], "access": params["scene_access"],
+            "output_profile": functions.parse_output_profiles(params["output_profile"]), "cog": params["cog"],
+            "sharded_metadata": params["sharded_metadata"], "timeseries": params["timeseries"],
+            "cube": params["local_cube"], "lowres_overviews": params["lowres_overviews"]}
+
+
+def profile(params, lake_geometry="lakes.geojson"):
+    """
+    Runs add_file under cProfile and tracemalloc for selected local files, writing <file>.pstats
+    and <file>.tracemalloc per file to the profile directory. Cropped files and metadata are
+    written inside the profile directory so the live outputs are left untouched.
+    """
+    import cProfile
+    import pstats
+    import tracemalloc
+    profile_dir = params["profile"]
+    print("Profiling into {}".format(profile_dir))
+    local_tiff_cropped = os.path.join(profile_dir, "tiff_cropped")
+    local_metadata = os.path.join(profile_dir, "metadata")
+    os.makedirs(local_metadata, exist_ok=True)
+    if not os.path.exists(lake_geometry):
+        functions.download_file(params["lake_geometry"], lake_geometry)
+    with open(lake_geometry, 'r') as f:
+        geometry = lake_catalogue(json.load(f), params["mask_cache"] or 0)
+
+    if params["profile_files"] is not False and params["profile_files"].lower() != "false":
+        files = [f.strip() for f in params["profile_files"].split(",")]
+    else:
+        files = []
+        for root, dirs, filenames in os.walk(params["local_tiff"]):
+            files.extend(os.path.relpath(os.path.join(root, f), params["local_tiff"]) for f in filenames if f.endswith(".tif"))
+        files = sorted(files)[:params["profile_count"]]
+
+    options = processing_options(params)
+    if options["cube"]:
+        options["cube"] = os.path.join(profile_dir, "cube")
+
+    for file in files:
+        name = os.path.splitext(os.path.basename(file))[0]
+        profiler = cProfile.Profile()
+        tracemalloc.start(25)
+        profiler.enable()
+        try:
+            functions.add_file(file, params["local_tiff"], local_tiff_cropped, local_metadata,
+                               params["remote_tiff"], geometry, options)
+        except Exception as e:
+            print(e)
+        finally:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        profiler.dump_stats(os.path.join(profile_dir, name + ".pstats"))
+        snapshot.dump(os.path.join(profile_dir, name + ".tracemalloc"))
+        print("   Peak traced memory: {:.1f} MB".format(peak / 1024 / 1024))
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+
+
+def rebuild(params, lake_geometry="lakes.geojson"):
+    """Rebuilds the metadata from the cropped files in local_tiff_cropped (see functions.rebuild_metadata)."""
+    print("Rebuilding metadata from {}".format(params["local_tiff_cropped"]))
+    with instrumentation.stage("geometry_load"):
+        if not os.path.exists(lake_geometry):
+            functions.download_file(params["lake_geometry"], lake_geometry)
+        with open(lake_geometry, 'r') as f:
+            geometry = json.load(f)
+    with instrumentation.stage("rebuild"):
+        functions.rebuild_metadata(params["local_tiff_cropped"], params["local_metadata"], params["local_tiff"],
+                                   params["remote_tiff"], geometry, params["workers"], params["statistics"],
+                                   params["sketch_accuracy"], params["sharded_metadata"], params["timeseries"])
+    if params["upload"]:
+        upload(params)
+
+
+def background_uploader(params):
+    """Uploader of the outputs of every processed file while the run continues, None unless enabled."""
+    if not params["upload"] or not params["background_upload"]:
+        return None
+    from uploader import BackgroundUploader
+    return BackgroundUploader(params["local_tiff_cropped"], params["remote_tiff_cropped"], params["local_metadata"],
+                              params["remote_metadata"], params["background_upload"])
+
+
+def finish_uploads(uploader):
+    """Waits for the background uploads, which must be complete before the final sync publishes anything else."""
+    if uploader is None:
+        return
+    with instrumentation.stage("upload_wait"):
+        failed = uploader.finish()
+    instrumentation.count("files_uploaded", uploader.uploaded)
+    if len(failed) > 0:
+        print("{} background uploads failed, left to the final sync".format(len(failed)))
+
+
+def upload(params, summary=True):
+    with instrumentation.stage("upload"):
+        if params["sharded_metadata"] and params["legacy_metadata"]:
+            print("Writing legacy metadata views")
+            functions.write_legacy_metadata(params["local_metadata"])
+        elif params["sharded_metadata"]:
+            functions.remove_legacy_metadata(params["local_metadata"])
+
+        if summary and "metadata_summary" in params:
             print("Checking for metadata summary updates")
             functions.metadata_summary(params["metadata_summary"], params["metadata_name"],
                                        os.path.abspath(params["local_metadata"]))
 
         print("Uploading to remote")
         functions.rclone_sync(params["local_tiff_cropped"], params["remote_tiff_cropped"])
-        functions.rclone_sync(params["local_metadata"], params["remote_metadata"], extension="*.json")
+        functions.rclone_sync(params["local_metadata"], params["remote_metadata"], extension=["*.json", "*.npz"])
+        if params["local_cube"] and params["remote_cube"]:
+            functions.rclone_sync(params["local_cube"], params["remote_cube"], extension="*.zarr/**")
 
-    if len(failed) > 0:
-        raise ValueError("Failed for: {}".format(", ".join(failed)))
+
+def run_report(params):
+    """Prints the run summary and writes --report, unless nothing was measured since the last report."""
+    if instrumentation.report.empty():
+        return
+    instrumentation.report.print_summary()
+    if params.get("report"):
+        instrumentation.report.write(params["report"])
+        print("Run report written to {}".format(params["report"]))
 
 
-def main(params, lake_geometry="lakes.geojson"):
+def main(params, lake_geometry="lakes.geojson", state=None):
+    """
+    Processes the files added to and removed from the remote since the last run. state is kept between the
+    cycles of the daemon and the products of a --config run: a warm "catalogue" is reused, files are no longer
+    started once "stop" is set and the metadata summary is left to the caller when "merge_summary" is set.
+    """
+    options = processing_options(params)
     print("Looking for updates from {}".format(params["remote_tiff"]))
-    added_files, removed_files = functions.rclone_sync(params["remote_tiff"], params["local_tiff"], dry_run=True)
-    if len(added_files) == 0 and len(removed_files) == 0:
+    with instrumentation.stage("listing"):
+        added_files, removed_files = functions.rclone_sync(params["remote_tiff"], params["local_tiff"], dry_run=True)
+
+    queue_file = params["retry_queue"] if params["retry_queue"] else os.path.join(params["local_tiff"], ".retry_queue.json")
+    queue = retry_queue.load_retry_queue(queue_file)
+    for file in added_files + removed_files:
+        retry_queue.forget(queue, file)  # Changed or removed on the remote, start again
+    retry_files = [f for f in retry_queue.due_files(queue) if os.path.isfile(os.path.join(params["local_tiff"], f))]
+    if len(queue["quarantine"]) > 0:
+        print("{} quarantined files are not retried: {}".format(len(queue["quarantine"]), queue_file))
+
+    if len(added_files) == 0 and len(removed_files) == 0 and len(retry_files) == 0:
         print("No updates, exiting.")
         return
 
-    functions.rclone_sync(params["remote_tiff"], params["local_tiff"])
-    functions.rclone_sync(params["remote_metadata"], params["local_metadata"], extension="*.json")
-    if not os.path.exists(lake_geometry):
-        functions.download_file(params["lake_geometry"], lake_geometry)
-    with open(lake_geometry, 'r') as f:
-        geometry = json.load(f)
+    with instrumentation.stage("sync"):
+        functions.rclone_sync(params["remote_tiff"], params["local_tiff"])
+        functions.rclone_sync(params["remote_metadata"], params["local_metadata"], extension=["*.json", "*.npz"])
+    if state is not None and state.get("catalogue") is not None:
+        geometry = state["catalogue"]
+    else:
+        with instrumentation.stage("geometry_load"):
+            if not os.path.exists(lake_geometry):
+                functions.download_file(params["lake_geometry"], lake_geometry)
+            with open(lake_geometry, 'r') as f:
+                geometry = lake_catalogue(json.load(f), params["mask_cache"] or 0)
+        if state is not None:
+            state["catalogue"] = geometry
+
+    if len(retry_files) > 0:
+        print("Retrying {} previously failed files".format(len(retry_files)))
+
+    pending = added_files + retry_files
+    if params["mosaic_tiles"]:
+        for acquisition in sorted(set(functions.acquisition_name(f) for f in removed_files)):
+            # Mosaicked again below from the remaining tiles
+            functions.remove_file(acquisition, params["local_metadata"], params["sharded_metadata"],
+                                  params["timeseries"], params["local_cube"])
+
+    work = scenes(pending + (removed_files if params["mosaic_tiles"] else []), params)
+    checkpoint = 0
+    if params["newest_first"]:
+        priority, backfill = newest_first(work)
+        work, checkpoint = priority + backfill, len(priority)
 
     failed = []
-    for file in added_files:
+    uploader = background_uploader(params)
+    checkpoint_outputs = []
+    for index, files in enumerate(work):
+        if index == checkpoint and index > 0:
+            publish_checkpoint(params, checkpoint_outputs, uploader)
+        queued = [f for f in files if f in pending] or files
+        if state is not None and state.get("stop"):
+            for file in queued:
+                retry_queue.defer(queue, file)  # Already synced, process it in the next run
+            continue
         try:
-            functions.add_file(file, params["local_tiff"], params["local_tiff_cropped"], params["local_metadata"],
-                               params["remote_tiff"], geometry)
+            outputs = add_scene(files, params, params["local_tiff_cropped"], params["local_metadata"], geometry, options)
+            if uploader is not None:
+                uploader.submit(outputs)
+            if index < checkpoint:
+                checkpoint_outputs.append(outputs)
+            for file in queued:
+                retry_queue.record_success(queue, file)
         except Exception as e:
-            os.remove(os.path.join(params["local_tiff"], file))
             print(e)
-            failed.append(file)
+            for file in queued:
+                failed.append(file)
+                instrumentation.count("files_failed")
+                if retry_queue.record_failure(queue, file, e, params["max_attempts"], params["retry_backoff"]):
+                    print("   Quarantined after {} attempts: {}".format(params["max_attempts"], file))
+                    instrumentation.count("files_quarantined")
+    retry_queue.save_retry_queue(queue_file, queue)
 
     for file in removed_files:
         try:
-            functions.remove_file(file, params["local_metadata"])
+            functions.remove_file(file, params["local_metadata"], params["sharded_metadata"], params["timeseries"],
+                                  params["local_cube"])
         except Exception as e:
             print(e)
             failed.append(file)
 
     if params["upload"]:
-        if "metadata_summary" in params:
-            print("Checking for metadata summary updates")
-            functions.metadata_summary(params["metadata_summary"], params["metadata_name"],
-                                       os.path.abspath(params["local_metadata"]))
-
-        print("Uploading to remote")
-        functions.rclone_sync(params["local_tiff_cropped"], params["remote_tiff_cropped"])
-        functions.rclone_sync(params["local_metadata"], params["remote_metadata"], extension="*.json")
+        finish_uploads(uploader)
+        upload(params, summary=state is None or not state.get("merge_summary"))
+        if state is not None:
+            state.setdefault("uploaded", []).append(params["metadata_name"])
 
     if len(failed) > 0:
         raise ValueError("Failed for: {}".format(", ".join(failed)))
 
 
-if __name__ == "__main__":
+def product_params(params):
+    """
+    Parameters of every product of the --config file: the command line parameters, updated with the shared
+    settings of the config and then with the settings of the product. Products share the lake_geometry but
+    not their local folders or retry queue.
+    """
+    with open(params["config"], 'r') as f:
+        config = json.load(f)
+    shared = {k: v for k, v in config.items() if k != "products"}
+    products = []
+    for product in config["products"]:
+        product_params = dict(params)
+        for key, value in list(shared.items()) + list(product.items()):
+            if key not in params:
+                raise ValueError("Unknown setting in {}: {}".format(params["config"], key))
+            product_params[key] = value
+        products.append(product_params)
+    if len(set(p["lake_geometry"] for p in products)) > 1:
+        raise ValueError("All products of {} must use the same lake_geometry".format(params["config"]))
+    for key in ("local_tiff", "local_tiff_cropped", "local_metadata", "retry_queue"):
+        paths = [os.path.abspath(p[key]) for p in products if p[key]]
+        if len(set(paths)) < len(paths):
+            raise ValueError("Every product of {} needs its own {}".format(params["config"], key))
+    return products
+
+
+def run_products(params, lake_geometry="lakes.geojson", state=None):
+    """
+    Runs main for every product of the --config file in one process, sharing the lake catalogue and its mask
+    cache, and updates the metadata summary of all uploaded products at once.
+    """
+    if state is None:
+        state = {"catalogue": None, "stop": False}
+    state["merge_summary"] = True
+    state["uploaded"] = []
+    products = product_params(params)
+    failed = []
+    for product in products:
+        if state["stop"]:
+            break
+        print("Product: {}".format(product["metadata_name"]))
+        try:
+            main(product, lake_geometry, state)
+        except Exception as e:
+            print(e)
+            failed.append(product["metadata_name"])
+
+    summaries = {}
+    for product in products:
+        if product["metadata_name"] in state["uploaded"] and product["metadata_summary"]:
+            summaries.setdefault(product["metadata_summary"], {})[product["metadata_name"]] = os.path.abspath(product["local_metadata"])
+    for uri, folders in summaries.items():
+        print("Checking for metadata summary updates")
+        with instrumentation.stage("upload"):
+            functions.metadata_summaries(uri, folders)
+
+    if len(failed) > 0:
+        raise ValueError("Failed for products: {}".format(", ".join(failed)))
+
+
+def daemon(params, lake_geometry="lakes.geojson"):
+    """
+    Runs main every --interval seconds until SIGTERM or SIGINT, keeping the lake catalogue, lake masks and
+    metadata documents in memory between cycles. With --watch a cycle also starts as soon as the content of the
+    watched folder changes. On shutdown the current file is finished, files not started yet are deferred to the
+    next run and the metadata is uploaded.
+    """
+    import time
+    import signal
+    state = {"catalogue": None, "stop": False}
+
+    def request_stop(signum, frame):
+        print("Received signal {}, shutting down after the current file".format(signum))
+        state["stop"] = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    if params["mask_cache"] is None:
+        params["mask_cache"] = 256
+    functions.cache_documents(params["document_cache"])
+
+    watched = None
+    while not state["stop"]:
+        try:
+            if params["config"]:
+                run_products(params, lake_geometry, state)
+            else:
+                main(params, lake_geometry, state)
+        except Exception as e:
+            print(e)
+        run_report(params)
+        instrumentation.report.reset()
+
+        next_cycle = time.time() + params["interval"]
+        while not state["stop"] and time.time() < next_cycle:
+            time.sleep(1)
+            if params["watch"]:
+                listing = watch_listing(params["watch"])
+                if watched is not None and listing != watched:
+                    watched = listing
+                    break
+                watched = listing
+    print("Daemon stopped")
+
+
+def watch_listing(folder):
+    """Names, sizes and modification times of the files in folder, used to detect new drops."""
+    listing = set()
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            try:
+                stat = os.stat(os.path.join(root, file))
+            except FileNotFoundError:
+                continue
+            listing.add((os.path.join(root, file), stat.st_size, stat.st_mtime_ns))
+    return listing
+
+
+def argument_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--remote_tiff', '-rt', help="URI of remote tiff folder", type=str)
     parser.add_argument('--local_tiff', '-lt', help="Path of local tiff folder", type=str, default="/local_tiff")
@@ -124,9 +545,62 @@ if __name__ == "__main__":
     parser.add_argument('--reprocess', '-r', help='Reprocess full dataset', action='store_true')
     parser.add_argument('--lakes', '-n', help='Comma separated list of lakes to reprocess e.g. geneva,zurich', type=str, default=False)
     parser.add_argument('--period', '-p', help='Time period to reprocess YYYYMMDD_YYYYMMDD', type=str, default=False)
-    args = parser.parse_args()
+    parser.add_argument('--newest_first', help='Process the newest scene of every parameter and tile first and, with -u, publish its latest entries before the backfill', action='store_true')
+    parser.add_argument('--mosaic_tiles', help='Process the tiles of an acquisition together, with one mosaicked crop and metadata entry per lake', action='store_true')
+    parser.add_argument('--shard', help='With -r, only process shard i of N (i/N, i from 0) of the files or lakes, writing to --shard_dir', type=str, default=False)
+    parser.add_argument('--shard_by', help='Partition shards by file name or by lake', type=str, default="file", choices=["file", "lake"])
+    parser.add_argument('--shard_dir', help='Folder of the shard outputs, one <i>-of-<N> folder per shard', type=str, default=False)
+    parser.add_argument('--merge_shards', help='Merge the shard outputs in this folder into the local cropped file and metadata folders', type=str, default=False)
+    parser.add_argument('--no_sync', help='With -r, use the local tiff and metadata folders without syncing from the remote', action='store_true')
+    parser.add_argument('--rebuild_metadata', help='Rebuild the metadata from the cropped files without reading the scenes', action='store_true')
+    parser.add_argument('--workers', help='Worker processes for --rebuild_metadata (default: number of CPUs)', type=int, default=None)
+    parser.add_argument('--retry_queue', help='Path of failed file retry queue (default: <local_tiff>/.retry_queue.json)', type=str, default=False)
+    parser.add_argument('--max_attempts', help='Attempts before a failing file is quarantined', type=int, default=5)
+    parser.add_argument('--retry_backoff', help='Seconds before the first retry, doubled after every failure', type=int, default=3600)
+    parser.add_argument('--memory_budget', help='Stream scenes block by block using at most this many MB for pixel buffers', type=float, default=False)
+    parser.add_argument('--statistics', help='Percentile statistics: exact, or sketch (bounded relative error, mergeable)', type=str, default="exact", choices=["exact", "sketch"])
+    parser.add_argument('--sketch_accuracy', help='Relative accuracy of the sketch percentiles', type=float, default=0.001)
+    parser.add_argument('--scene_access', help='Scene access: read, or memmap (zero-copy for uncompressed scenes)', type=str, default="read", choices=["read", "memmap"])
+    parser.add_argument('--output_profile', help='Encoding of cropped files, per parameter e.g. ST=int16:0.01,CHL=lerc:0.001,deflate_predictor', type=str, default="deflate")
+    parser.add_argument('--cog', help='Write one Cloud Optimized GeoTiff with internal overviews per lake instead of full and low resolution files', action='store_true')
+    parser.add_argument('--lowres_overviews', help='Cut the low resolution files from overviews of the lake pixels built once per scene instead of resampling every crop', action='store_true')
+    parser.add_argument('--sharded_metadata', help='Store lake metadata in per-year documents with an index instead of one growing file', action='store_true')
+    parser.add_argument('--legacy_metadata', help='With --sharded_metadata, also write the legacy single file metadata views', action='store_true')
+    parser.add_argument('--timeseries', help='Also maintain a columnar time series of the statistics per lake and parameter (<parameter>_timeseries.npz)', action='store_true')
+    parser.add_argument('--local_cube', help='Path of local folder of per lake data cubes, every crop is also appended to <lake>/<parameter>.zarr', type=str, default=False)
+    parser.add_argument('--remote_cube', help='URI of remote data cube folder', type=str, default=False)
+    parser.add_argument('--config', help='JSON file with several products processed in one run, see README', type=str, default=False)
+    parser.add_argument('--daemon', help='Keep running, checking for updates every --interval seconds with warm caches', action='store_true')
+    parser.add_argument('--interval', help='Seconds between update checks in daemon mode', type=int, default=600)
+    parser.add_argument('--watch', help='In daemon mode, also check for updates as soon as the content of this folder changes', type=str, default=False)
+    parser.add_argument('--mask_cache', help='MB of rasterized lake masks kept for scenes on the same grid (default 256 in daemon mode, else 0)', type=float, default=None)
+    parser.add_argument('--document_cache', help='In daemon mode, MB of metadata documents (size on disk) kept parsed between cycles', type=float, default=64)
+    parser.add_argument('--background_upload', help='With -u, upload finished crops and metadata in the background using this many parallel transfers', type=int, default=0)
+    parser.add_argument('--report', help='Path of JSON run report with per-stage timings', type=str, default=False)
+    parser.add_argument('--profile', help='Profile add_file with cProfile and tracemalloc, writing results to this folder', type=str, default=False)
+    parser.add_argument('--profile_files', help='Comma separated list of files (relative to local tiff folder) to profile', type=str, default=False)
+    parser.add_argument('--profile_count', help='Number of local files to profile when no files are given', type=int, default=1)
+    return parser
+
+
+if __name__ == "__main__":
+    args = argument_parser().parse_args()
     params = vars(args)
-    if params["reprocess"]:
-        reprocess(params)
-    else:
-        main(params)
+    instrumentation.report.records = bool(params["report"])
+    try:
+        if params["profile"]:
+            profile(params)
+        elif params["merge_shards"]:
+            merge(params)
+        elif params["rebuild_metadata"]:
+            rebuild(params)
+        elif params["reprocess"]:
+            reprocess(params)
+        elif params["daemon"]:
+            daemon(params)
+        elif params["config"]:
+            run_products(params)
+        else:
+            main(params)
+    finally:
+        run_report(params)
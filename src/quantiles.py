@@ -0,0 +1,149 @@
+import math
+import numpy as np
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with bounded relative error (DDSketch style).
+
+    Values are counted in logarithmic buckets [gamma^(i-1), gamma^i) with gamma = (1 + alpha) / (1 - alpha),
+    separately for positive and negative values, and represented by 2 gamma^i / (gamma + 1). Every value is
+    therefore known to within a relative error of alpha.
+
+    quantile(q) interpolates between the two order statistics around rank q (n - 1) like np.percentile, so the
+    returned value v satisfies |v - exact| <= alpha * max(|x_lo|, |x_hi|), where x_lo and x_hi are those two order
+    statistics. Values with |x| < min_value are counted as zero (absolute error below min_value).
+
+    Sketches with the same alpha can be merged, so statistics can be combined across blocks, tiles and workers.
+    """
+    def __init__(self, alpha=0.001, min_value=1e-9):
+        self.alpha = alpha
+        self.min_value = min_value
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.zero = 0
+        self.positive = {}
+        self.negative = {}
+
+    def _add_store(self, store, values):
+        if values.size == 0:
+            return
+        indices, counts = np.unique(np.ceil(np.log(values) / self.log_gamma).astype(np.int64), return_counts=True)
+        for index, count in zip(indices.tolist(), counts.tolist()):
+            store[index] = store.get(index, 0) + count
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        self.count += values.size
+        self._add_store(self.positive, values[values >= self.min_value])
+        self._add_store(self.negative, -values[values <= -self.min_value])
+        self.zero += int(np.count_nonzero(np.abs(values) < self.min_value))
+
+    def merge(self, other):
+        if other.alpha != self.alpha:
+            raise ValueError("Cannot merge sketches with different accuracy ({} and {})".format(self.alpha, other.alpha))
+        self.count += other.count
+        self.zero += other.zero
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in other_store.items():
+                store[index] = store.get(index, 0) + count
+        return self
+
+    def _buckets(self):
+        """Bucket representative values in ascending order with their counts."""
+        negative = sorted(self.negative.items(), reverse=True)
+        positive = sorted(self.positive.items())
+        values = ([-2 * self.gamma ** i / (self.gamma + 1) for i, c in negative] + [0.0] +
+                  [2 * self.gamma ** i / (self.gamma + 1) for i, c in positive])
+        counts = [c for i, c in negative] + [self.zero] + [c for i, c in positive]
+        return np.array(values), np.cumsum(counts)
+
+    def quantile(self, q):
+        """Approximate q quantile (0 <= q <= 1) using the same linear interpolation as np.percentile."""
+        if self.count == 0:
+            raise ValueError("Quantile of an empty sketch")
+        values, cumulative = self._buckets()
+        rank = q * (self.count - 1)
+        lower, upper = math.floor(rank), math.ceil(rank)
+        value_lower = values[np.searchsorted(cumulative, lower, side="right")]
+        value_upper = values[np.searchsorted(cumulative, upper, side="right")]
+        return float(value_lower + (rank - lower) * (value_upper - value_lower))
+
+    def to_dict(self):
+        return {"alpha": self.alpha, "min_value": self.min_value, "count": self.count, "zero": self.zero,
+                "positive": {str(k): v for k, v in self.positive.items()},
+                "negative": {str(k): v for k, v in self.negative.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(alpha=data["alpha"], min_value=data["min_value"])
+        sketch.count = data["count"]
+        sketch.zero = data["zero"]
+        sketch.positive = {int(k): v for k, v in data["positive"].items()}
+        sketch.negative = {int(k): v for k, v in data["negative"].items()}
+        return sketch
+
+
+class LakeStatistics:
+    """
+    Accumulates the statistics of a lake from chunks of valid pixel values.
+
+    mode "exact" keeps the values and computes percentiles with np.percentile. mode "sketch" keeps only the
+    count, sum, minimum, maximum and a QuantileSketch, so memory no longer grows with the lake size and partial
+    statistics can be merged; p10 and p90 are then within the error bound documented in QuantileSketch.
+    """
+    def __init__(self, mode="exact", alpha=0.001):
+        if mode not in ("exact", "sketch"):
+            raise ValueError("Unknown statistics mode: {}".format(mode))
+        self.mode = mode
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.values = []
+        self.sketch = QuantileSketch(alpha) if mode == "sketch" else None
+
+    def add(self, values):
+        if values.size == 0:
+            return
+        self.count += values.size
+        self.sum += float(np.sum(values, dtype=np.float64))
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+        if self.mode == "exact":
+            self.values.append(values)
+        else:
+            self.sketch.add(values)
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.values.extend(other.values)
+        if self.sketch is not None:
+            self.sketch.merge(other.sketch)
+        return self
+
+    def result(self):
+        """Statistics in the form stored in the metadata, rounded to 5 decimals."""
+        if self.mode == "exact":
+            values = np.concatenate(self.values)
+            return {
+                "valid_pixels": int(values.size),
+                "min": np.round(np.min(values).astype(np.float64), 5),
+                "max": np.round(np.max(values).astype(np.float64), 5),
+                "mean": np.round(np.mean(values, dtype=np.float64), 5),
+                "p10": np.round(np.percentile(values, 10), 5),
+                "p90": np.round(np.percentile(values, 90), 5)
+            }
+        return {
+            "valid_pixels": int(self.count),
+            "min": np.round(np.float64(self.min), 5),
+            "max": np.round(np.float64(self.max), 5),
+            "mean": np.round(np.float64(self.sum / self.count), 5),
+            "p10": np.round(np.float64(min(max(self.sketch.quantile(0.1), self.min), self.max)), 5),
+            "p90": np.round(np.float64(min(max(self.sketch.quantile(0.9), self.min), self.max)), 5)
+        }
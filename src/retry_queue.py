@@ -0,0 +1,73 @@
+import os
+import json
+import time
+
+
+def load_retry_queue(path):
+    """
+    Loads the persisted retry queue.
+
+    The queue has two sections, both keyed by file (relative to the local tiff folder):
+    - retry: files that failed and are retried from the local copy once "next_attempt" has passed
+    - quarantine: files that failed max_attempts times and are no longer retried
+    """
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            queue = json.load(f)
+    else:
+        queue = {}
+    queue.setdefault("retry", {})
+    queue.setdefault("quarantine", {})
+    return queue
+
+
+def save_retry_queue(path, queue):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_file = path + ".tmp"
+    with open(temp_file, 'w') as f:
+        json.dump(queue, f, indent=1)
+    os.replace(temp_file, path)
+
+
+def due_files(queue, now=None):
+    if now is None:
+        now = time.time()
+    return sorted(f for f, entry in queue["retry"].items() if entry["next_attempt"] <= now)
+
+
+def record_failure(queue, file, error, max_attempts=5, backoff=3600, now=None):
+    """
+    Records a failed attempt for file, scheduling the next attempt with exponential backoff
+    (backoff, 2 x backoff, 4 x backoff, ... seconds). Returns True if the file was quarantined.
+    """
+    if now is None:
+        now = time.time()
+    entry = queue["retry"].pop(file, {"attempts": 0, "first_failure": now})
+    entry["attempts"] += 1
+    entry["last_attempt"] = now
+    entry["error"] = str(error)
+    if entry["attempts"] >= max_attempts:
+        entry.pop("next_attempt", None)
+        queue["quarantine"][file] = entry
+        return True
+    entry["next_attempt"] = now + backoff * 2 ** (entry["attempts"] - 1)
+    queue["retry"][file] = entry
+    return False
+
+
+def record_success(queue, file):
+    queue["retry"].pop(file, None)
+
+
+def defer(queue, file, now=None):
+    """Schedules file for the next run without counting an attempt, e.g. when shutting down before processing it."""
+    if now is None:
+        now = time.time()
+    entry = queue["retry"].setdefault(file, {"attempts": 0, "deferred": now})
+    entry["next_attempt"] = now
+
+
+def forget(queue, file):
+    """Drops file from the queue, e.g. because it changed or was removed on the remote."""
+    queue["retry"].pop(file, None)
+    queue["quarantine"].pop(file, None)
@@ -0,0 +1,59 @@
+import os
+import numpy as np
+
+# Columns of the per lake time series, in the order of the metadata records. dt is stored as datetime64[s], k is
+# kept so entries can be replaced and removed like the records of <parameter>.json.
+COLUMNS = {
+    "dt": "datetime64[s]",
+    "k": np.str_,
+    "p": np.int64,
+    "vp": np.int64,
+    "min": np.float64,
+    "max": np.float64,
+    "mean": np.float64,
+    "p10": np.float64,
+    "p90": np.float64
+}
+
+
+def parse_date(dt):
+    """Converts a metadata date (YYYYMMDDTHHMMSS) to numpy datetime64."""
+    return np.datetime64("{}-{}-{}T{}:{}:{}".format(dt[:4], dt[4:6], dt[6:8], dt[9:11], dt[11:13], dt[13:15]), "s")
+
+
+def from_records(records):
+    """Columns of a list of metadata records, sorted by date."""
+    columns = {}
+    for name, dtype in COLUMNS.items():
+        if name == "dt":
+            columns[name] = np.array([parse_date(r["dt"]) for r in records], dtype=dtype)
+        else:
+            columns[name] = np.array([r[name] for r in records], dtype=dtype)
+    return sort(columns)
+
+
+def sort(columns):
+    order = np.argsort(columns["dt"], kind="stable")
+    return {name: values[order] for name, values in columns.items()}
+
+
+def append(columns, records):
+    new = from_records(records)
+    return sort({name: np.concatenate([columns[name], new[name]]) for name in COLUMNS})
+
+
+def drop(columns, mask):
+    return {name: values[~mask] for name, values in columns.items()}
+
+
+def load(path):
+    with np.load(path, allow_pickle=False) as data:
+        return {name: data[name] for name in COLUMNS}
+
+
+def save(path, columns):
+    """Writes the columns as an uncompressed .npz, readable with numpy.load in a single small read."""
+    temp_file = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_file, 'wb') as f:
+        np.savez(f, **columns)
+    os.replace(temp_file, path)
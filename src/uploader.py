@@ -0,0 +1,182 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class BackgroundUploader:
+    """
+    Uploads finished outputs with rclone copyto while processing continues, using at most `concurrency`
+    parallel transfers.
+
+    Metadata documents are shared by all files of a lake, so they are snapshotted when submitted: a snapshot only
+    references crops submitted before it and is uploaded once all of them were uploaded, so the published metadata
+    never references a crop that is not there yet. Uploads of a document run one at a time and only its newest
+    released snapshot is uploaded. Once a crop upload of a lake fails, the later metadata of that lake is not
+    uploaded either and is left to the final sync. finish() is the barrier waiting for all transfers.
+    """
+    def __init__(self, local_tiff_cropped, remote_tiff_cropped, local_metadata, remote_metadata, concurrency=4):
+        self.targets = [(os.path.abspath(local_tiff_cropped), remote_tiff_cropped),
+                        (os.path.abspath(local_metadata), remote_metadata)]
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.queued = {}
+        self.crops = {}
+        self.broken = set()
+        self.documents = {}
+        self.snapshots = tempfile.mkdtemp(prefix="uploads_")
+        self.sequence = 0
+        self.waiting = 0
+        self.uploaded = 0
+        self.failed = []
+
+    def remote_path(self, path):
+        path = os.path.abspath(path)
+        for local, remote in self.targets:
+            if path.startswith(local + os.sep):
+                return remote.rstrip("/") + "/" + os.path.relpath(path, local).replace(os.sep, "/")
+        raise ValueError("{} is not in an output folder".format(path))
+
+    def _copy(self, path, source=None):
+        try:
+            subprocess.run(["rclone", "copyto", source or path, self.remote_path(path), "--s3-no-check-bucket"],
+                           check=True, capture_output=True)
+            with self.lock:
+                self.uploaded += 1
+        except Exception as e:
+            with self.lock:
+                self.failed.append(path)
+            raise e
+
+    def _queue(self, function, *args):
+        with self.lock:
+            future = self.executor.submit(function, *args)
+            self.pending.append(future)
+        return future
+
+    def _submit(self, path):
+        with self.lock:
+            queued = self.queued.get(path)
+            if queued is not None and not queued.running() and not queued.done():
+                return queued  # Not started yet, so it will upload the latest version
+            future = self.executor.submit(self._copy, path)
+            self.queued[path] = future
+            self.pending.append(future)
+        return future
+
+    def submit(self, outputs):
+        """Queues the outputs of add_file: {lake: {"crops": [paths], "metadata": [paths]}}."""
+        for lake, files in outputs.items():
+            crops = [self._submit(path) for path in files["crops"]]
+            with self.lock:
+                barrier = []
+                for future in self.crops.get(lake, []) + crops:
+                    if not future.done():
+                        barrier.append(future)
+                    elif future.exception() is not None:
+                        self.broken.add(lake)
+                self.crops[lake] = barrier
+            self._after(lake, barrier, [self._snapshot(path) for path in files["metadata"]])
+
+    def _snapshot(self, path):
+        """Copy of a metadata document as it is now, (path, snapshot, sequence) or None if it cannot be read."""
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+        snapshot = os.path.join(self.snapshots, "{}_{}".format(sequence, os.path.basename(path)))
+        try:
+            shutil.copyfile(path, snapshot)
+        except OSError:
+            with self.lock:
+                self.failed.append(path)
+            return None
+        return path, snapshot, sequence
+
+    def _after(self, lake, barrier, snapshots):
+        snapshots = [s for s in snapshots if s is not None]
+        with self.lock:
+            broken = lake in self.broken
+            if not broken and len(barrier) > 0:
+                self.waiting += 1
+        if broken:
+            self._discard(snapshots)
+            return
+        if len(barrier) == 0:
+            self._release(snapshots)
+            return
+        remaining = [len(barrier)]
+
+        def crop_done(future):
+            with self.lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if not ready:
+                return
+            if all(c.exception() is None for c in barrier):
+                self._release(snapshots)
+            else:
+                with self.lock:
+                    self.broken.add(lake)
+                self._discard(snapshots)
+            with self.lock:
+                self.waiting -= 1
+
+        for future in barrier:
+            future.add_done_callback(crop_done)
+
+    def _discard(self, snapshots):
+        with self.lock:
+            self.failed.extend(path for path, snapshot, sequence in snapshots)
+        for path, snapshot, sequence in snapshots:
+            os.remove(snapshot)
+
+    def _release(self, snapshots):
+        """Makes the snapshots the versions to upload unless a newer one of the same document was released."""
+        for path, snapshot, sequence in snapshots:
+            with self.lock:
+                document = self.documents.setdefault(path, {"sequence": 0, "snapshot": None, "uploading": False})
+                if sequence < document["sequence"]:
+                    superseded = snapshot
+                else:
+                    superseded = document["snapshot"]
+                    document.update(sequence=sequence, snapshot=snapshot)
+                start = not document["uploading"] and document["snapshot"] is not None
+                document["uploading"] = document["uploading"] or start
+            if superseded is not None:
+                os.remove(superseded)
+            if start:
+                self._queue(self._upload_document, path)
+
+    def _upload_document(self, path):
+        with self.lock:
+            document = self.documents[path]
+            snapshot, document["snapshot"] = document["snapshot"], None
+        try:
+            self._copy(path, snapshot)
+        finally:
+            os.remove(snapshot)
+            with self.lock:
+                document["uploading"] = document["snapshot"] is not None
+                again = document["uploading"]
+            if again:
+                self._queue(self._upload_document, path)
+
+    def finish(self):
+        """Waits for all uploads, including metadata released by finishing crops. Returns the failed paths."""
+        while True:
+            with self.lock:
+                pending = [f for f in self.pending if not f.done()]
+                waiting = self.waiting
+            if len(pending) == 0 and waiting == 0:
+                break
+            if len(pending) > 0:
+                wait(pending)
+            else:
+                time.sleep(0.01)
+        self.executor.shutdown(wait=True)
+        shutil.rmtree(self.snapshots, ignore_errors=True)
+        return self.failed
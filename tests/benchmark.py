@@ -0,0 +1,363 @@
+"""
+Benchmark the metadata pipeline on realistic, full-size synthetic scenes.
+
+Scenes are generated with conftest._create_tiff at Sentinel-2 tile size
+(10980×10980, with and without the quality mask band) together with lake
+catalogues of 1, 10 and 200 polygons of varying size and vertex count. Each
+case runs in a fresh process so that peak memory is measured per case.
+
+Usage:
+    cd /path/to/sencast-metadata
+    python tests/benchmark.py                         # full size scenes
+    python tests/benchmark.py --size 2048 --files 2   # quicker run
+    python tests/benchmark.py --save-baseline         # store results as the new baseline
+    python tests/benchmark.py --compare               # check for regressions against the baseline
+
+With --compare, results are compared against tests/fixtures/benchmark/baseline.json
+(or --baseline), which must have been recorded with the same scene size and file
+count. Any case slower or using more memory than the baseline by more than
+--tolerance exits non-zero, as does a missing or mismatching baseline.
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(TESTS_DIR, "..", "src")
+BASELINE_FILE = os.path.join(TESTS_DIR, "fixtures", "benchmark", "baseline.json")
+
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, TESTS_DIR)
+import functions  # noqa: E402
+from conftest import TIFF_ORIGIN_X, TIFF_ORIGIN_Y, _create_tiff  # noqa: E402
+
+SCENE_SIZE = 10980
+SCENE_DEGREES = 1.0
+LAKE_COUNTS = (1, 10, 200)
+REMOTE_TIFF = "s3://eawagrs/test/tiff"
+SCENE_FILENAME = "COLLECTION_ST_S2A_202405{:02d}T102031_T32TMT.tif"
+
+
+# ---------------------------------------------------------------------------
+# Synthetic inputs
+# ---------------------------------------------------------------------------
+
+def create_scene(path, size, with_mask, seed, creation_options=("TILED=YES", "COMPRESS=DEFLATE")):
+    """Smooth surface temperature field with blocky cloud cover in the quality band."""
+    rng = np.random.default_rng(seed)
+    axis = np.linspace(0, 6 * np.pi, size, dtype=np.float32)
+    values = (15 + 5 * np.sin(axis)[np.newaxis, :] * np.cos(axis)[:, np.newaxis]).astype(np.float32)
+    values += rng.normal(0, 0.1, size=(1, size)).astype(np.float32)
+    mask = None
+    if with_mask:
+        cells = rng.random((size // 512 + 1, size // 512 + 1)) > 0.7
+        mask = np.repeat(np.repeat(cells, 512, axis=0), 512, axis=1)[:size, :size].astype(np.uint8)
+    _create_tiff(path, with_mask=with_mask, values=values, mask=mask, width=size, height=size,
+                 pixel_size=SCENE_DEGREES / size, creation_options=list(creation_options))
+    return path
+
+
+def create_lakes(count, seed):
+    """
+    Lake catalogue of *count* polygons inside the scene footprint.
+
+    Polygons are noisy circles whose radius (0.2-8% of the scene) and vertex count
+    (8-4096) vary, so both the rasterization and the geometry handling are exercised.
+    """
+    rng = np.random.default_rng(seed)
+    vertices = (8, 64, 512, 4096)
+    features = []
+    for i in range(count):
+        if count == 1:
+            radius, n = 0.1, 2048
+        else:
+            radius = math.exp(rng.uniform(math.log(0.002), math.log(0.08)))
+            n = vertices[i % len(vertices)]
+        cx = rng.uniform(radius, 1 - radius)
+        cy = rng.uniform(radius, 1 - radius)
+        angles = np.linspace(0, 2 * np.pi, n, endpoint=False)
+        r = radius * (1 + 0.15 * rng.uniform(-1, 1, n))
+        xs = TIFF_ORIGIN_X + SCENE_DEGREES * (cx + r * np.cos(angles))
+        ys = TIFF_ORIGIN_Y - SCENE_DEGREES * (cy + r * np.sin(angles))
+        ring = [[float(x), float(y)] for x, y in zip(xs, ys)]
+        ring.append(ring[0])
+        features.append({
+            "type": "Feature",
+            "properties": {"key": "lake_{:03d}".format(i)},
+            "geometry": {"type": "Polygon", "coordinates": [ring]}
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+
+def prepare_inputs(work_dir, size, files):
+    inputs = {"scenes": {}, "lakes": {}, "local_tiff": os.path.join(work_dir, "local_tiff")}
+    os.makedirs(inputs["local_tiff"], exist_ok=True)
+    for with_mask in (False, True):
+        path = os.path.join(work_dir, "scene_{}.tif".format("mask" if with_mask else "nomask"))
+        print("Creating {}×{} scene: {}".format(size, size, path))
+        inputs["scenes"][with_mask] = create_scene(path, size, with_mask, seed=1)
+    path = os.path.join(work_dir, "scene_raw.tif")
+    print("Creating {}×{} uncompressed scene: {}".format(size, size, path))
+    inputs["scenes"]["raw"] = create_scene(path, size, True, seed=1, creation_options=())
+    for i in range(files):
+        path = os.path.join(inputs["local_tiff"], SCENE_FILENAME.format(i + 1))
+        print("Creating {}×{} scene: {}".format(size, size, path))
+        create_scene(path, size, True, seed=i + 2)
+    for count in LAKE_COUNTS:
+        path = os.path.join(work_dir, "lakes_{}.geojson".format(count))
+        with open(path, "w") as f:
+            json.dump(create_lakes(count, seed=count), f)
+        inputs["lakes"][count] = path
+    return inputs
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# ---------------------------------------------------------------------------
+# Cases — each returns (seconds, items, unit) for the timed section only
+# ---------------------------------------------------------------------------
+
+def case_extract(inputs, work_dir, with_mask, lakes, **options):
+    geometry = _load(inputs["lakes"][lakes])
+    output_dir = os.path.join(work_dir, "extract_{}_{}_{}".format(with_mask, lakes, "_".join(map(str, options.values()))))
+    start = time.perf_counter()
+    functions.extract_tiff_subsection(inputs["scenes"][with_mask], output_dir, geometry, **options)
+    return time.perf_counter() - start, lakes, "lakes"
+
+
+def case_add_file(inputs, work_dir, lakes):
+    geometry = _load(inputs["lakes"][lakes])
+    files = sorted(os.listdir(inputs["local_tiff"]))
+    dirs = _pipeline_dirs(work_dir, "add_file_{}".format(lakes))
+    start = time.perf_counter()
+    for file in files:
+        functions.add_file(file, inputs["local_tiff"], dirs["local_tiff_cropped"], dirs["local_metadata"],
+                           REMOTE_TIFF, geometry)
+    return time.perf_counter() - start, len(files), "files"
+
+
+def case_remove_file(inputs, work_dir, lakes):
+    source = os.path.join(work_dir, "add_file_{}".format(lakes), "local_metadata")
+    local_metadata = os.path.join(work_dir, "remove_file_{}".format(lakes))
+    shutil.copytree(source, local_metadata)
+    files = sorted(os.listdir(inputs["local_tiff"]))
+    start = time.perf_counter()
+    for file in files:
+        functions.remove_file(file, local_metadata)
+    return time.perf_counter() - start, len(files), "files"
+
+
+def case_get_latest(inputs, work_dir, records=7300, calls=200):
+    rng = np.random.default_rng(0)
+    file_list = [{"dt": "{:04d}{:02d}{:02d}T{:02d}0000".format(2000 + i // 365, 1 + (i // 28) % 12, 1 + i % 28,
+                                                             int(rng.integers(0, 24))),
+                  "vp": int(rng.integers(0, 10000)), "p": 10000} for i in range(records)]
+    start = time.perf_counter()
+    for _ in range(calls):
+        functions.get_latest(file_list)
+    return time.perf_counter() - start, calls, "calls"
+
+
+def case_reprocess(inputs, work_dir, lakes):
+    """Full reprocess loop with the remote sync and geometry download replaced by local no-ops."""
+    import main
+    dirs = _pipeline_dirs(work_dir, "reprocess_{}".format(lakes))
+    functions.rclone_sync = lambda *args, **kwargs: None
+    functions.download_file = lambda url, save_path: shutil.copy(url, save_path)
+    params = vars(main.argument_parser().parse_args([]))
+    params.update({"remote_tiff": REMOTE_TIFF, "local_tiff": inputs["local_tiff"], "lake_geometry": inputs["lakes"][lakes],
+                   "local_tiff_cropped": dirs["local_tiff_cropped"], "local_metadata": dirs["local_metadata"]})
+    files = len(os.listdir(inputs["local_tiff"]))
+    start = time.perf_counter()
+    main.reprocess(params, lake_geometry=os.path.join(work_dir, "reprocess_{}.geojson".format(lakes)))
+    return time.perf_counter() - start, files, "files"
+
+
+def case_output_profile(inputs, work_dir, profile, lakes=10):
+    """Encode time (the write stage), decode time and size of the full resolution lake crops for a profile."""
+    import instrumentation
+    from osgeo import gdal
+    geometry = _load(inputs["lakes"][lakes])
+    output_dir = os.path.join(work_dir, "profile_{}".format(profile.replace(":", "_")))
+    instrumentation.report.reset()
+    metadata = functions.extract_tiff_subsection(inputs["scenes"][True], output_dir, geometry, output_profile=profile)
+    encode = instrumentation.report.aggregate("stage")["write"]["seconds"]
+    name = os.path.splitext(os.path.basename(inputs["scenes"][True]))[0]
+    files = [os.path.join(output_dir, key, "{}_{}.tif".format(name, key)) for key in metadata]
+    start = time.perf_counter()
+    for path in files:
+        gdal.Open(path).GetRasterBand(1).ReadAsArray()
+    decode = time.perf_counter() - start
+    size_mb = sum(os.path.getsize(path) for path in files) / 1024 / 1024
+    return encode, len(files), "lakes", {"decode_seconds": round(decode, 4), "size_mb": round(size_mb, 3)}
+
+
+NOOP_CODE = ("import functions, main; "
+             "functions.rclone_sync = lambda *args, **kwargs: ([], []); "
+             "main.main(vars(main.argument_parser().parse_args(['-rt', 's3://bucket/tiff', '-lt', '.'])))")
+
+
+def case_startup(inputs, work_dir, command, runs=5):
+    """Wall time of a fresh interpreter running the CLI, e.g. `main.py -h` or the "No updates" path."""
+    start = time.perf_counter()
+    for _ in range(runs):
+        subprocess.run([sys.executable] + command, cwd=SRC_DIR, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start, runs, "runs"
+
+
+def _pipeline_dirs(work_dir, name):
+    dirs = {"local_tiff_cropped": os.path.join(work_dir, name, "local_tiff_cropped"),
+            "local_metadata": os.path.join(work_dir, name, "local_metadata")}
+    for d in dirs.values():
+        os.makedirs(d, exist_ok=True)
+    return dirs
+
+
+def cases():
+    out = []
+    for with_mask in (False, True):
+        for lakes in LAKE_COUNTS:
+            out.append(("extract_{}_{}".format("mask" if with_mask else "nomask", lakes),
+                        case_extract, {"with_mask": with_mask, "lakes": lakes}))
+    for lakes in (1, 200):
+        out.append(("extract_mask_{}_overviews".format(lakes), case_extract,
+                    {"with_mask": True, "lakes": lakes, "lowres_overviews": True}))
+    for access in ("read", "memmap"):
+        out.append(("extract_raw_{}_200".format(access), case_extract,
+                    {"with_mask": "raw", "lakes": 200, "access": access}))
+    for lakes in LAKE_COUNTS:
+        out.append(("add_file_{}".format(lakes), case_add_file, {"lakes": lakes}))
+        out.append(("remove_file_{}".format(lakes), case_remove_file, {"lakes": lakes}))
+    for profile in ("deflate", "deflate_predictor", "zstd", "lerc:0.001", "int16:0.001"):
+        out.append(("profile_" + profile.split(":")[0], case_output_profile, {"profile": profile}))
+    out.append(("get_latest", case_get_latest, {}))
+    out.append(("reprocess_10", case_reprocess, {"lakes": 10}))
+    out.append(("startup_help", case_startup, {"command": ["main.py", "-h"]}))
+    out.append(("startup_noop", case_startup, {"command": ["-c", NOOP_CODE]}))
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Runner
+# ---------------------------------------------------------------------------
+
+def _child(case, inputs, work_dir, kwargs, queue):
+    seconds, items, unit, *extra = case(inputs, work_dir, **kwargs)
+    peak_rss_mb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    queue.put({"seconds": round(seconds, 4), "items": items, "unit": unit,
+               "throughput": round(items / seconds, 4) if seconds > 0 else None,
+               "peak_rss_mb": round(peak_rss_mb, 1), **(extra[0] if extra else {})})
+
+
+def run_case(name, case, inputs, work_dir, kwargs):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_child, args=(case, inputs, work_dir, kwargs, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError("Benchmark case {} failed with exit code {}".format(name, process.exitcode))
+    return queue.get()
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ("seconds", "peak_rss_mb"):
+            if baseline[name][metric] and result[metric] > baseline[name][metric] * (1 + tolerance):
+                regressions.append("{} {}: {} > baseline {}".format(name, metric, result[metric], baseline[name][metric]))
+    return regressions
+
+
+def print_table(results, baseline):
+    print("\n{:<22} {:>10} {:>16} {:>13} {:>10}".format("case", "seconds", "throughput", "peak RSS MB", "vs base"))
+    for name, r in results.items():
+        ratio = ""
+        if name in baseline and baseline[name]["seconds"]:
+            ratio = "{:.2f}x".format(r["seconds"] / baseline[name]["seconds"])
+        print("{:<22} {:>10.3f} {:>10.2f} {:<5} {:>13.1f} {:>10}".format(
+            name, r["seconds"], r["throughput"] or 0, r["unit"] + "/s", r["peak_rss_mb"], ratio))
+    profiles = {name: r for name, r in results.items() if "size_mb" in r}
+    if profiles:
+        print("\n{:<22} {:>10} {:>10} {:>10}".format("output profile", "encode s", "decode s", "size MB"))
+        for name, r in profiles.items():
+            print("{:<22} {:>10.3f} {:>10.3f} {:>10.3f}".format(name, r["seconds"], r["decode_seconds"], r["size_mb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', help="Scene width and height in pixels", type=int, default=SCENE_SIZE)
+    parser.add_argument('--files', help="Number of scenes processed by add_file/remove_file/reprocess", type=int, default=3)
+    parser.add_argument('--cases', help="Comma separated list of cases to run (default all)", type=str, default=False)
+    parser.add_argument('--tolerance', help="Allowed relative regression against the baseline", type=float, default=0.2)
+    parser.add_argument('--save-baseline', help="Store these results as the new baseline", action='store_true')
+    parser.add_argument('--baseline', help="Baseline to compare against and save to", type=str, default=BASELINE_FILE)
+    parser.add_argument('--compare', help="Fail on regressions against the baseline", action='store_true')
+    parser.add_argument('--output', help="Write the results as JSON to this path", type=str, default=False)
+    parser.add_argument('--work-dir', help="Directory for generated scenes (default: temporary)", type=str, default=False)
+    args = parser.parse_args()
+
+    work_dir = args.work_dir if args.work_dir else tempfile.mkdtemp(prefix="sencast_benchmark_")
+    config = {"size": args.size, "files": args.files}
+    baseline = {}
+    if args.compare:
+        if not os.path.isfile(args.baseline):
+            sys.exit("No baseline at {}, record one with --save-baseline".format(args.baseline))
+        stored = _load(args.baseline)
+        if stored["config"] != config:
+            sys.exit("Baseline recorded with {}, run with the same --size/--files".format(stored["config"]))
+        baseline = stored["results"]
+
+    try:
+        inputs = prepare_inputs(work_dir, args.size, args.files)
+        selected = [c.strip() for c in args.cases.split(",")] if args.cases else None
+        results = {}
+        for name, case, kwargs in cases():
+            if selected and name not in selected:
+                continue
+            print("Running {}".format(name))
+            results[name] = run_case(name, case, inputs, work_dir, kwargs)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_table(results, baseline)
+    report = {"config": config, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print("\nSaved baseline: {}".format(args.baseline))
+    if not args.compare:
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("\nRegressions beyond {:.0%}:".format(args.tolerance))
+        for r in regressions:
+            print("  " + r)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,37 +21,42 @@ TIFF_FILENAME = "COLLECTION_ST_L8_20240512T202405_194027.tif"
 TIFF_FILENAME2 = "COLLECTION_ST_L8_20240601T102030_194027.tif"
 
 
-def _create_tiff(path, with_mask=False, mask_band_value=1, values=None):
+def _create_tiff(path, with_mask=False, mask_band_value=1, values=None, mask=None,
+                 width=TIFF_WIDTH, height=TIFF_HEIGHT, pixel_size=TIFF_PIXEL_SIZE, creation_options=None):
     """
     Create a synthetic Float32 GeoTiff at *path*.
 
     Band 1: known pixel values (arange reshaped to 100×100, scaled by 0.001)
     Band 2 (optional): quality mask — 0 everywhere except a 10×10 block
                        in rows 10-20 / cols 10-20, which is set to mask_band_value.
+
+    width, height, pixel_size, mask and creation_options allow larger scenes to be
+    generated (see tests/benchmark.py); the defaults produce the standard test raster.
     """
     driver = gdal.GetDriverByName("GTiff")
     n_bands = 2 if with_mask else 1
-    ds = driver.Create(path, TIFF_WIDTH, TIFF_HEIGHT, n_bands, gdal.GDT_Float32)
+    ds = driver.Create(path, width, height, n_bands, gdal.GDT_Float32, options=creation_options or [])
 
     srs = osr.SpatialReference()
     srs.ImportFromEPSG(4326)
     ds.SetProjection(srs.ExportToWkt())
     ds.SetGeoTransform((
-        TIFF_ORIGIN_X, TIFF_PIXEL_SIZE, 0,
-        TIFF_ORIGIN_Y, 0, -TIFF_PIXEL_SIZE,
+        TIFF_ORIGIN_X, pixel_size, 0,
+        TIFF_ORIGIN_Y, 0, -pixel_size,
     ))
 
     if values is None:
-        values = np.arange(TIFF_WIDTH * TIFF_HEIGHT, dtype=np.float32).reshape(
-            TIFF_HEIGHT, TIFF_WIDTH
+        values = np.arange(width * height, dtype=np.float32).reshape(
+            height, width
         ) * 0.001
     ds.GetRasterBand(1).WriteArray(values)
 
     if with_mask:
-        mask = np.zeros((TIFF_HEIGHT, TIFF_WIDTH), dtype=np.uint8)
-        # Mask block at rows 35-45, cols 35-45 — inside the test_lake polygon area
-        # (lake covers rows 25-75, cols 25-75 of this raster)
-        mask[35:45, 35:45] = mask_band_value
+        if mask is None:
+            mask = np.zeros((height, width), dtype=np.uint8)
+            # Mask block at rows 35-45, cols 35-45 — inside the test_lake polygon area
+            # (lake covers rows 25-75, cols 25-75 of this raster)
+            mask[35:45, 35:45] = mask_band_value
         ds.GetRasterBand(2).WriteArray(mask)
 
     ds.FlushCache()
@@ -59,6 +64,21 @@ def _create_tiff(path, with_mask=False, mask_band_value=1, values=None):
     return path
 
 
+def _scene(date, vp=50, name="COLLECTION_ST_L8_{}_194027.tif", lake="test_lake"):
+    """File name, metadata record and public record of a scene acquired at date (YYYYMMDDTHHMMSS)."""
+    file = name.format(date)
+    record = {"dt": date, "k": file.replace(".tif", "_{}.tif".format(lake)), "p": 100, "vp": vp, "min": 1.0,
+              "max": 2.0, "mean": 1.5, "p10": 1.1, "p90": 1.9, "c": "abc", "r": "cmd"}
+    public = {"datetime": date, "name": file, "url": "https://example.com/" + file, "valid_pixels": "{}%".format(vp)}
+    return file, record, public
+
+
+def _read(*path):
+    """Content of a JSON document."""
+    with open(os.path.join(*path)) as f:
+        return json.load(f)
+
+
 @pytest.fixture(scope="session")
 def synthetic_tiff(tmp_path_factory):
     """Standard synthetic TIFF — no mask band."""
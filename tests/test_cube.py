@@ -0,0 +1,67 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from cube import LakeCube
+
+GEOTRANSFORM = (8.0, 0.001, 0.0, 47.0, 0.0, -0.001)
+
+
+def _crop(value, shape=(70, 90)):
+    values = np.full(shape, value, dtype=np.float32)
+    values[0, 0] = np.nan
+    return values
+
+
+class TestLakeCube:
+    def test_append_and_read(self, tmp_path):
+        cube = LakeCube(str(tmp_path / "ST.zarr"), chunks=(4, 32, 32))
+        for i in range(6):
+            cube.append("scene_{}.tif".format(i), "2024051{}T101010".format(i), _crop(i), "WKT", GEOTRANSFORM)
+
+        cube = LakeCube(str(tmp_path / "ST.zarr"))
+        assert cube.files == ["scene_{}.tif".format(i) for i in range(6)]
+        assert cube.grid() == ("WKT", GEOTRANSFORM, (70, 90))
+        np.testing.assert_array_equal(cube.read(5), _crop(5))
+        np.testing.assert_array_equal(cube.pixel(69, 89), np.arange(6, dtype=np.float32))
+        assert np.isnan(cube.pixel(0, 0)).all()
+        assert str(cube.times()[2]) == "2024-05-12T10:10:10"
+
+    def test_zarr_metadata(self, tmp_path):
+        cube = LakeCube(str(tmp_path / "ST.zarr"), chunks=(4, 32, 32))
+        cube.append("scene.tif", "20240512T101010", _crop(1), "WKT", GEOTRANSFORM)
+        with open(str(tmp_path / "ST.zarr" / "data" / ".zarray")) as f:
+            zarray = json.load(f)
+        assert zarray["shape"] == [1, 70, 90]
+        assert zarray["chunks"] == [4, 32, 32]
+        assert zarray["compressor"]["id"] == "zlib"
+        assert os.path.isfile(str(tmp_path / "ST.zarr" / "data" / "0.2.2"))
+        assert os.path.isfile(str(tmp_path / "ST.zarr" / ".zgroup"))
+
+    def test_readd_overwrites_time_step(self, tmp_path):
+        cube = LakeCube(str(tmp_path / "ST.zarr"))
+        cube.append("scene.tif", "20240512T101010", _crop(1), "WKT", GEOTRANSFORM)
+        cube.append("scene.tif", "20240512T101010", _crop(2), "WKT", GEOTRANSFORM)
+        assert LakeCube(str(tmp_path / "ST.zarr")).pixel(5, 5).tolist() == [2.0]
+
+    def test_remove_clears_time_step(self, tmp_path):
+        cube = LakeCube(str(tmp_path / "ST.zarr"))
+        cube.append("a.tif", "20240512T101010", _crop(1), "WKT", GEOTRANSFORM)
+        cube.append("b.tif", "20240513T101010", _crop(2), "WKT", GEOTRANSFORM)
+        assert cube.remove("a.tif")
+        assert not cube.remove("a.tif")
+        cube = LakeCube(str(tmp_path / "ST.zarr"))
+        assert cube.files == [None, "b.tif"]
+        assert np.isnan(cube.read(0)).all()
+        np.testing.assert_array_equal(cube.read(1), _crop(2))
+
+    def test_shape_mismatch(self, tmp_path):
+        cube = LakeCube(str(tmp_path / "ST.zarr"))
+        cube.append("a.tif", "20240512T101010", _crop(1), "WKT", GEOTRANSFORM)
+        with pytest.raises(ValueError):
+            cube.append("b.tif", "20240513T101010", _crop(1, (10, 10)), "WKT", GEOTRANSFORM)
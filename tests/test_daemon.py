@@ -0,0 +1,139 @@
+import json
+import os
+import signal
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import functions
+import instrumentation
+import main
+import retry_queue
+from conftest import _scene
+
+
+@pytest.fixture
+def params(tmp_path):
+    params = vars(main.argument_parser().parse_args([
+        "--daemon", "--interval", "0", "--remote_tiff", "s3://bucket/tiff",
+        "--local_tiff", str(tmp_path / "tiff"), "--local_metadata", str(tmp_path / "metadata")]))
+    os.makedirs(params["local_tiff"])
+    return params
+
+
+@pytest.fixture
+def daemon_globals():
+    handlers = {s: signal.getsignal(s) for s in (signal.SIGTERM, signal.SIGINT)}
+    yield
+    for s, handler in handlers.items():
+        signal.signal(s, handler)
+    functions.cache_documents(False)
+
+
+class TestDaemon:
+    def test_stops_on_sigterm(self, params, monkeypatch, daemon_globals):
+        cycles = []
+
+        def cycle(params, lake_geometry, state):
+            cycles.append(state)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        monkeypatch.setattr(main, "main", cycle)
+        main.daemon(params)
+        assert len(cycles) == 1
+        assert cycles[0]["stop"]
+        assert params["mask_cache"] == 256
+
+    def test_warm_state_is_reused(self, params, monkeypatch, daemon_globals):
+        states = []
+
+        def cycle(params, lake_geometry, state):
+            states.append(state)
+            if len(states) == 3:
+                state["stop"] = True
+
+        monkeypatch.setattr(main, "main", cycle)
+        main.daemon(params)
+        assert len(states) == 3
+        assert states[0] is states[2]
+
+    def test_final_report_keeps_last_cycle(self, params, tmp_path, monkeypatch, daemon_globals):
+        params["report"] = str(tmp_path / "report.json")
+
+        def cycle(params, lake_geometry, state):
+            with instrumentation.stage("listing"):
+                pass
+            state["stop"] = True
+
+        monkeypatch.setattr(main, "main", cycle)
+        main.daemon(params)
+        main.run_report(params)
+        with open(params["report"]) as f:
+            assert "listing" in json.load(f)["by_stage"]
+
+    def test_shutdown_defers_files_not_started(self, params, monkeypatch):
+        def rclone_sync(remote, local_dir, dry_run=False, extension="*.tif"):
+            if dry_run:
+                return ["a.tif", "b.tif"], []
+
+        added = []
+
+        def add_file(file, *args):
+            added.append(file)
+            state["stop"] = True
+
+        monkeypatch.setattr(functions, "rclone_sync", rclone_sync)
+        monkeypatch.setattr(functions, "add_file", add_file)
+        state = {"catalogue": object(), "stop": False}
+        main.main(params, state=state)
+        assert added == ["a.tif"]
+        queue = retry_queue.load_retry_queue(os.path.join(params["local_tiff"], ".retry_queue.json"))
+        assert list(queue["retry"].keys()) == ["b.tif"]
+        assert queue["retry"]["b.tif"]["attempts"] == 0
+
+    def test_watch_listing_detects_drops(self, tmp_path):
+        before = main.watch_listing(str(tmp_path))
+        (tmp_path / "scene.tif").write_bytes(b"x")
+        assert main.watch_listing(str(tmp_path)) != before
+
+
+class TestDocumentCache:
+    def test_cached_until_changed(self, tmp_path, daemon_globals):
+        path = str(tmp_path / "ST.json")
+        functions.cache_documents()
+        functions.write_json(path, [1])
+        first = functions.read_json(path, [])
+        assert functions.read_json(path, []) is first
+        with open(path, "w") as f:
+            f.write("[1, 2]")
+        assert functions.read_json(path, []) == [1, 2]
+
+    def test_least_recently_used_dropped(self, tmp_path, daemon_globals):
+        functions.cache_documents(2.5 / 1024)
+        paths = [str(tmp_path / "{}.json".format(i)) for i in range(3)]
+        for path in paths[:2]:
+            functions.write_json(path, ["x" * 1000])
+        functions.read_json(paths[0], None)
+        functions.write_json(paths[2], ["x" * 1000])
+        assert list(functions._documents.keys()) == [paths[0], paths[2]]
+
+    def test_failed_index_write_keeps_cache(self, tmp_path, daemon_globals, monkeypatch):
+        functions.cache_documents()
+        file, record, public = _scene("20240601T102030")
+        functions.add_metadata_entry(str(tmp_path), "test_lake", "ST", file, record, public, sharded=True)
+        index_path = functions.shard_index_path(str(tmp_path / "test_lake" / "ST"))
+        before = json.loads(json.dumps(functions.read_json(index_path, None)))
+        write_json = functions.write_json
+
+        def failing_write(path, data):
+            if path == index_path:
+                raise OSError("disk full")
+            write_json(path, data)
+
+        monkeypatch.setattr(functions, "write_json", failing_write)
+        file, record, public = _scene("20230105T101010")
+        with pytest.raises(OSError):
+            functions.add_metadata_entry(str(tmp_path), "test_lake", "ST", file, record, public, sharded=True)
+        assert functions.read_json(index_path, None) == before
@@ -0,0 +1,82 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from instrumentation import RunReport
+
+
+class TestRunReport:
+    def test_stage_records_file_and_lake(self):
+        report = RunReport(records=True)
+        with report.stage("stats", file="scene.tif", lake="geneva"):
+            pass
+        assert len(report.stages) == 1
+        entry = report.stages[0]
+        assert entry["stage"] == "stats"
+        assert entry["file"] == "scene.tif"
+        assert entry["lake"] == "geneva"
+        assert entry["seconds"] >= 0
+        assert entry["peak_rss_mb"] > 0
+
+    def test_stage_recorded_on_exception(self):
+        report = RunReport(records=True)
+        with pytest.raises(ValueError):
+            with report.stage("write", file="scene.tif"):
+                raise ValueError("failed")
+        assert report.stages[0]["stage"] == "write"
+
+    def test_aggregates_by_stage_file_and_lake(self):
+        report = RunReport()
+        for lake in ("geneva", "zurich"):
+            with report.stage("masking", file="a.tif", lake=lake):
+                pass
+        with report.stage("upload"):
+            pass
+        summary = report.to_dict()
+        assert summary["by_stage"]["masking"]["count"] == 2
+        assert summary["by_stage"]["upload"]["count"] == 1
+        assert summary["by_file"]["a.tif"]["count"] == 2
+        assert set(summary["by_lake"].keys()) == {"geneva", "zurich"}
+
+    def test_counters(self):
+        report = RunReport()
+        report.count("files_added")
+        report.count("files_added", 2)
+        assert report.to_dict()["counters"] == {"files_added": 3}
+
+    def test_write_json(self, tmp_path):
+        report = RunReport()
+        with report.stage("listing"):
+            pass
+        path = str(tmp_path / "report.json")
+        report.write(path)
+        with open(path) as f:
+            data = json.load(f)
+        for key in ("started", "duration_seconds", "peak_rss_mb", "counters", "by_stage", "by_file", "by_lake", "stages"):
+            assert key in data
+
+    def test_reset_clears_stages(self):
+        report = RunReport(records=True)
+        with report.stage("listing"):
+            pass
+        report.count("files_added")
+        report.reset()
+        assert report.stages == []
+        assert report.counters == {}
+        assert report.to_dict()["by_stage"] == {}
+        assert report.empty()
+
+    def test_only_aggregates_kept_without_records(self):
+        report = RunReport()
+        for index in range(1000):
+            with report.stage("masking", file="{}.tif".format(index % 10), lake="geneva"):
+                pass
+        assert report.stages == []
+        summary = report.to_dict()
+        assert summary["by_stage"]["masking"]["count"] == 1000
+        assert len(summary["by_file"]) == 10
+        assert summary["by_lake"]["geneva"]["max_seconds"] >= 0
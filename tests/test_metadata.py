@@ -2,13 +2,17 @@ import json
 import os
 import shutil
 import sys
+import tempfile
 
 import pytest
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
 
-from functions import add_file, remove_file
-from conftest import TIFF_FILENAME, TIFF_FILENAME2
+from functions import (add_file, add_tiles, remove_file, add_metadata_entry, write_legacy_metadata, lake_parameters,
+                       rebuild_metadata, metadata_lock)
+from conftest import TIFF_FILENAME, TIFF_FILENAME2, _read, _scene
+import functions
+import main
 
 FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
 REMOTE_TIFF = "s3://eawagrs/test/tiff"
@@ -96,6 +100,42 @@ class TestAddFile:
             data = json.load(f)
         assert len(data) == 1
 
+    def test_idempotent_public_no_duplicate(self, synthetic_tiff, tiff_dirs):
+        filename = _copy_tiff(synthetic_tiff, tiff_dirs["local_tiff"])
+        geojson = _load_geojson()
+        for _ in range(2):
+            add_file(filename, tiff_dirs["local_tiff"], tiff_dirs["local_tiff_cropped"],
+                     tiff_dirs["local_metadata"], REMOTE_TIFF, geojson)
+
+        with open(os.path.join(tiff_dirs["local_metadata"], "test_lake", "ST_public.json")) as f:
+            data = json.load(f)
+        assert len(data) == 1
+
+    def test_cog_replaces_existing_entry(self, synthetic_tiff, tiff_dirs):
+        """Switching output mode keeps one entry per scene, pointing at the COG file."""
+        filename = _copy_tiff(synthetic_tiff, tiff_dirs["local_tiff"])
+        geojson = _load_geojson()
+        add_file(filename, tiff_dirs["local_tiff"], tiff_dirs["local_tiff_cropped"],
+                 tiff_dirs["local_metadata"], REMOTE_TIFF, geojson)
+        add_file(filename, tiff_dirs["local_tiff"], tiff_dirs["local_tiff_cropped"],
+                 tiff_dirs["local_metadata"], REMOTE_TIFF, geojson, {"cog": True})
+
+        with open(os.path.join(tiff_dirs["local_metadata"], "test_lake", "ST.json")) as f:
+            data = json.load(f)
+        assert len(data) == 1
+        assert data[0]["k"] == "COLLECTION_ST_L8_20240512T202405_194027_test_lake.tif"
+
+    def test_returns_written_files(self, synthetic_tiff, tiff_dirs):
+        filename = _copy_tiff(synthetic_tiff, tiff_dirs["local_tiff"])
+        outputs = add_file(filename, tiff_dirs["local_tiff"], tiff_dirs["local_tiff_cropped"],
+                           tiff_dirs["local_metadata"], REMOTE_TIFF, _load_geojson())
+        assert list(outputs.keys()) == ["test_lake"]
+        assert os.path.join(tiff_dirs["local_tiff_cropped"], "test_lake",
+                            "COLLECTION_ST_L8_20240512T202405_194027_test_lake.tif") in outputs["test_lake"]["crops"]
+        assert sorted(os.path.basename(f) for f in outputs["test_lake"]["metadata"]) == \
+            ["ST.json", "ST_latest.json", "ST_public.json"]
+        assert all(os.path.isfile(f) for f in outputs["test_lake"]["crops"] + outputs["test_lake"]["metadata"])
+
     def test_appends_second_date(self, synthetic_tiff, synthetic_tiff2, tiff_dirs):
         """Two TIFFs with different dates → two entries in ST.json."""
         geojson = _load_geojson()
@@ -155,6 +195,315 @@ class TestRemoveFile:
         assert data[0]["dt"] == "20240512T202405"
 
 
+# ---------------------------------------------------------------------------
+# Sharded metadata
+# ---------------------------------------------------------------------------
+
+SCENES = ["20221231T101010", "20230105T101010", "20230601T101010", "20240512T202405"]
+
+
+class TestShardedMetadata:
+    def _add(self, local_metadata, dates, sharded):
+        for date in dates:
+            file, record, public = _scene(date)
+            add_metadata_entry(local_metadata, "test_lake", "ST", file, record, public, sharded=sharded)
+
+    def test_writes_year_shards_and_index(self, tmp_path):
+        self._add(str(tmp_path), SCENES, True)
+        shard_dir = os.path.join(str(tmp_path), "test_lake", "ST")
+        assert [r["dt"] for r in _read(shard_dir, "2023.json")] == SCENES[1:3]
+        assert len(_read(shard_dir, "2023_public.json")) == 2
+        index = _read(shard_dir, "index.json")
+        assert sorted(index["shards"].keys()) == ["2022", "2023", "2024"]
+        assert index["shards"]["2023"] == {"records": 2, "first": SCENES[1], "last": SCENES[2]}
+        assert index["latest"]["dt"] == SCENES[3]
+        assert _read(str(tmp_path), "test_lake", "ST_latest.json") == index["latest"]
+        assert not os.path.isfile(os.path.join(str(tmp_path), "test_lake", "ST.json"))
+
+    def test_append_only_rewrites_current_year(self, tmp_path):
+        self._add(str(tmp_path), SCENES[:3], True)
+        old_shard = os.path.join(str(tmp_path), "test_lake", "ST", "2022.json")
+        os.utime(old_shard, (0, 0))
+        self._add(str(tmp_path), SCENES[3:], True)
+        assert os.path.getmtime(old_shard) == 0
+
+    def test_latest_falls_back_to_previous_year(self, tmp_path):
+        self._add(str(tmp_path), SCENES[:3], True)
+        file, record, public = _scene("20240101T101010", vp=5)
+        add_metadata_entry(str(tmp_path), "test_lake", "ST", file, record, public, sharded=True)
+        assert _read(str(tmp_path), "test_lake", "ST_latest.json")["dt"] == SCENES[2]
+
+    def test_legacy_views_match_legacy_layout(self, tmp_path):
+        legacy, sharded = str(tmp_path / "legacy"), str(tmp_path / "sharded")
+        self._add(legacy, SCENES, False)
+        self._add(sharded, SCENES, True)
+        write_legacy_metadata(sharded)
+        for name in ("ST.json", "ST_public.json", "ST_latest.json"):
+            assert _read(sharded, "test_lake", name) == _read(legacy, "test_lake", name)
+
+    def test_migrates_legacy_documents(self, tmp_path):
+        self._add(str(tmp_path), SCENES[:3], False)
+        self._add(str(tmp_path), SCENES[3:], True)
+        index = _read(str(tmp_path), "test_lake", "ST", "index.json")
+        assert sorted(index["shards"].keys()) == ["2022", "2023", "2024"]
+        assert len(_read(str(tmp_path), "test_lake", "ST", "2023.json")) == 2
+
+    def test_migration_removes_legacy_documents(self, tmp_path):
+        self._add(str(tmp_path), SCENES[:3], False)
+        self._add(str(tmp_path), SCENES[3:], True)
+        assert sorted(os.listdir(str(tmp_path / "test_lake"))) == ["ST", "ST_latest.json"]
+
+    def test_legacy_views_removed_when_no_longer_written(self, tmp_path):
+        self._add(str(tmp_path), SCENES, True)
+        write_legacy_metadata(str(tmp_path))
+        functions.remove_legacy_metadata(str(tmp_path))
+        assert not os.path.isfile(os.path.join(str(tmp_path), "test_lake", "ST.json"))
+        assert not os.path.isfile(os.path.join(str(tmp_path), "test_lake", "ST_public.json"))
+        assert len(functions.lake_records(os.path.join(str(tmp_path), "test_lake", "ST"))) == len(SCENES)
+
+    def test_remove_updates_shard_and_latest(self, tmp_path):
+        self._add(str(tmp_path), SCENES, True)
+        remove_file(_scene(SCENES[3])[0], str(tmp_path), sharded=True)
+        shard_dir = os.path.join(str(tmp_path), "test_lake", "ST")
+        assert _read(shard_dir, "2024.json") == []
+        assert _read(shard_dir, "2024_public.json") == []
+        assert _read(shard_dir, "index.json")["shards"]["2024"]["records"] == 0
+        assert _read(str(tmp_path), "test_lake", "ST_latest.json")["dt"] == SCENES[2]
+
+    def test_add_file_sharded(self, synthetic_tiff, tiff_dirs):
+        filename = _copy_tiff(synthetic_tiff, tiff_dirs["local_tiff"])
+        add_file(filename, tiff_dirs["local_tiff"], tiff_dirs["local_tiff_cropped"],
+                 tiff_dirs["local_metadata"], REMOTE_TIFF, _load_geojson(), {"sharded_metadata": True})
+        data = _read(tiff_dirs["local_metadata"], "test_lake", "ST", "2024.json")
+        assert len(data) == 1
+        assert _read(tiff_dirs["local_metadata"], "test_lake", "ST_latest.json")["dt"] == "20240512T202405"
+
+    def test_lake_parameters(self, tmp_path):
+        self._add(str(tmp_path), SCENES, True)
+        lake_dir = os.path.join(str(tmp_path), "test_lake")
+        os.makedirs(os.path.join(lake_dir, "notes"))
+        for name in ("CHL.json", "CHL_public.json", "CHL_latest.json", "README.txt"):
+            open(os.path.join(lake_dir, name), "w").close()
+        assert lake_parameters(lake_dir) == ["CHL", "ST"]
+
+
+# ---------------------------------------------------------------------------
+# Concurrent instances
+# ---------------------------------------------------------------------------
+
+def _add_scenes(args):
+    local_metadata, worker, sharded = args
+    for i in range(25):
+        file, record, public = _scene("2024{:02d}{:02d}T10{:02d}{:02d}".format(worker + 1, i + 1, worker, i))
+        with metadata_lock(local_metadata, "test_lake", "ST"):
+            add_metadata_entry(local_metadata, "test_lake", "ST", file, record, public, sharded=sharded)
+
+
+class TestConcurrentInstances:
+    @pytest.mark.parametrize("sharded", [False, True])
+    def test_parallel_processes_keep_all_entries(self, tmp_path, sharded):
+        from multiprocessing import Pool
+        with Pool(4) as pool:
+            pool.map(_add_scenes, [(str(tmp_path), worker, sharded) for worker in range(4)])
+        if sharded:
+            write_legacy_metadata(str(tmp_path))
+        assert len(_read(str(tmp_path), "test_lake", "ST.json")) == 100
+        assert len(_read(str(tmp_path), "test_lake", "ST_public.json")) == 100
+        assert _read(str(tmp_path), "test_lake", "ST_latest.json")["dt"] == "20240425T100324"
+        assert not any(f.endswith(".tmp") for root, dirs, files in os.walk(str(tmp_path)) for f in files)
+
+
+# ---------------------------------------------------------------------------
+# Rebuild from cropped files
+# ---------------------------------------------------------------------------
+
+class TestRebuildMetadata:
+    def _process(self, tiffs, tiff_dirs, options=None):
+        geojson = _load_geojson()
+        for src in tiffs:
+            filename = _copy_tiff(src, tiff_dirs["local_tiff"])
+            add_file(filename, tiff_dirs["local_tiff"], tiff_dirs["local_tiff_cropped"],
+                     tiff_dirs["local_metadata"], REMOTE_TIFF, geojson, options)
+        return geojson
+
+    def _documents(self, local_metadata):
+        return {name: _read(local_metadata, "test_lake", name) for name in ("ST.json", "ST_public.json", "ST_latest.json")}
+
+    def test_rebuild_matches_processing(self, synthetic_tiff, synthetic_tiff2, tiff_dirs):
+        geojson = self._process((synthetic_tiff, synthetic_tiff2), tiff_dirs)
+        expected = self._documents(tiff_dirs["local_metadata"])
+        shutil.rmtree(tiff_dirs["local_metadata"])
+        rebuild_metadata(tiff_dirs["local_tiff_cropped"], tiff_dirs["local_metadata"], tiff_dirs["local_tiff"],
+                         REMOTE_TIFF, geojson, workers=2)
+        assert self._documents(tiff_dirs["local_metadata"]) == expected
+
+    def test_rebuild_replaces_stale_entries(self, synthetic_tiff, tiff_dirs):
+        geojson = self._process((synthetic_tiff,), tiff_dirs)
+        expected = self._documents(tiff_dirs["local_metadata"])
+        file, record, public = _scene("20200101T101010")
+        add_metadata_entry(tiff_dirs["local_metadata"], "test_lake", "ST", file, record, public)
+        rebuild_metadata(tiff_dirs["local_tiff_cropped"], tiff_dirs["local_metadata"], tiff_dirs["local_tiff"],
+                         REMOTE_TIFF, geojson, workers=1)
+        assert self._documents(tiff_dirs["local_metadata"]) == expected
+
+    def test_commit_hash_read_from_crop(self, tmp_path, tiff_dirs):
+        from osgeo import gdal
+        from conftest import _create_tiff
+        path = str(tmp_path / TIFF_FILENAME)
+        _create_tiff(path)
+        ds = gdal.Open(path, gdal.GA_Update)
+        ds.SetMetadata({"Commit Hash": "abc123", "Reproduce": "python main.py"})
+        ds = None
+        geojson = self._process((path,), tiff_dirs)
+        shutil.rmtree(tiff_dirs["local_metadata"])
+        rebuild_metadata(tiff_dirs["local_tiff_cropped"], tiff_dirs["local_metadata"], tiff_dirs["local_tiff"],
+                         REMOTE_TIFF, geojson, workers=1)
+        entry = _read(tiff_dirs["local_metadata"], "test_lake", "ST.json")[0]
+        assert entry["c"] == "abc123"
+        assert entry["r"] == "python main.py"
+
+    def test_rebuild_keeps_untagged_record_fields(self, synthetic_tiff, tiff_dirs):
+        geojson = self._process((synthetic_tiff,), tiff_dirs)
+        date = _read(tiff_dirs["local_metadata"], "test_lake", "ST.json")[0]["dt"]
+        file, record, public = _scene(date)
+        record["k"] = _read(tiff_dirs["local_metadata"], "test_lake", "ST.json")[0]["k"]
+        public["url"] = "https://example.com/2024/" + file
+        shutil.rmtree(os.path.join(tiff_dirs["local_metadata"], "test_lake"))
+        add_metadata_entry(tiff_dirs["local_metadata"], "test_lake", "ST", file, record, public)
+        os.remove(os.path.join(tiff_dirs["local_tiff"], file))
+        rebuild_metadata(tiff_dirs["local_tiff_cropped"], tiff_dirs["local_metadata"], tiff_dirs["local_tiff"],
+                         REMOTE_TIFF, geojson, workers=1)
+        entry = _read(tiff_dirs["local_metadata"], "test_lake", "ST.json")[0]
+        assert (entry["c"], entry["r"]) == ("abc", "cmd")
+        assert _read(tiff_dirs["local_metadata"], "test_lake", "ST_public.json")[0]["url"] == public["url"]
+
+    def test_rebuild_sharded(self, synthetic_tiff, synthetic_tiff2, tiff_dirs):
+        geojson = self._process((synthetic_tiff, synthetic_tiff2), tiff_dirs)
+        expected = self._documents(tiff_dirs["local_metadata"])
+        shutil.rmtree(tiff_dirs["local_metadata"])
+        rebuild_metadata(tiff_dirs["local_tiff_cropped"], tiff_dirs["local_metadata"], tiff_dirs["local_tiff"],
+                         REMOTE_TIFF, geojson, workers=1, sharded=True)
+        assert _read(tiff_dirs["local_metadata"], "test_lake", "ST", "2024.json") == expected["ST.json"]
+        assert _read(tiff_dirs["local_metadata"], "test_lake", "ST_latest.json") == expected["ST_latest.json"]
+
+
+# ---------------------------------------------------------------------------
+# Tile mosaics
+# ---------------------------------------------------------------------------
+
+TILE_A = "COLLECTION_ST_L8_20240512T202405_T32TLT.tif"
+TILE_B = "COLLECTION_ST_L8_20240512T202405_T32TMT.tif"
+STATISTICS = ("p", "vp", "min", "max", "mean", "p10", "p90")
+
+
+def _create_tile(path, values, first_column):
+    """Tile of the standard synthetic raster made of values (its columns from first_column on)."""
+    from osgeo import gdal, osr
+    from conftest import TIFF_ORIGIN_X, TIFF_ORIGIN_Y, TIFF_PIXEL_SIZE
+    ds = gdal.GetDriverByName("GTiff").Create(path, values.shape[1], values.shape[0], 1, gdal.GDT_Float32)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.SetGeoTransform((TIFF_ORIGIN_X + first_column * TIFF_PIXEL_SIZE, TIFF_PIXEL_SIZE, 0, TIFF_ORIGIN_Y, 0, -TIFF_PIXEL_SIZE))
+    ds.GetRasterBand(1).WriteArray(values)
+    ds = None
+
+
+class TestMosaicTiles:
+    def _expected(self, synthetic_tiff, tmp_path):
+        dirs = {name: str(tmp_path / "scene" / name) for name in ("tiff", "cropped", "metadata")}
+        os.makedirs(dirs["tiff"])
+        filename = _copy_tiff(synthetic_tiff, dirs["tiff"])
+        add_file(filename, dirs["tiff"], dirs["cropped"], dirs["metadata"], REMOTE_TIFF, _load_geojson())
+        return _read(dirs["metadata"], "test_lake", "ST.json")[0]
+
+    def _values(self):
+        import numpy as np
+        return np.arange(100 * 100, dtype=np.float32).reshape(100, 100) * 0.001
+
+    def test_matches_single_scene(self, synthetic_tiff, tiff_dirs, tmp_path):
+        values = self._values()
+        _create_tile(os.path.join(tiff_dirs["local_tiff"], TILE_A), values[:, :50], 0)
+        _create_tile(os.path.join(tiff_dirs["local_tiff"], TILE_B), values[:, 50:], 50)
+        outputs = add_tiles([TILE_A, TILE_B], tiff_dirs["local_tiff"], tiff_dirs["local_tiff_cropped"],
+                            tiff_dirs["local_metadata"], REMOTE_TIFF, _load_geojson())
+        records = _read(tiff_dirs["local_metadata"], "test_lake", "ST.json")
+        expected = self._expected(synthetic_tiff, tmp_path)
+        assert len(records) == 1
+        assert records[0]["k"] == "COLLECTION_ST_L8_20240512T202405_test_lake.tif"
+        assert {k: records[0][k] for k in STATISTICS} == {k: expected[k] for k in STATISTICS}
+        assert _read(tiff_dirs["local_metadata"], "test_lake", "ST_public.json")[0]["name"] == \
+            "COLLECTION_ST_L8_20240512T202405.tif"
+        assert os.listdir(os.path.join(tiff_dirs["local_tiff_cropped"], "test_lake")) == [records[0]["k"]]
+        assert outputs["test_lake"]["crops"] == [os.path.join(tiff_dirs["local_tiff_cropped"], "test_lake", records[0]["k"])]
+        assert not [f for f in os.listdir(tempfile.gettempdir()) if f.startswith("tiles_")]
+
+    def test_overlap_prefers_valid_pixels(self, synthetic_tiff, tiff_dirs, tmp_path):
+        import numpy as np
+        values = self._values()
+        cloudy = values[:, :60].copy()
+        cloudy[:, 40:] = np.nan
+        _create_tile(os.path.join(tiff_dirs["local_tiff"], TILE_A), cloudy, 0)
+        _create_tile(os.path.join(tiff_dirs["local_tiff"], TILE_B), values[:, 40:], 40)
+        add_tiles([TILE_A, TILE_B], tiff_dirs["local_tiff"], tiff_dirs["local_tiff_cropped"],
+                  tiff_dirs["local_metadata"], REMOTE_TIFF, _load_geojson())
+        record = _read(tiff_dirs["local_metadata"], "test_lake", "ST.json")[0]
+        expected = self._expected(synthetic_tiff, tmp_path)
+        assert {k: record[k] for k in STATISTICS} == {k: expected[k] for k in STATISTICS}
+        assert _read(tiff_dirs["local_metadata"], "test_lake", "ST_public.json")[0]["url"].endswith(TILE_B)
+
+    def test_replaces_tile_entries(self, tiff_dirs):
+        values = self._values()
+        _create_tile(os.path.join(tiff_dirs["local_tiff"], TILE_A), values[:, :50], 0)
+        _create_tile(os.path.join(tiff_dirs["local_tiff"], TILE_B), values[:, 50:], 50)
+        add_file(TILE_A, tiff_dirs["local_tiff"], tiff_dirs["local_tiff_cropped"], tiff_dirs["local_metadata"],
+                 REMOTE_TIFF, _load_geojson())
+        add_tiles([TILE_A, TILE_B], tiff_dirs["local_tiff"], tiff_dirs["local_tiff_cropped"],
+                  tiff_dirs["local_metadata"], REMOTE_TIFF, _load_geojson())
+        assert [r["k"] for r in _read(tiff_dirs["local_metadata"], "test_lake", "ST.json")] == \
+            ["COLLECTION_ST_L8_20240512T202405_test_lake.tif"]
+        assert len(_read(tiff_dirs["local_metadata"], "test_lake", "ST_public.json")) == 1
+        assert not os.path.isfile(os.path.join(tiff_dirs["local_tiff_cropped"], "test_lake",
+                                               TILE_A.replace(".tif", "_test_lake.tif")))
+
+    def test_lowres_overviews_rejected(self, tiff_dirs):
+        with pytest.raises(ValueError):
+            add_tiles([TILE_A, TILE_B], tiff_dirs["local_tiff"], tiff_dirs["local_tiff_cropped"],
+                      tiff_dirs["local_metadata"], REMOTE_TIFF, _load_geojson(), options={"lowres_overviews": True})
+        params = vars(main.argument_parser().parse_args(["--mosaic_tiles", "--lowres_overviews"]))
+        with pytest.raises(ValueError):
+            main.processing_options(params)
+
+    def test_single_tile_uses_acquisition_name(self, tiff_dirs):
+        _create_tile(os.path.join(tiff_dirs["local_tiff"], TILE_A), self._values(), 0)
+        add_tiles([TILE_A], tiff_dirs["local_tiff"], tiff_dirs["local_tiff_cropped"],
+                  tiff_dirs["local_metadata"], REMOTE_TIFF, _load_geojson())
+        assert _read(tiff_dirs["local_metadata"], "test_lake", "ST.json")[0]["k"] == \
+            "COLLECTION_ST_L8_20240512T202405_test_lake.tif"
+
+    def test_main_groups_tiles_and_mosaics_removals_again(self, tiff_dirs, monkeypatch):
+        params = vars(main.argument_parser().parse_args([
+            "--mosaic_tiles", "--remote_tiff", "s3://bucket/tiff", "--local_tiff", tiff_dirs["local_tiff"],
+            "--local_metadata", tiff_dirs["local_metadata"]]))
+        for name in ("COLLECTION_ST_S2A_20240512T102031_T32TLT.tif", "COLLECTION_ST_S2A_20240601T102031_T32TLT.tif",
+                     "COLLECTION_ST_S2A_20240601T102031_T32TMT.tif"):
+            open(os.path.join(params["local_tiff"], name), 'w').close()
+
+        def rclone_sync(remote, local_dir, dry_run=False, extension="*.tif"):
+            if dry_run:
+                return (["COLLECTION_ST_S2A_20240601T102031_T32TLT.tif", "COLLECTION_ST_S2A_20240601T102031_T32TMT.tif"],
+                        ["COLLECTION_ST_S2A_20240512T102031_T32TMT.tif"])
+
+        added, removed = [], []
+        monkeypatch.setattr(functions, "rclone_sync", rclone_sync)
+        monkeypatch.setattr(functions, "add_tiles", lambda files, *args: added.append(files) or {})
+        monkeypatch.setattr(functions, "remove_file", lambda file, *args: removed.append(file))
+        main.main(params, state={"catalogue": object(), "stop": False})
+        assert added == [["COLLECTION_ST_S2A_20240601T102031_T32TLT.tif", "COLLECTION_ST_S2A_20240601T102031_T32TMT.tif"],
+                         ["COLLECTION_ST_S2A_20240512T102031_T32TLT.tif"]]
+        assert removed == ["COLLECTION_ST_S2A_20240512T102031.tif", "COLLECTION_ST_S2A_20240512T102031_T32TMT.tif"]
+
+
 # ---------------------------------------------------------------------------
 # Golden file comparison
 # ---------------------------------------------------------------------------
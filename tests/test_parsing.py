@@ -3,7 +3,7 @@ import os
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
 
-from functions import properties_from_filename, uri_to_url
+from functions import properties_from_filename, uri_to_url, acquisition_name, group_tiles
 
 
 class TestPropertiesFromFilename:
@@ -44,6 +44,26 @@ class TestPropertiesFromFilename:
         assert result["satellite"] == "L9"
 
 
+class TestAcquisitions:
+    def test_acquisition_name_drops_tile(self):
+        assert acquisition_name("2024/COLLECTION_CHL_CI_S2A_20240512T102031_T32TLT.tif") == \
+            "COLLECTION_CHL_CI_S2A_20240512T102031.tif"
+        assert acquisition_name("COLLECTION_ST_L8_20240512T202405.tif") == "COLLECTION_ST_L8_20240512T202405.tif"
+
+    def test_group_tiles(self, tmp_path):
+        os.makedirs(str(tmp_path / "2024"))
+        for name in ("COLLECTION_ST_S2A_20240512T102031_T32TLT.tif", "COLLECTION_ST_S2A_20240512T102031_T32TMT.tif",
+                     "COLLECTION_ST_S2B_20240512T102031_T32TLT.tif", "COLLECTION_CHL_S2A_20240512T102031_T32TLT.tif"):
+            open(str(tmp_path / "2024" / name), 'w').close()
+        groups = group_tiles(["2024/COLLECTION_ST_S2A_20240512T102031_T32TMT.tif",
+                              "2024/COLLECTION_ST_S2B_20240512T102031_T32TLT.tif"], str(tmp_path))
+        assert groups == [["2024/COLLECTION_ST_S2A_20240512T102031_T32TLT.tif", "2024/COLLECTION_ST_S2A_20240512T102031_T32TMT.tif"],
+                          ["2024/COLLECTION_ST_S2B_20240512T102031_T32TLT.tif"]]
+
+    def test_group_tiles_skips_missing(self, tmp_path):
+        assert group_tiles(["COLLECTION_ST_S2A_20240512T102031_T32TMT.tif"], str(tmp_path)) == []
+
+
 class TestUriToUrl:
     def test_basic_conversion(self):
         uri = "s3://eawagrs/metadata/collection/zurich/ST.json"
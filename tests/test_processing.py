@@ -1,6 +1,7 @@
 import json
 import os
 import sys
+import tempfile
 
 import numpy as np
 import pytest
@@ -8,7 +9,9 @@ from osgeo import gdal, ogr, osr
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
 
-from functions import extract_tiff_subsection, get_latest, pixel_coordinates
+from functions import (block_windows, build_overviews, extract_tiff_subsection, get_latest, parse_output_profile,
+                       parse_output_profiles, pixel_coordinates, reject_masked_lakes, scene_arrays, scene_overviews,
+                       select_output_profile)
 from conftest import (
     TIFF_ORIGIN_X, TIFF_ORIGIN_Y, TIFF_PIXEL_SIZE, TIFF_WIDTH, TIFF_HEIGHT,
     _create_tiff,
@@ -21,6 +24,15 @@ FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
 # Helper
 # ---------------------------------------------------------------------------
 
+@pytest.fixture
+def report():
+    """The run report of the instrumentation module, reset before and after the test."""
+    import instrumentation
+    instrumentation.report.reset()
+    yield instrumentation.report
+    instrumentation.report.reset()
+
+
 def _load_lake_geojson():
     with open(os.path.join(FIXTURES_DIR, "lakes.geojson")) as f:
         return json.load(f)
@@ -156,6 +168,448 @@ class TestExtractTiffSubsection:
         assert "test_lake" not in result
 
 
+# ---------------------------------------------------------------------------
+# Block-wise processing
+# ---------------------------------------------------------------------------
+
+class TestBlockProcessing:
+    def _compare(self, tiff_path, tmp_path, memory_budget):
+        in_memory = extract_tiff_subsection(tiff_path, str(tmp_path / "memory"), _load_lake_geojson())
+        blocks = extract_tiff_subsection(tiff_path, str(tmp_path / "blocks"), _load_lake_geojson(),
+                                         memory_budget=memory_budget)
+        assert blocks == in_memory
+        for key, stats in in_memory.items():
+            expected = gdal.Open(str(tmp_path / "memory" / key / stats["file"]))
+            actual = gdal.Open(str(tmp_path / "blocks" / key / stats["file"]))
+            assert actual.GetGeoTransform() == expected.GetGeoTransform()
+            np.testing.assert_array_equal(actual.ReadAsArray(), expected.ReadAsArray())
+        assert sorted(os.listdir(str(tmp_path / "blocks"))) == sorted(os.listdir(str(tmp_path / "memory")))
+        assert not [f for f in os.listdir(tempfile.gettempdir()) if f.startswith("blocks_")]
+
+    def test_tiled_matches_in_memory(self, tmp_path):
+        tiff_path = str(tmp_path / "tiled.tif")
+        _create_tiff(tiff_path, with_mask=True, creation_options=["TILED=YES", "BLOCKXSIZE=16", "BLOCKYSIZE=16"])
+        self._compare(tiff_path, tmp_path, memory_budget=0.005)
+
+    def test_strips_match_in_memory(self, synthetic_tiff_with_mask, tmp_path):
+        self._compare(synthetic_tiff_with_mask, tmp_path, memory_budget=0.01)
+
+    def test_large_budget_matches_in_memory(self, synthetic_tiff, tmp_path):
+        self._compare(synthetic_tiff, tmp_path, memory_budget=1024)
+
+    def test_block_windows_cover_raster_within_budget(self, tmp_path):
+        tiff_path = str(tmp_path / "tiled.tif")
+        _create_tiff(tiff_path, creation_options=["TILED=YES", "BLOCKXSIZE=16", "BLOCKYSIZE=16"])
+        ds = gdal.Open(tiff_path)
+        windows = list(block_windows(ds, memory_budget=0.005, bytes_per_pixel=12))
+        covered = np.zeros((TIFF_HEIGHT, TIFF_WIDTH), dtype=int)
+        for x, y, w, h in windows:
+            assert w * h * 12 <= 0.005 * 1024 * 1024 or (w == 16 and h == 16)
+            covered[y:y + h, x:x + w] += 1
+        assert (covered == 1).all()
+        ds = None
+
+
+# ---------------------------------------------------------------------------
+# Quality mask pre-pass
+# ---------------------------------------------------------------------------
+
+class TestQualityPrepass:
+    @pytest.mark.parametrize("memory_budget", [False, 0.01])
+    def test_masked_lake_skipped_before_reading(self, tmp_path, report, memory_budget):
+        tiff_path = str(tmp_path / "cloudy.tif")
+        mask = np.zeros((TIFF_HEIGHT, TIFF_WIDTH), dtype=np.uint8)
+        mask[20:80, 20:80] = 1
+        _create_tiff(tiff_path, with_mask=True, mask=mask)
+        assert extract_tiff_subsection(tiff_path, str(tmp_path / "out"), _load_lake_geojson(),
+                                       memory_budget=memory_budget) == {}
+        assert report.counters["lakes_masked"] == 1
+        assert not set(report.aggregate("stage")) & {"scene_read", "masking"}
+
+    def test_partially_masked_lake_kept(self, synthetic_tiff_with_mask, tmp_path, report):
+        result = extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "out"), _load_lake_geojson())
+        assert "test_lake" in result
+        assert "lakes_masked" not in report.counters
+
+    def test_mask_read_within_budget(self, report):
+        mask = np.ones((1000, 1000), dtype=np.uint8)
+        mask[600, 500] = 0
+        raster = _MaskRaster(mask)
+        lakes = [("cloudy", None, (0, 0, 1000, 500)), ("clear", None, (0, 0, 1000, 1000))]
+        assert [l[0] for l in reject_masked_lakes(raster, lakes, memory_budget=1)] == ["clear"]
+        budget_pixels = 1024 * 1024 // 12
+        assert all(x_size * y_size <= budget_pixels for x_size, y_size in raster.reads)
+        assert sum(x_size * y_size for x_size, y_size in raster.reads) < 500 * 1000 + 700 * 1000
+
+    def test_read_mask_reused(self, report):
+        mask = np.ones((100, 100), dtype=np.uint8)
+        mask[50:60, 50:60] = 0
+        raster = _MaskRaster(mask)
+        lakes = [("cloudy", None, (0, 0, 40, 40)), ("clear", None, (40, 40, 80, 80))]
+        assert [l[0] for l in reject_masked_lakes(raster, lakes, mask=mask)] == ["clear"]
+        assert raster.reads == []
+
+
+class _MaskRaster:
+    """Two band scene with 64 pixel high strips recording the windows read from its quality mask."""
+    def __init__(self, mask):
+        self.mask = mask
+        self.RasterYSize, self.RasterXSize = mask.shape
+        self.RasterCount = 2
+        self.reads = []
+
+    def GetRasterBand(self, index):
+        return self
+
+    def GetBlockSize(self):
+        return self.RasterXSize, 64
+
+    def ReadAsArray(self, x_offset, y_offset, x_size, y_size):
+        self.reads.append((x_size, y_size))
+        return self.mask[y_offset:y_offset + y_size, x_offset:x_offset + x_size]
+
+
+# ---------------------------------------------------------------------------
+# Memory mapped scene access
+# ---------------------------------------------------------------------------
+
+class TestMemmapAccess:
+    def test_uncompressed_is_memory_mapped(self, synthetic_tiff_with_mask):
+        ds = gdal.Open(synthetic_tiff_with_mask)
+        band, mask = scene_arrays(ds, access="memmap")
+        assert not band.flags.owndata
+        np.testing.assert_array_equal(band, ds.GetRasterBand(1).ReadAsArray())
+        np.testing.assert_array_equal(mask, ds.GetRasterBand(2).ReadAsArray())
+        del band, mask
+        ds = None
+
+    def test_compressed_falls_back_to_read(self, tmp_path):
+        tiff_path = str(tmp_path / "deflate.tif")
+        _create_tiff(tiff_path, creation_options=["COMPRESS=DEFLATE"])
+        ds = gdal.Open(tiff_path)
+        band, mask = scene_arrays(ds, access="memmap")
+        assert mask is None
+        np.testing.assert_array_equal(band, ds.GetRasterBand(1).ReadAsArray())
+        ds = None
+
+    def test_memmap_matches_read(self, synthetic_tiff_with_mask, tmp_path):
+        read = extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "read"), _load_lake_geojson())
+        memmap = extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "memmap"), _load_lake_geojson(),
+                                         access="memmap")
+        assert memmap == read
+        expected = gdal.Open(str(tmp_path / "read" / "test_lake" / read["test_lake"]["file"])).ReadAsArray()
+        actual = gdal.Open(str(tmp_path / "memmap" / "test_lake" / memmap["test_lake"]["file"])).ReadAsArray()
+        np.testing.assert_array_equal(actual, expected)
+
+
+# ---------------------------------------------------------------------------
+# Approximate percentile statistics
+# ---------------------------------------------------------------------------
+
+class TestSketchStatistics:
+    def test_sketch_within_bound_of_exact(self, synthetic_tiff_with_mask, tmp_path):
+        exact = extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "exact"), _load_lake_geojson())
+        sketch = extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "sketch"), _load_lake_geojson(),
+                                         statistics="sketch", sketch_accuracy=0.001)
+        e, s = exact["test_lake"], sketch["test_lake"]
+        for key in ("pixels", "valid_pixels", "min", "max", "file"):
+            assert s[key] == e[key]
+        assert abs(s["mean"] - e["mean"]) <= 1e-5
+        for key in ("p10", "p90"):
+            assert abs(s[key] - e[key]) <= 0.001 * abs(e[key]) + 1e-4
+
+    def test_sketch_with_blocks(self, synthetic_tiff_with_mask, tmp_path):
+        in_memory = extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "memory"), _load_lake_geojson(),
+                                            statistics="sketch")
+        blocks = extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "blocks"), _load_lake_geojson(),
+                                         statistics="sketch", memory_budget=0.01)
+        for key in ("pixels", "valid_pixels", "min", "max", "p10", "p90"):
+            assert blocks["test_lake"][key] == in_memory["test_lake"][key]
+
+
+# ---------------------------------------------------------------------------
+# Output profiles
+# ---------------------------------------------------------------------------
+
+class TestOutputProfiles:
+    def _crop(self, tmp_path, tiff_path, profile):
+        result = extract_tiff_subsection(tiff_path, str(tmp_path / profile.replace(":", "_")), _load_lake_geojson(),
+                                         output_profile=profile)
+        return result, gdal.Open(str(tmp_path / profile.replace(":", "_") / "test_lake" / result["test_lake"]["file"]))
+
+    @pytest.mark.parametrize("profile", ["deflate_predictor", "zstd"])
+    def test_lossless_profiles_match_default(self, synthetic_tiff_with_mask, tmp_path, profile):
+        default, expected = self._crop(tmp_path, synthetic_tiff_with_mask, "deflate")
+        result, actual = self._crop(tmp_path, synthetic_tiff_with_mask, profile)
+        assert result == default
+        np.testing.assert_array_equal(actual.ReadAsArray(), expected.ReadAsArray())
+
+    def test_int16_scaled_within_half_scale(self, synthetic_tiff_with_mask, tmp_path):
+        default, expected = self._crop(tmp_path, synthetic_tiff_with_mask, "deflate")
+        result, actual = self._crop(tmp_path, synthetic_tiff_with_mask, "int16:0.001:5")
+        assert result == default
+        band = actual.GetRasterBand(1)
+        assert band.DataType == gdal.GDT_Int16
+        assert band.GetNoDataValue() == -32768
+        raw = band.ReadAsArray()
+        decoded = np.where(raw == -32768, np.nan, raw * band.GetScale() + band.GetOffset())
+        reference = expected.ReadAsArray()
+        np.testing.assert_array_equal(np.isnan(decoded), np.isnan(reference))
+        assert np.nanmax(np.abs(decoded - reference)) <= 0.0005 + 1e-6
+
+    def test_parse_output_profiles(self):
+        profiles = parse_output_profiles("ST=int16:0.01,CHL_CI=lerc:0.001,deflate_predictor")
+        assert profiles == {"default": "deflate_predictor", "ST": "int16:0.01", "CHL_CI": "lerc:0.001"}
+        assert select_output_profile(profiles, "ST") == "int16:0.01"
+        assert select_output_profile(profiles, "TSM") == "deflate_predictor"
+        assert parse_output_profile("lerc:0.01")["creation_options"] == ["COMPRESS=LERC_ZSTD", "MAX_Z_ERROR=0.01"]
+
+    def test_unknown_profile(self):
+        with pytest.raises(ValueError):
+            parse_output_profiles("ST=jpeg")
+
+
+# ---------------------------------------------------------------------------
+# Cloud optimized output
+# ---------------------------------------------------------------------------
+
+class TestCogOutput:
+    def test_single_cog_with_overviews(self, tmp_path):
+        tiff_path = str(tmp_path / "large.tif")
+        _create_tiff(tiff_path, width=2000, height=2000, pixel_size=0.0005,
+                     values=np.ones((2000, 2000), dtype=np.float32))
+        result = extract_tiff_subsection(tiff_path, str(tmp_path / "out"), _load_lake_geojson(), cog=True)
+        assert result["test_lake"]["file"] == "large_test_lake.tif"
+        assert os.listdir(str(tmp_path / "out" / "test_lake")) == ["large_test_lake.tif"]
+        ds = gdal.Open(str(tmp_path / "out" / "test_lake" / "large_test_lake.tif"))
+        assert ds.GetMetadataItem("LAYOUT", "IMAGE_STRUCTURE") == "COG"
+        assert ds.GetRasterBand(1).GetOverviewCount() > 0
+        ds = None
+
+    def test_cog_statistics_match_default(self, synthetic_tiff_with_mask, tmp_path):
+        default = extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "default"), _load_lake_geojson())
+        cog = extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "cog"), _load_lake_geojson(),
+                                      cog=True, output_profile="zstd")
+        assert cog == default
+
+
+# ---------------------------------------------------------------------------
+# Low resolution files from overviews
+# ---------------------------------------------------------------------------
+
+class TestLowresOverviews:
+    def _large_tiff(self, path):
+        rows, columns = np.mgrid[0:2000, 0:2000]
+        values = ((rows + columns) * 0.001 + np.random.default_rng(0).random((2000, 2000)) * 0.01).astype(np.float32)
+        _create_tiff(path, with_mask=True, width=2000, height=2000, pixel_size=0.0005, values=values)
+
+    def test_matches_resampled_lowres(self, tmp_path):
+        tiff_path = str(tmp_path / "large.tif")
+        self._large_tiff(tiff_path)
+        resampled = extract_tiff_subsection(tiff_path, str(tmp_path / "warp"), _load_lake_geojson())
+        overviews = extract_tiff_subsection(tiff_path, str(tmp_path / "overviews"), _load_lake_geojson(),
+                                            lowres_overviews=True)
+        assert overviews == resampled
+        assert overviews["test_lake"]["file"] == "large_test_lake_lowres.tif"
+        expected = gdal.Open(str(tmp_path / "warp" / "test_lake" / "large_test_lake_lowres.tif"))
+        actual = gdal.Open(str(tmp_path / "overviews" / "test_lake" / "large_test_lake_lowres.tif"))
+        assert actual.GetGeoTransform() == pytest.approx(expected.GetGeoTransform())
+        assert (actual.RasterXSize, actual.RasterYSize) == (expected.RasterXSize, expected.RasterYSize)
+        assert actual.GetProjection() == expected.GetProjection()
+        expected_values, actual_values = expected.ReadAsArray(), actual.ReadAsArray()
+        both = ~np.isnan(expected_values) & ~np.isnan(actual_values)
+        assert np.count_nonzero(both) > 0.98 * np.count_nonzero(~np.isnan(expected_values))
+        assert np.abs(actual_values[both] - expected_values[both]).mean() < 0.01
+        # The full resolution crops are unchanged
+        full = [gdal.Open(str(tmp_path / d / "test_lake" / "large_test_lake.tif")).ReadAsArray() for d in ("warp", "overviews")]
+        np.testing.assert_array_equal(full[0], full[1])
+
+    def test_overviews_built_in_memory(self, tmp_path):
+        tiff_path = str(tmp_path / "large.tif")
+        self._large_tiff(tiff_path)
+        ds = gdal.Open(tiff_path)
+        with scene_overviews(ds) as overviews:
+            assert overviews is not ds
+            build_overviews(overviews, 4)
+            assert overviews.GetRasterBand(1).GetOverviewCount() == 2
+        ds = None
+        assert os.listdir(str(tmp_path)) == ["large.tif"]
+        assert not [f for f in (gdal.ReadDir("/vsimem/") or []) if f.startswith("overviews_")]
+
+    def test_unchanged_lowres_kept(self, tmp_path):
+        tiff_path = str(tmp_path / "large.tif")
+        self._large_tiff(tiff_path)
+        lowres_file = str(tmp_path / "overviews" / "test_lake" / "large_test_lake_lowres.tif")
+        first = extract_tiff_subsection(tiff_path, str(tmp_path / "overviews"), _load_lake_geojson(),
+                                        lowres_overviews=True)
+        modified = os.stat(lowres_file).st_mtime_ns
+        second = extract_tiff_subsection(tiff_path, str(tmp_path / "overviews"), _load_lake_geojson(),
+                                         lowres_overviews=True)
+        assert second == first
+        assert os.stat(lowres_file).st_mtime_ns == modified
+
+    @pytest.mark.parametrize("memory_budget", [False, 1])
+    def test_flagged_and_land_pixels_not_averaged(self, tmp_path, memory_budget):
+        rows, columns = np.mgrid[0:2000, 0:2000]
+        values = ((rows + columns) * 0.001).astype(np.float32)
+        mask = np.zeros((2000, 2000), dtype=np.uint8)
+        mask[900:1000, 900:1000] = 1
+        clean_path = str(tmp_path / "clean.tif")
+        _create_tiff(clean_path, with_mask=True, width=2000, height=2000, pixel_size=0.0005, values=values, mask=mask)
+        extract_tiff_subsection(clean_path, str(tmp_path / "clean"), _load_lake_geojson())
+        crop = gdal.Open(str(tmp_path / "clean" / "test_lake" / "clean_test_lake.tif"))
+        x0 = int(round((crop.GetGeoTransform()[0] - TIFF_ORIGIN_X) / 0.0005))
+        y0 = int(round((TIFF_ORIGIN_Y - crop.GetGeoTransform()[3]) / 0.0005))
+        lake = np.zeros((2000, 2000), dtype=bool)
+        lake[y0:y0 + crop.RasterYSize, x0:x0 + crop.RasterXSize] = ~np.isnan(crop.ReadAsArray())
+        crop = None
+
+        # Flagged and land pixels are far off the lake values, also in overviews the scene already has
+        values[~lake] = 1000
+        tiff_path = str(tmp_path / "large.tif")
+        _create_tiff(tiff_path, with_mask=True, width=2000, height=2000, pixel_size=0.0005, values=values, mask=mask)
+        ds = gdal.Open(tiff_path, gdal.GA_Update)
+        ds.BuildOverviews("AVERAGE", [2, 4])
+        ds = None
+        resampled = extract_tiff_subsection(tiff_path, str(tmp_path / "warp"), _load_lake_geojson())
+        overviews = extract_tiff_subsection(tiff_path, str(tmp_path / "overviews"), _load_lake_geojson(),
+                                            memory_budget=memory_budget, lowres_overviews=True)
+        assert overviews == resampled
+        lowres = gdal.Open(str(tmp_path / "overviews" / "test_lake" / "large_test_lake_lowres.tif")).ReadAsArray()
+        assert np.nanmax(lowres) < 5
+        assert not [f for f in os.listdir(tempfile.gettempdir()) if f.startswith("overviews_")]
+
+
+# ---------------------------------------------------------------------------
+# Content hash
+# ---------------------------------------------------------------------------
+
+class TestContentHash:
+    FILE = os.path.join("test_lake", "COLLECTION_ST_L8_20240512T202405_194027_test_lake.tif")
+
+    def _extract(self, tiff_path, output_dir, **kwargs):
+        result = extract_tiff_subsection(tiff_path, output_dir, _load_lake_geojson(), **kwargs)
+        return result, os.stat(os.path.join(output_dir, self.FILE)).st_mtime_ns
+
+    def test_hash_stored_in_crop(self, synthetic_tiff_with_mask, tmp_path):
+        self._extract(synthetic_tiff_with_mask, str(tmp_path))
+        ds = gdal.Open(str(tmp_path / self.FILE))
+        assert len(ds.GetMetadataItem("Content Hash")) == 64
+        ds = None
+
+    def test_unchanged_crop_not_rewritten(self, synthetic_tiff_with_mask, tmp_path, report):
+        first, mtime = self._extract(synthetic_tiff_with_mask, str(tmp_path))
+        second, unchanged = self._extract(synthetic_tiff_with_mask, str(tmp_path))
+        assert second == first
+        assert unchanged == mtime
+        assert report.counters["crops_unchanged"] == 1
+
+    def test_changed_profile_rewritten(self, synthetic_tiff_with_mask, tmp_path, report):
+        _, mtime = self._extract(synthetic_tiff_with_mask, str(tmp_path))
+        os.utime(str(tmp_path / self.FILE), ns=(mtime - 10 ** 9, mtime - 10 ** 9))
+        _, rewritten = self._extract(synthetic_tiff_with_mask, str(tmp_path), output_profile="zstd")
+        assert rewritten != mtime - 10 ** 9
+        assert "crops_unchanged" not in report.counters
+
+    def test_changed_values_rewritten(self, tmp_path):
+        tiff_path = str(tmp_path / os.path.basename(self.FILE).replace("_test_lake", ""))
+        _create_tiff(tiff_path, with_mask=True)
+        self._extract(tiff_path, str(tmp_path / "out"))
+        before = gdal.Open(str(tmp_path / "out" / self.FILE)).GetMetadataItem("Content Hash")
+        _create_tiff(tiff_path, with_mask=True,
+                     values=np.full((TIFF_HEIGHT, TIFF_WIDTH), 0.5, dtype=np.float32))
+        self._extract(tiff_path, str(tmp_path / "out"))
+        ds = gdal.Open(str(tmp_path / "out" / self.FILE))
+        assert ds.GetMetadataItem("Content Hash") != before
+        assert np.nanmax(ds.GetRasterBand(1).ReadAsArray()) == pytest.approx(0.5)
+        ds = None
+
+
+# ---------------------------------------------------------------------------
+# Data cube
+# ---------------------------------------------------------------------------
+
+class TestDataCube:
+    def test_crop_appended_to_cube(self, synthetic_tiff_with_mask, tmp_path):
+        from cube import LakeCube
+        extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "out"), _load_lake_geojson(),
+                                cube=str(tmp_path / "cube"))
+        cube = LakeCube(str(tmp_path / "cube" / "test_lake" / "ST.zarr"))
+        assert cube.files == [os.path.basename(synthetic_tiff_with_mask)]
+        ds = gdal.Open(str(tmp_path / "out" / "test_lake" / "COLLECTION_ST_L8_20240512T202405_194027_test_lake.tif"))
+        np.testing.assert_array_equal(cube.read(0), ds.GetRasterBand(1).ReadAsArray())
+        assert cube.grid()[1] == ds.GetGeoTransform()
+        ds = None
+
+    def test_remove_from_cube(self, synthetic_tiff, tmp_path):
+        from cube import LakeCube
+        from functions import remove_from_cube
+        extract_tiff_subsection(synthetic_tiff, str(tmp_path / "out"), _load_lake_geojson(),
+                                cube=str(tmp_path / "cube"))
+        remove_from_cube(str(tmp_path / "cube"), os.path.basename(synthetic_tiff))
+        assert np.isnan(LakeCube(str(tmp_path / "cube" / "test_lake" / "ST.zarr")).read(0)).all()
+
+
+# ---------------------------------------------------------------------------
+# Lake catalogue
+# ---------------------------------------------------------------------------
+
+def _create_utm_tiff(path, epsg=32632, origin=(430000.0, 5300000.0), pixel_size=500.0, width=120, height=150):
+    ds = gdal.GetDriverByName("GTiff").Create(path, width, height, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((origin[0], pixel_size, 0, origin[1], 0, -pixel_size))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).WriteArray(np.ones((height, width), dtype=np.float32))
+    ds.FlushCache()
+    ds = None
+
+
+class TestLakeCatalogue:
+    def test_utm_scene_is_cropped_in_scene_crs(self, tmp_path):
+        from catalogue import LakeCatalogue
+        tiff_path = str(tmp_path / "COLLECTION_ST_L8_20240512T202405_194027.tif")
+        _create_utm_tiff(tiff_path)
+        catalogue = LakeCatalogue(_load_lake_geojson())
+        result = extract_tiff_subsection(tiff_path, str(tmp_path / "out"), catalogue)
+        ds = gdal.Open(tiff_path)
+        key, geometry, envelope = catalogue.lakes(ds.GetProjection())[0]
+        ds = None
+        assert key == "test_lake"
+        assert envelope[0] > 400000
+        expected_pixels = geometry.GetArea() / 500.0 ** 2
+        assert abs(result["test_lake"]["valid_pixels"] - expected_pixels) / expected_pixels < 0.02
+
+    def test_transformed_geometries_cached_per_crs(self, synthetic_tiff, tmp_path):
+        from catalogue import LakeCatalogue
+        tiff_path = str(tmp_path / "utm.tif")
+        _create_utm_tiff(tiff_path)
+        catalogue = LakeCatalogue(_load_lake_geojson())
+        utm = gdal.Open(tiff_path).GetProjection()
+        wgs84 = gdal.Open(synthetic_tiff).GetProjection()
+        assert catalogue.lakes(utm) is catalogue.lakes(utm)
+        assert catalogue.lakes(wgs84)[0][1] is catalogue.features[0][1]
+        assert catalogue.lakes(wgs84)[0][2] == (8.25, 8.75, 47.25, 47.75)
+
+    def test_mask_cache_reused_with_identical_results(self, synthetic_tiff_with_mask, tmp_path):
+        from catalogue import LakeCatalogue
+        geojson = _load_lake_geojson()
+        catalogue = LakeCatalogue(geojson, mask_cache=16)
+        first = extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "a"), catalogue)
+        masks = list(catalogue._masks.values())
+        second = extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "b"), catalogue)
+        assert first == second == extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "c"), geojson)
+        assert len(masks) == 1
+        assert list(catalogue._masks.values())[0] is masks[0]
+
+    def test_catalogue_matches_geojson(self, synthetic_tiff_with_mask, tmp_path):
+        from catalogue import LakeCatalogue
+        geojson = _load_lake_geojson()
+        from_dict = extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "a"), geojson)
+        from_catalogue = extract_tiff_subsection(synthetic_tiff_with_mask, str(tmp_path / "b"), LakeCatalogue(geojson))
+        assert from_catalogue == from_dict
+
+
 # ---------------------------------------------------------------------------
 # get_latest
 # ---------------------------------------------------------------------------
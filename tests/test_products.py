@@ -0,0 +1,109 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import functions
+import main
+
+
+def _params(tmp_path, config):
+    path = str(tmp_path / "config.json")
+    with open(path, "w") as f:
+        json.dump(config, f)
+    return vars(main.argument_parser().parse_args(["--config", path]))
+
+
+CONFIG = {
+    "lake_geometry": "https://example.com/lakes.json",
+    "metadata_summary": "s3://bucket/metadata/summary.json",
+    "upload": True,
+    "products": [
+        {"metadata_name": "sencast_st", "remote_tiff": "s3://bucket/st/tiff", "local_tiff": "/data/st/tiff",
+         "local_tiff_cropped": "/data/st/cropped", "local_metadata": "/data/st/metadata"},
+        {"metadata_name": "sencast_chl", "remote_tiff": "s3://bucket/chl/tiff", "local_tiff": "/data/chl/tiff",
+         "local_tiff_cropped": "/data/chl/cropped", "local_metadata": "/data/chl/metadata", "statistics": "sketch"}
+    ]
+}
+
+
+class TestProductParams:
+    def test_shared_and_product_settings(self, tmp_path):
+        products = main.product_params(_params(tmp_path, CONFIG))
+        assert [p["metadata_name"] for p in products] == ["sencast_st", "sencast_chl"]
+        assert all(p["upload"] and p["lake_geometry"] == CONFIG["lake_geometry"] for p in products)
+        assert [p["statistics"] for p in products] == ["exact", "sketch"]
+        assert products[1]["remote_tiff"] == "s3://bucket/chl/tiff"
+
+    def test_unknown_setting(self, tmp_path):
+        config = dict(CONFIG, products=[{"metadata_name": "a", "remote_tif": "s3://typo"}])
+        with pytest.raises(ValueError):
+            main.product_params(_params(tmp_path, config))
+
+    def test_products_share_lake_geometry(self, tmp_path):
+        config = dict(CONFIG, products=[{"metadata_name": "a"}, {"metadata_name": "b", "lake_geometry": "other"}])
+        with pytest.raises(ValueError):
+            main.product_params(_params(tmp_path, config))
+
+    @pytest.mark.parametrize("key", ["local_tiff", "local_tiff_cropped", "local_metadata", "retry_queue"])
+    def test_products_do_not_share_folders(self, tmp_path, key):
+        products = [dict(product, retry_queue="/data/{}.json".format(i)) for i, product in enumerate(CONFIG["products"])]
+        products[1][key] = products[0][key] + "/"
+        with pytest.raises(ValueError, match=key):
+            main.product_params(_params(tmp_path, dict(CONFIG, products=products)))
+
+
+class TestRunProducts:
+    def test_shared_state_and_single_summary_update(self, tmp_path, monkeypatch):
+        states, summaries = [], []
+
+        def run(params, lake_geometry, state):
+            states.append(state)
+            state["catalogue"] = state["catalogue"] or object()
+            if params["metadata_name"] == "sencast_st":
+                state["uploaded"].append(params["metadata_name"])
+
+        monkeypatch.setattr(main, "main", run)
+        monkeypatch.setattr(functions, "metadata_summaries", lambda uri, products: summaries.append((uri, products)))
+        main.run_products(_params(tmp_path, CONFIG))
+        assert len(states) == 2 and states[0] is states[1]
+        assert summaries == [("s3://bucket/metadata/summary.json", {"sencast_st": "/data/st/metadata"})]
+
+    def test_failed_product_does_not_stop_others(self, tmp_path, monkeypatch):
+        names = []
+
+        def run(params, lake_geometry, state):
+            names.append(params["metadata_name"])
+            raise ValueError("Failed for: x.tif")
+
+        monkeypatch.setattr(main, "main", run)
+        with pytest.raises(ValueError, match="sencast_st, sencast_chl"):
+            main.run_products(_params(tmp_path, CONFIG))
+        assert names == ["sencast_st", "sencast_chl"]
+
+
+class TestMetadataSummaries:
+    def test_single_upload_for_all_products(self, tmp_path, monkeypatch):
+        import requests
+        for product, parameter in (("st", "ST"), ("chl", "CHL")):
+            os.makedirs(str(tmp_path / product / "geneva"))
+            for suffix in (".json", "_public.json", "_latest.json"):
+                (tmp_path / product / "geneva" / (parameter + suffix)).write_text("[]")
+        uploads = []
+
+        class Response:
+            def json(self):
+                return {"geneva": {"old": ["X"]}}
+
+        def run(command, check):
+            with open(command[2]) as f:
+                uploads.append(json.load(f))
+
+        monkeypatch.setattr(requests, "get", lambda url: Response())
+        monkeypatch.setattr(functions.subprocess, "run", run)
+        functions.metadata_summaries("s3://bucket/summary.json", {"sencast_st": str(tmp_path / "st"),
+                                                                  "sencast_chl": str(tmp_path / "chl")})
+        assert uploads == [{"geneva": {"old": ["X"], "sencast_st": ["ST"], "sencast_chl": ["CHL"]}}]
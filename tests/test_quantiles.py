@@ -0,0 +1,104 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from quantiles import LakeStatistics, QuantileSketch
+
+
+def _bound(values, q, alpha):
+    """Error bound documented in QuantileSketch: alpha times the larger neighbouring order statistic."""
+    ordered = np.sort(values)
+    rank = q * (len(ordered) - 1)
+    return alpha * max(abs(ordered[int(np.floor(rank))]), abs(ordered[int(np.ceil(rank))])) + 1e-12
+
+
+class TestQuantileSketch:
+    @pytest.mark.parametrize("alpha", [0.01, 0.001])
+    @pytest.mark.parametrize("q", [0.0, 0.1, 0.5, 0.9, 1.0])
+    def test_within_error_bound(self, alpha, q):
+        values = np.random.default_rng(1).normal(15, 5, 50000).astype(np.float32)
+        sketch = QuantileSketch(alpha)
+        sketch.add(values)
+        exact = np.percentile(values.astype(np.float64), q * 100)
+        assert abs(sketch.quantile(q) - exact) <= _bound(values, q, alpha)
+
+    def test_negative_and_zero_values(self):
+        values = np.concatenate([np.linspace(-10, -0.1, 1000), np.zeros(200), np.linspace(0.1, 3, 500)])
+        sketch = QuantileSketch(0.001)
+        sketch.add(values)
+        for q in (0.05, 0.1, 0.5, 0.6, 0.9):
+            exact = np.percentile(values, q * 100)
+            assert abs(sketch.quantile(q) - exact) <= _bound(values, q, 0.001)
+
+    def test_ignores_nan(self):
+        sketch = QuantileSketch()
+        sketch.add(np.array([1.0, np.nan, 2.0]))
+        assert sketch.count == 2
+
+    def test_merge_equals_single_sketch(self):
+        values = np.random.default_rng(2).uniform(0, 30, 10000)
+        whole = QuantileSketch()
+        whole.add(values)
+        merged = QuantileSketch()
+        for chunk in np.array_split(values, 7):
+            part = QuantileSketch()
+            part.add(chunk)
+            merged.merge(part)
+        assert merged.to_dict() == whole.to_dict()
+
+    def test_merge_rejects_different_accuracy(self):
+        with pytest.raises(ValueError):
+            QuantileSketch(0.01).merge(QuantileSketch(0.001))
+
+    def test_round_trip(self):
+        sketch = QuantileSketch()
+        sketch.add(np.array([-1.5, 0.0, 2.5, 7.0]))
+        restored = QuantileSketch.from_dict(sketch.to_dict())
+        assert restored.quantile(0.5) == sketch.quantile(0.5)
+
+    def test_empty_sketch_raises(self):
+        with pytest.raises(ValueError):
+            QuantileSketch().quantile(0.5)
+
+
+class TestLakeStatistics:
+    def test_exact_matches_numpy(self):
+        values = np.random.default_rng(3).normal(10, 2, 5000).astype(np.float32)
+        stats = LakeStatistics("exact")
+        for chunk in np.array_split(values, 5):
+            stats.add(chunk)
+        result = stats.result()
+        assert result["valid_pixels"] == 5000
+        assert result["min"] == np.round(float(values.min()), 5)
+        assert result["max"] == np.round(float(values.max()), 5)
+        assert result["p10"] == np.round(np.percentile(values, 10), 5)
+        assert result["p90"] == np.round(np.percentile(values, 90), 5)
+
+    def test_sketch_close_to_exact(self):
+        values = np.random.default_rng(4).normal(10, 2, 20000).astype(np.float32)
+        exact, sketch = LakeStatistics("exact"), LakeStatistics("sketch", alpha=0.001)
+        exact.add(values)
+        sketch.add(values)
+        e, s = exact.result(), sketch.result()
+        for key in ("valid_pixels", "min", "max"):
+            assert s[key] == e[key]
+        assert abs(s["mean"] - e["mean"]) <= 1e-5
+        assert abs(s["p10"] - e["p10"]) <= _bound(values, 0.1, 0.001) + 1e-5
+        assert abs(s["p90"] - e["p90"]) <= _bound(values, 0.9, 0.001) + 1e-5
+
+    def test_merge(self):
+        values = np.random.default_rng(5).uniform(1, 2, 1000)
+        a, b = LakeStatistics("sketch"), LakeStatistics("sketch")
+        a.add(values[:400])
+        b.add(values[400:])
+        whole = LakeStatistics("sketch")
+        whole.add(values)
+        assert a.merge(b).result() == whole.result()
+
+    def test_unknown_mode(self):
+        with pytest.raises(ValueError):
+            LakeStatistics("approximate")
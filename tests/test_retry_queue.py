@@ -0,0 +1,67 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from retry_queue import (defer, due_files, forget, load_retry_queue, record_failure, record_success,
+                         save_retry_queue)
+
+FILE = "COLLECTION_ST_L8_20240512T202405_194027.tif"
+
+
+class TestRetryQueue:
+    def test_missing_file_gives_empty_queue(self, tmp_path):
+        queue = load_retry_queue(str(tmp_path / "queue.json"))
+        assert queue == {"retry": {}, "quarantine": {}}
+
+    def test_failure_schedules_retry_with_backoff(self):
+        queue = load_retry_queue("/nonexistent/queue.json")
+        assert record_failure(queue, FILE, "boom", backoff=100, now=1000) is False
+        assert queue["retry"][FILE]["attempts"] == 1
+        assert queue["retry"][FILE]["next_attempt"] == 1100
+        assert due_files(queue, now=1099) == []
+        assert due_files(queue, now=1100) == [FILE]
+
+    def test_backoff_doubles(self):
+        queue = load_retry_queue("/nonexistent/queue.json")
+        record_failure(queue, FILE, "boom", backoff=100, now=1000)
+        record_failure(queue, FILE, "boom", backoff=100, now=2000)
+        record_failure(queue, FILE, "boom", backoff=100, now=3000)
+        assert queue["retry"][FILE]["attempts"] == 3
+        assert queue["retry"][FILE]["next_attempt"] == 3400
+
+    def test_quarantine_after_max_attempts(self):
+        queue = load_retry_queue("/nonexistent/queue.json")
+        results = [record_failure(queue, FILE, "boom", max_attempts=3, now=i) for i in range(3)]
+        assert results == [False, False, True]
+        assert FILE not in queue["retry"]
+        assert queue["quarantine"][FILE]["attempts"] == 3
+        assert queue["quarantine"][FILE]["error"] == "boom"
+        assert due_files(queue, now=10 ** 12) == []
+
+    def test_success_clears_entry(self):
+        queue = load_retry_queue("/nonexistent/queue.json")
+        record_failure(queue, FILE, "boom", now=0)
+        record_success(queue, FILE)
+        assert queue["retry"] == {}
+
+    def test_forget_clears_quarantine(self):
+        queue = load_retry_queue("/nonexistent/queue.json")
+        record_failure(queue, FILE, "boom", max_attempts=1, now=0)
+        forget(queue, FILE)
+        assert queue == {"retry": {}, "quarantine": {}}
+
+    def test_defer_is_due_without_attempt(self):
+        queue = load_retry_queue("/nonexistent/queue.json")
+        defer(queue, FILE, now=5)
+        assert due_files(queue, now=5) == [FILE]
+        assert queue["retry"][FILE]["attempts"] == 0
+
+    def test_round_trip(self, tmp_path):
+        path = str(tmp_path / "queue" / "queue.json")
+        queue = load_retry_queue(path)
+        record_failure(queue, FILE, ValueError("bad scene"), now=0)
+        save_retry_queue(path, queue)
+        loaded = load_retry_queue(path)
+        assert loaded == queue
+        assert loaded["retry"][FILE]["error"] == "bad scene"
@@ -0,0 +1,68 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import functions
+import main
+
+
+@pytest.fixture
+def params(tmp_path):
+    params = vars(main.argument_parser().parse_args([
+        "--remote_tiff", "s3://bucket/tiff", "--local_tiff", str(tmp_path / "tiff"),
+        "--local_metadata", str(tmp_path / "metadata")]))
+    os.makedirs(params["local_tiff"])
+    return params
+
+
+class TestNewestFirst:
+    FILES = ["COLLECTION_ST_S2A_20240301T102031_T32TLT.tif", "COLLECTION_ST_S2A_20240601T102031_T32TLT.tif",
+             "COLLECTION_ST_S2A_20240401T102031_T32TMT.tif", "COLLECTION_CHL_S2A_20240501T102031_T32TLT.tif",
+             "COLLECTION_ST_S2A_20240501T102031_T32TLT.tif"]
+
+    def test_newest_per_parameter_and_tile_first(self):
+        priority, backfill = main.newest_first([[f] for f in self.FILES])
+        assert priority == [["COLLECTION_ST_S2A_20240601T102031_T32TLT.tif"],
+                            ["COLLECTION_CHL_S2A_20240501T102031_T32TLT.tif"],
+                            ["COLLECTION_ST_S2A_20240401T102031_T32TMT.tif"]]
+        assert backfill == [["COLLECTION_ST_S2A_20240501T102031_T32TLT.tif"],
+                            ["COLLECTION_ST_S2A_20240301T102031_T32TLT.tif"]]
+
+    def test_checkpoint_published_before_backfill(self, params, monkeypatch):
+        def rclone_sync(remote, local_dir, dry_run=False, extension="*.tif"):
+            if dry_run:
+                return list(self.FILES), []
+
+        events = []
+        monkeypatch.setattr(functions, "rclone_sync", rclone_sync)
+        monkeypatch.setattr(functions, "add_file", lambda file, *args: events.append(file) or {"lake": file})
+        monkeypatch.setattr(main, "publish_checkpoint", lambda params, outputs, uploader: events.append(outputs))
+        params["newest_first"] = True
+        main.main(params, state={"catalogue": object(), "stop": False})
+        assert events[3] == [{"lake": f} for f in events[:3]]
+        assert events[4:] == ["COLLECTION_ST_S2A_20240501T102031_T32TLT.tif", "COLLECTION_ST_S2A_20240301T102031_T32TLT.tif"]
+
+    def test_checkpoint_uploads_crops_and_latest(self, params, monkeypatch):
+        import uploader
+        submitted = []
+
+        class Uploader:
+            uploaded = 0
+
+            def __init__(self, *args):
+                pass
+
+            def submit(self, outputs):
+                submitted.append(outputs)
+
+            def finish(self):
+                return []
+
+        monkeypatch.setattr(uploader, "BackgroundUploader", Uploader)
+        params["upload"] = True
+        main.publish_checkpoint(params, [{"geneva": {"crops": ["a_geneva.tif"],
+                                                     "metadata": ["geneva/ST.json", "geneva/ST_latest.json"]}}])
+        assert submitted == [{"geneva": {"crops": ["a_geneva.tif"], "metadata": ["geneva/ST_latest.json"]}}]
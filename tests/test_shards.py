@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import functions
+import main
+from conftest import _read, _scene
+
+LAKES = ["geneva", "zurich", "constance", "lugano", "maggiore"]
+
+
+def _add(local_metadata, date, lake="test_lake", vp=50, sharded=False):
+    file, record, public = _scene(date, vp=vp, lake=lake)
+    functions.add_metadata_entry(local_metadata, lake, "ST", file, record, public, sharded=sharded)
+
+
+@pytest.fixture
+def params(tmp_path):
+    def make(*args):
+        params = vars(main.argument_parser().parse_args([
+            "-r", "--no_sync", "--remote_tiff", "s3://bucket/tiff", "--shard_dir", str(tmp_path / "shards"),
+            "--local_tiff", str(tmp_path / "tiff"), "--local_tiff_cropped", str(tmp_path / "cropped"),
+            "--local_metadata", str(tmp_path / "metadata")] + list(args)))
+        return params
+    os.makedirs(str(tmp_path / "tiff" / "2024"))
+    for day in range(1, 21):
+        open(str(tmp_path / "tiff" / "2024" / "COLLECTION_ST_L8_202406{:02d}T102030_194027.tif".format(day)), 'w').close()
+    with open(str(tmp_path / "lakes.geojson"), 'w') as f:
+        json.dump({"type": "FeatureCollection", "features": [{"properties": {"key": lake}} for lake in LAKES]}, f)
+    return make
+
+
+@pytest.fixture
+def processed(monkeypatch):
+    calls = []
+
+    def add_file(file, local_tiff, local_tiff_cropped, local_metadata, remote_tiff, geometry, options=None):
+        calls.append((file, local_metadata, [f["properties"]["key"] for f in geometry["features"]], options))
+        return {}
+
+    monkeypatch.setattr(functions, "add_file", add_file)
+    monkeypatch.setattr(main, "lake_catalogue", lambda geojson, mask_cache=0: geojson)
+    return calls
+
+
+class TestPartition:
+    def test_parse_shard(self):
+        assert main.parse_shard(False) is None
+        assert main.parse_shard("2/4") == (2, 4)
+        for spec in ("4/4", "1", "a/2"):
+            with pytest.raises(ValueError):
+                main.parse_shard(spec)
+
+    def test_shard_of_is_stable(self):
+        assert functions.shard_of("COLLECTION_ST_L8_20240601T102030_194027.tif", 7) == \
+            functions.shard_of("2024/COLLECTION_ST_L8_20240601T102030_194027.tif", 7)
+        assert [functions.shard_of(lake, 3) for lake in LAKES] == [functions.shard_of(lake, 3) for lake in LAKES]
+
+    def test_files_are_split_between_shards(self, tmp_path, params, processed):
+        files = []
+        for index in range(3):
+            main.reprocess(params("--shard", "{}/3".format(index)), str(tmp_path / "lakes.geojson"))
+            shard_files = [call[0] for call in processed[len(files):]]
+            assert all(call[1] == str(tmp_path / "shards" / "{}-of-3".format(index) / "metadata")
+                       for call in processed[len(files):])
+            files.extend(shard_files)
+        assert len(files) == 20
+        assert len(set(files)) == 20
+
+    def test_lakes_are_split_between_shards(self, tmp_path, params, processed):
+        lakes = []
+        for index in range(2):
+            main.reprocess(params("--shard", "{}/2".format(index), "--shard_by", "lake"), str(tmp_path / "lakes.geojson"))
+            lakes.extend(processed[-1][2])
+            assert len(processed) == 20 * (index + 1)
+        assert sorted(lakes) == sorted(LAKES)
+
+    def test_cube_requires_lake_partition(self, tmp_path, params, processed):
+        with pytest.raises(ValueError):
+            main.reprocess(params("--shard", "0/2", "--local_cube", str(tmp_path / "cube")), str(tmp_path / "lakes.geojson"))
+
+
+class TestMergeShards:
+    DATES = ["20240601T102030", "20230105T101010", "20240512T202405", "20240601T090000", "20220101T000000"]
+
+    def _shards(self, shard_dir, order, sharded=False):
+        for index, dates in order:
+            local_metadata = os.path.join(shard_dir, "{}-of-2".format(index), "metadata")
+            for date in dates:
+                _add(local_metadata, date, vp=80 if date == "20240601T090000" else 50, sharded=sharded)
+
+    def test_matches_single_run(self, tmp_path):
+        single = str(tmp_path / "single")
+        for date in self.DATES:
+            _add(single, date, vp=80 if date == "20240601T090000" else 50)
+        self._shards(str(tmp_path / "shards"), [(0, self.DATES[:2]), (1, self.DATES[2:])])
+        functions.merge_shards(str(tmp_path / "shards"), str(tmp_path / "cropped"), str(tmp_path / "metadata"))
+        merged = _read(str(tmp_path / "metadata" / "test_lake" / "ST.json"))
+        assert [r["dt"] for r in merged] == sorted(self.DATES)
+        assert sorted(merged, key=lambda r: r["dt"]) == sorted(_read(os.path.join(single, "test_lake", "ST.json")), key=lambda r: r["dt"])
+        assert _read(str(tmp_path / "metadata" / "test_lake" / "ST_latest.json")) == \
+            _read(os.path.join(single, "test_lake", "ST_latest.json"))
+        assert _read(str(tmp_path / "metadata" / "test_lake" / "ST_latest.json"))["dt"] == "20240601T090000"
+
+    def test_deterministic(self, tmp_path):
+        self._shards(str(tmp_path / "a"), [(0, self.DATES[:3]), (1, self.DATES[3:])])
+        self._shards(str(tmp_path / "b"), [(1, self.DATES[3:][::-1]), (0, self.DATES[:3][::-1])])
+        for name in ("a", "b"):
+            functions.merge_shards(str(tmp_path / name), str(tmp_path / "cropped"), str(tmp_path / ("metadata_" + name)))
+        for document in ("ST.json", "ST_public.json", "ST_latest.json"):
+            with open(str(tmp_path / "metadata_a" / "test_lake" / document), 'rb') as a, \
+                    open(str(tmp_path / "metadata_b" / "test_lake" / document), 'rb') as b:
+                assert a.read() == b.read()
+
+    def test_replaces_canonical_entries(self, tmp_path):
+        _add(str(tmp_path / "metadata"), "20220101T000000", vp=10)
+        _add(str(tmp_path / "metadata"), "20210101T000000", vp=10)
+        self._shards(str(tmp_path / "shards"), [(0, ["20220101T000000"])])
+        functions.merge_shards(str(tmp_path / "shards"), str(tmp_path / "cropped"), str(tmp_path / "metadata"))
+        merged = _read(str(tmp_path / "metadata" / "test_lake" / "ST.json"))
+        assert [(r["dt"], r["vp"]) for r in merged] == [("20210101T000000", 10), ("20220101T000000", 50)]
+        assert len(_read(str(tmp_path / "metadata" / "test_lake" / "ST_public.json"))) == 2
+
+    def test_sharded_layout(self, tmp_path):
+        self._shards(str(tmp_path / "shards"), [(0, self.DATES[:2]), (1, self.DATES[2:])], sharded=True)
+        functions.merge_shards(str(tmp_path / "shards"), str(tmp_path / "cropped"), str(tmp_path / "metadata"), sharded=True)
+        index = _read(str(tmp_path / "metadata" / "test_lake" / "ST" / "index.json"))
+        assert sorted(index["shards"].keys()) == ["2022", "2023", "2024"]
+        assert index["latest"]["dt"] == "20240601T090000"
+
+    def test_crops_are_moved(self, tmp_path):
+        crop = tmp_path / "shards" / "0-of-2" / "tiff_cropped" / "test_lake" / "COLLECTION_ST_L8_20240601T102030_194027_test_lake.tif"
+        os.makedirs(str(crop.parent))
+        crop.write_bytes(b"tiff")
+        functions.merge_shards(str(tmp_path / "shards"), str(tmp_path / "cropped"), str(tmp_path / "metadata"))
+        assert (tmp_path / "cropped" / "test_lake" / crop.name).read_bytes() == b"tiff"
+
+    def _crop(self, path, digest):
+        from osgeo import gdal
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ds = gdal.GetDriverByName("GTiff").Create(path, 2, 2, 1, gdal.GDT_Float32)
+        ds.SetMetadataItem("Content Hash", digest)
+        ds = None
+        return path
+
+    def _crops(self, folder, digest, lowres=True):
+        name = "COLLECTION_ST_L8_20240601T102030_194027_test_lake"
+        main = self._crop(os.path.join(folder, "test_lake", name + ".tif"), digest)
+        if lowres:
+            self._crop(os.path.join(folder, "test_lake", name + "_lowres.tif"), digest)
+        return main, main.replace(".tif", "_lowres.tif")
+
+    def test_unchanged_crops_kept(self, tmp_path):
+        canonical, canonical_lowres = self._crops(str(tmp_path / "cropped"), "abc")
+        os.utime(canonical, ns=(10 ** 9, 10 ** 9))
+        os.utime(canonical_lowres, ns=(10 ** 9, 10 ** 9))
+        shard, shard_lowres = self._crops(str(tmp_path / "shards" / "0-of-1" / "tiff_cropped"), "abc")
+        functions.merge_shards(str(tmp_path / "shards"), str(tmp_path / "cropped"), str(tmp_path / "metadata"))
+        assert os.stat(canonical).st_mtime_ns == 10 ** 9
+        assert os.stat(canonical_lowres).st_mtime_ns == 10 ** 9
+        assert not os.path.exists(shard) and not os.path.exists(shard_lowres)
+
+    def test_changed_crop_replaces_stale_lowres(self, tmp_path):
+        from osgeo import gdal
+        canonical, canonical_lowres = self._crops(str(tmp_path / "cropped"), "abc")
+        self._crops(str(tmp_path / "shards" / "0-of-1" / "tiff_cropped"), "def", lowres=False)
+        functions.merge_shards(str(tmp_path / "shards"), str(tmp_path / "cropped"), str(tmp_path / "metadata"))
+        assert gdal.Open(canonical).GetMetadataItem("Content Hash") == "def"
+        assert not os.path.exists(canonical_lowres)
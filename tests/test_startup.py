@@ -0,0 +1,24 @@
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), "..", "src")
+
+
+def _loaded_modules(code):
+    result = subprocess.run([sys.executable, "-c", code], cwd=SRC_DIR, capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+class TestLazyImports:
+    def test_cli_import_does_not_load_heavy_modules(self):
+        """Importing main/functions (CLI startup, "No updates" path) must not load numpy, GDAL or requests."""
+        loaded = _loaded_modules(
+            "import sys, main, functions; "
+            "print(' '.join(m for m in ('numpy', 'osgeo', 'requests') if m in sys.modules))")
+        assert loaded == []
+
+    def test_help_runs(self):
+        result = subprocess.run([sys.executable, "main.py", "-h"], cwd=SRC_DIR, capture_output=True, text=True)
+        assert result.returncode == 0
+        assert "--remote_tiff" in result.stdout
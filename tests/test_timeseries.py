@@ -0,0 +1,70 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import timeseries
+from functions import add_metadata_entry, update_timeseries, remove_file
+from conftest import _scene
+
+
+def _add(local_metadata, date, sharded=False, vp=50):
+    file, record, public = _scene(date, vp)
+    add_metadata_entry(local_metadata, "test_lake", "ST", file, record, public, sharded=sharded)
+    update_timeseries(local_metadata, "test_lake", "ST", file, record)
+
+
+def _path(local_metadata):
+    return os.path.join(local_metadata, "test_lake", "ST_timeseries.npz")
+
+
+class TestColumns:
+    def test_from_records_sorted_and_typed(self):
+        records = [_scene(d)[1] for d in ("20240601T102030", "20230105T101010")]
+        columns = timeseries.from_records(records)
+        assert columns["dt"].dtype == np.dtype("datetime64[s]")
+        assert columns["dt"][0] == np.datetime64("2023-01-05T10:10:10")
+        assert columns["vp"].dtype == np.int64
+        assert columns["mean"].dtype == np.float64
+
+    def test_round_trip(self, tmp_path):
+        columns = timeseries.from_records([_scene("20240601T102030")[1]])
+        timeseries.save(str(tmp_path / "ts.npz"), columns)
+        loaded = timeseries.load(str(tmp_path / "ts.npz"))
+        for name in timeseries.COLUMNS:
+            np.testing.assert_array_equal(loaded[name], columns[name])
+
+    def test_empty(self, tmp_path):
+        columns = timeseries.from_records([])
+        timeseries.save(str(tmp_path / "ts.npz"), columns)
+        assert timeseries.load(str(tmp_path / "ts.npz"))["dt"].size == 0
+
+
+class TestUpdateTimeseries:
+    def test_incremental_updates(self, tmp_path):
+        for date in ("20240601T102030", "20230105T101010", "20240512T202405"):
+            _add(str(tmp_path), date)
+        columns = timeseries.load(_path(str(tmp_path)))
+        assert [str(d) for d in columns["dt"]] == ["2023-01-05T10:10:10", "2024-05-12T20:24:05", "2024-06-01T10:20:30"]
+
+    def test_readd_replaces_entry(self, tmp_path):
+        _add(str(tmp_path), "20240601T102030", vp=50)
+        _add(str(tmp_path), "20240601T102030", vp=70)
+        columns = timeseries.load(_path(str(tmp_path)))
+        assert columns["vp"].tolist() == [70]
+
+    def test_built_from_existing_records(self, tmp_path):
+        for date in ("20230105T101010", "20240512T202405"):
+            file, record, public = _scene(date)
+            add_metadata_entry(str(tmp_path), "test_lake", "ST", file, record, public, sharded=True)
+        _add(str(tmp_path), "20240601T102030", sharded=True)
+        assert timeseries.load(_path(str(tmp_path)))["dt"].size == 3
+
+    def test_remove(self, tmp_path):
+        for date in ("20230105T101010", "20240512T202405"):
+            _add(str(tmp_path), date)
+        remove_file(_scene("20230105T101010")[0], str(tmp_path), timeseries=True)
+        columns = timeseries.load(_path(str(tmp_path)))
+        assert columns["k"].tolist() == [_scene("20240512T202405")[1]["k"]]
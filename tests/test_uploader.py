@@ -0,0 +1,126 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import uploader
+from uploader import BackgroundUploader
+
+
+@pytest.fixture
+def transfers(monkeypatch):
+    """
+    Records (start, end, local, remote, content) of every rclone copyto, crops take longer than metadata and
+    "slow" crops longer still.
+    """
+    log = []
+    lock = threading.Lock()
+
+    def run(command, check, capture_output):
+        start = time.monotonic()
+        content = None
+        if command[2].endswith(".json"):
+            with open(command[2], 'r') as f:
+                content = f.read()
+        name = os.path.basename(command[2])
+        time.sleep(0.3 if "slow" in name else 0.05 if name.endswith(".tif") else 0.001)
+        if "fail" in name:
+            raise RuntimeError("rclone failed")
+        with lock:
+            log.append((start, time.monotonic(), command[2], command[3], content))
+
+    monkeypatch.setattr(uploader.subprocess, "run", run)
+    return log
+
+
+def _uploader(tmp_path, concurrency=4):
+    return BackgroundUploader(str(tmp_path / "cropped"), "s3://bucket/cropped", str(tmp_path / "metadata"),
+                              "s3://bucket/metadata", concurrency)
+
+
+def _document(path, content="[]"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+def _outputs(tmp_path, lake, crops=("a.tif", "a_lowres.tif")):
+    return {lake: {"crops": [str(tmp_path / "cropped" / lake / c) for c in crops],
+                   "metadata": [_document(str(tmp_path / "metadata" / lake / n)) for n in ("ST.json", "ST_latest.json")]}}
+
+
+class TestBackgroundUploader:
+    def test_remote_paths(self, tmp_path):
+        u = _uploader(tmp_path)
+        assert u.remote_path(str(tmp_path / "cropped" / "geneva" / "a.tif")) == "s3://bucket/cropped/geneva/a.tif"
+        assert u.remote_path(str(tmp_path / "metadata" / "geneva" / "ST.json")) == "s3://bucket/metadata/geneva/ST.json"
+        with pytest.raises(ValueError):
+            u.remote_path(str(tmp_path / "elsewhere.json"))
+        u.finish()
+
+    def test_metadata_uploaded_after_its_crops(self, tmp_path, transfers):
+        u = _uploader(tmp_path)
+        u.submit(_outputs(tmp_path, "geneva"))
+        u.submit(_outputs(tmp_path, "zurich"))
+        assert u.finish() == []
+        assert u.uploaded == 8
+        for lake in ("geneva", "zurich"):
+            crops_done = max(t[1] for t in transfers if lake in t[3] and t[3].endswith(".tif"))
+            metadata_start = min(t[0] for t in transfers if lake in t[3] and t[3].endswith(".json"))
+            assert metadata_start >= crops_done
+
+    def test_bounded_concurrency(self, tmp_path, transfers):
+        u = _uploader(tmp_path, concurrency=2)
+        u.submit(_outputs(tmp_path, "geneva", crops=["{}.tif".format(i) for i in range(6)]))
+        u.finish()
+        crops = [(t[0], t[1]) for t in transfers if t[3].endswith(".tif")]
+        for start, end in crops:
+            assert sum(1 for s, e in crops if s <= start < e) <= 2
+
+    def test_failed_crop_holds_back_metadata(self, tmp_path, transfers):
+        u = _uploader(tmp_path)
+        u.submit(_outputs(tmp_path, "geneva", crops=("fail.tif",)))
+        failed = u.finish()
+        assert not any(t[3].endswith(".json") for t in transfers)
+        assert len(failed) == 3
+
+    def test_queued_document_uploaded_once(self, tmp_path, transfers):
+        u = _uploader(tmp_path, concurrency=1)
+        path = _document(str(tmp_path / "metadata" / "geneva" / "ST.json"))
+        u.submit({"a": {"crops": [str(tmp_path / "cropped" / "a" / "a.tif")], "metadata": []}})
+        for _ in range(3):
+            u.submit({"geneva": {"crops": [], "metadata": [path]}})
+        u.finish()
+        assert sum(1 for t in transfers if t[3] == "s3://bucket/metadata/geneva/ST.json") == 1
+
+    def test_shared_document_waits_for_earlier_crops(self, tmp_path, transfers):
+        u = _uploader(tmp_path)
+        path = str(tmp_path / "metadata" / "geneva" / "ST.json")
+        u.submit({"geneva": {"crops": [str(tmp_path / "cropped" / "geneva" / "slow.tif")],
+                             "metadata": [_document(path, '["slow.tif"]')]}})
+        u.submit({"geneva": {"crops": [str(tmp_path / "cropped" / "geneva" / "fast.tif")],
+                             "metadata": [_document(path, '["slow.tif", "fast.tif"]')]}})
+        _document(path, '["slow.tif", "fast.tif", "unsubmitted.tif"]')
+        assert u.finish() == []
+        slow_done = next(t[1] for t in transfers if t[3].endswith("slow.tif"))
+        documents = [t for t in transfers if t[3].endswith("ST.json")]
+        assert all(t[0] >= slow_done for t in documents)
+        assert documents[-1][4] == '["slow.tif", "fast.tif"]'
+
+    def test_failed_crop_holds_back_later_metadata_of_lake(self, tmp_path, transfers):
+        u = _uploader(tmp_path)
+        path = str(tmp_path / "metadata" / "geneva" / "ST.json")
+        u.submit({"geneva": {"crops": [str(tmp_path / "cropped" / "geneva" / "slow_fail.tif")],
+                             "metadata": [_document(path)]}})
+        u.submit({"geneva": {"crops": [str(tmp_path / "cropped" / "geneva" / "b.tif")], "metadata": [_document(path)]}})
+        u.submit(_outputs(tmp_path, "zurich"))
+        failed = u.finish()
+        assert not any(t[3].startswith("s3://bucket/metadata/geneva") for t in transfers)
+        assert any(t[3] == "s3://bucket/cropped/geneva/b.tif" for t in transfers)
+        assert sum(1 for t in transfers if t[3].startswith("s3://bucket/metadata/zurich")) == 2
+        assert failed.count(path) == 2